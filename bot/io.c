@@ -111,7 +111,7 @@ tile_id * read_tiles_array(FILE *file)
 	int i = 0;
 	for (t = 0; t < TILES_COUNT; t++) {
 		int s;
-		for (s = 0; s < tiles[t]; t++) {
+		for (s = 0; s < tiles[t]; s++) {
 			array[i++] = t;
 		}
 	}
@@ -17,17 +17,67 @@
 
 import socket
 import select
-import string
+
+# Maximal length of line (without '\n'), longer line closes the connection
+MAX_LINE_LENGTH = 16384
 
 class ConnectionClosed(Exception):
 	pass
 
+class LineTooLong(ConnectionClosed):
+	pass
+
+
+class LineBuffer:
+
+	""" Lines received from socket. Data are received by large recv_into calls
+		into one reusable bytearray, lines are cut out of it without copying the rest. """
+
+	def __init__(self, sock, max_line_length = MAX_LINE_LENGTH):
+		self.socket = sock
+		self.data = bytearray(max_line_length + 1)
+		self.view = memoryview(self.data)
+		self.start = 0
+		self.end = 0
+
+	def next_line(self):
+		""" Returns the next received line without '\n' or None if it is not complete """
+		pos = self.data.find("\n", self.start, self.end)
+		if pos < 0:
+			if self.end - self.start == len(self.data):
+				raise LineTooLong()
+			return None
+		line = self.view[self.start:pos].tobytes()
+		if pos + 1 == self.end:
+			self.start = self.end = 0
+		else:
+			self.start = pos + 1
+		return line
+
+	def receive(self):
+		""" Receives what is ready (one recv_into), it blocks if nothing is ready.
+			Raises ConnectionClosed at the end of stream. """
+		if self.end == len(self.data):
+			# Move the unfinished line to the beginning
+			size = self.end - self.start
+			self.data[:size] = self.view[self.start:self.end]
+			self.start = 0
+			self.end = size
+		try:
+			count = self.socket.recv_into(self.view[self.end:])
+		except socket.error, e:
+			raise ConnectionClosed()
+		if count == 0:
+			raise ConnectionClosed()
+		self.end += count
+
 
 class Connection:
-	def __init__(self, sock = None):
+	def __init__(self, sock = None, max_line_length = MAX_LINE_LENGTH):
 		if sock == None:
 			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket = sock
+		self.lines = LineBuffer(sock, max_line_length)
 
 	def connect(self, addr, port):
 		return self.socket.connect_ex((addr, port)) == 0
@@ -54,23 +104,16 @@ class Connection:
 		self.socket.close()
 
 	def read_line(self):
-		# TODO: Handle long lines
-		try:
-			if self.is_read_ready():
-				buf = []
-				while True:
-					char = self.socket.recv(1)
-					if char == '\n':
-						return string.join(buf,'')
-					if char == '':
-						raise ConnectionClosed()
-					buf.append(char)
-		except socket.error,e:
-			raise ConnectionClosed()
+		""" Returns the next line or None if the whole line is not received yet """
+		line = self.lines.next_line()
+		if line is None and self.is_read_ready():
+			self.lines.receive()
+			line = self.lines.next_line()
+		return line
 
 	def send(self, string):
 		try:
-			self.socket.send(string)
+			self.socket.sendall(string)
 		except socket.error,e:
 			raise ConnectionClosed()	
 
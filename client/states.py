@@ -29,6 +29,14 @@ import pygame
 def split_str(string, sep):
 	return [ i for i in string.split(sep) if i != "" ]
 
+def parse_riichi_discards(message):
+	""" Returns dictionary: name of discarded tile -> list of names of waiting tiles """
+	result = {}
+	for item in split_str(message.get("riichi_discards", ""), ";"):
+		tile, waiting = item.split(":")
+		result[tile] = split_str(waiting, " ")
+	return result
+
 class StateBase:
 
 	def __init__(self, mahjong):
@@ -98,7 +106,7 @@ class RoundPreparingState(State):
 		if name == "MOVE":
 			self.mahjong.table.remove_tile_from_wall()
 			actions = split_str(message["actions"],";")
-			state = MyMoveState(self.mahjong, message["tile"], actions)
+			state = MyMoveState(self.mahjong, message["tile"], actions, parse_riichi_discards(message))
 			self.mahjong.set_state(state)
 			return
 		if name == "OTHER_MOVE":
@@ -240,7 +248,7 @@ class RoundState(State):
 		if name == "MOVE":
 			self.mahjong.table.remove_tile_from_wall()
 			actions = split_str(message["actions"], ";")
-			state = MyMoveState(self.mahjong, message["tile"], actions)
+			state = MyMoveState(self.mahjong, message["tile"], actions, parse_riichi_discards(message))
 			self.mahjong.set_state(state)
 			return
 
@@ -317,7 +325,7 @@ class RoundState(State):
 				new_tile = None
 				actions = []
 
-			self.mahjong.set_state(MyMoveState(self.mahjong, new_tile, actions))
+			self.mahjong.set_state(MyMoveState(self.mahjong, new_tile, actions, parse_riichi_discards(message)))
 		else:
 			self.mahjong.table.remove_tiles_from_other_hand(player_id, len(tiles) - 1)
 			self.mahjong.set_state(OtherMoveState(self.mahjong, player, action == "Kan"))
@@ -364,10 +372,12 @@ class RoundState(State):
 
 class MyMoveState(RoundState):
 
-	def __init__(self, mahjong, tile, actions):
+	def __init__(self, mahjong, tile, actions, riichi_discards = None):
 		RoundState.__init__(self, mahjong)
 		self.picked_tile_name = tile
 		self.actions = actions
+		self.riichi_discards = riichi_discards or {}
+		self.riichi_declared = False
 		self.picked_tile = None
 
 	def enter_state(self):
@@ -396,13 +406,21 @@ class MyMoveState(RoundState):
 		self.picked_tile.callback = None
 		self.mahjong.table.add_to_hand(self.picked_tile)
 
+	def is_drop_allowed(self, tile):
+		""" After riichi only discards that keep hand in tenpai are allowed """
+		return not self.riichi_declared or tile.name in self.riichi_discards
+
 	def drop_picked_tile(self, tile):
+		if not self.is_drop_allowed(tile):
+			return
 		self.mahjong.table.set_hand_callback(None)		
 		self.protocol.send_message(message = "DROP", tile = tile.name)
 		tile.remove()
 		self.remove_widgets()
 
 	def drop_hand_tile(self, tile):
+		if not self.is_drop_allowed(tile):
+			return
 		table = self.mahjong.table
 		table.set_hand_callback(None)		
 		self.protocol.send_message(message = "DROP", tile = tile.name)
@@ -430,6 +448,7 @@ class MyMoveState(RoundState):
 		self.protocol.send_message(message = "TSUMO")
 
 	def action_riichi(self):
+		self.riichi_declared = True
 		self.protocol.send_message(message = "RIICHI")
 
 	def action_kan(self, tile):
@@ -452,6 +471,7 @@ class MyMoveState(RoundState):
 		self.new_picked_tile(message["new_tile"])
 		self.mahjong.arrange_hand()
 		actions = split_str(message["actions"],";")
+		self.riichi_discards = parse_riichi_discards(message)
 		self.add_buttons(actions, self.on_action_click)
 
 
@@ -0,0 +1,317 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Agari (winning hand) table of suit patterns.
+
+	Every suit of a complete hand has to be complete on its own (melds and
+	maybe a pair), so the table describes single suits. It contains every
+	pattern of one suit with at most 14 tiles (no count bigger than 4),
+	patterns are indexed by their rank in lexicographic order (see suit_index).
+	For every pattern the table records tiles that complete it (waits) and all
+	its decompositions if the pattern is complete. Honors are handled directly
+	(only pairs and pons are possible).
+
+	The table is generated by gen_agari.py into agari.dat. The file is memory
+	mapped at the first use, nothing is parsed, so all server processes share
+	its pages. Decoded decompositions of suits are memoized for the whole
+	process in _suit_decompositions.
+
+	File (little-endian uint32): magic, number of patterns, number of codes,
+	entry of every pattern, decomposition codes.
+
+	Entry of pattern:
+		bits 0-8:   waits, bit on position is set if tile on position completes the pattern
+		bits 9-11:  number of decompositions (0 if pattern is not complete)
+		bits 12-31: index of the first decomposition in codes
+
+	Decomposition of suit is encoded into one integer:
+		bits 0-3:  position of pair (0-8), NO_PAIR if there is no pair
+		bits 4-6:  number of melds
+		bits 8-23: melds, 4 bits each; 0-8 pon on position, 9-15 chi starting on position - 9
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+from tile import suit_first_ids
+
+AGARI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agari.dat")
+AGARI_MAGIC = 0x32414741 # "AGA2"
+
+NO_PAIR = 15
+
+MAX_PATTERN_TILES = 14
+WAITS_MASK = 0x1ff
+COUNT_SHIFT = 9
+COUNT_MASK = 7
+CODES_SHIFT = 12
+
+_header = struct.Struct("<III")
+_uint = struct.Struct("<I")
+
+_agari_table = None
+
+# (first id of suit, suit index) -> tuple of (pair_id or None, tuple of melds)
+_suit_decompositions = {}
+
+
+def _build_index_steps():
+	""" steps[position][tiles][count] is the number of patterns that precede pattern with 'count'
+		on position when 'tiles' can be still placed from position to the end of suit """
+	# patterns[position][tiles] is the number of patterns of positions from 'position' to the end
+	patterns = [ [ 1 ] * (MAX_PATTERN_TILES + 1) ]
+	for position in xrange(9):
+		next = patterns[0]
+		patterns.insert(0, [ sum(next[tiles - c] for c in xrange(min(4, tiles) + 1))
+			for tiles in xrange(MAX_PATTERN_TILES + 1) ])
+	steps = []
+	for position in xrange(9):
+		next = patterns[position + 1]
+		row = []
+		for tiles in xrange(MAX_PATTERN_TILES + 1):
+			counts = [ 0 ]
+			for c in xrange(min(4, tiles)):
+				counts.append(counts[-1] + next[tiles - c])
+			row.append(counts)
+		steps.append(row)
+	return steps, patterns[0][MAX_PATTERN_TILES]
+
+_index_steps, PATTERNS_COUNT = _build_index_steps()
+
+
+def suit_index(counts, first):
+	""" Returns index of suit pattern or -1 if suit is not in table (too many tiles) """
+	index = 0
+	tiles = MAX_PATTERN_TILES
+	for i in xrange(9):
+		count = counts[first + i]
+		steps = _index_steps[i][tiles]
+		if count >= len(steps):
+			return -1
+		index += steps[count]
+		tiles -= count
+	return index
+
+def encode_decomposition(pair, melds):
+	""" pair is position in suit or None, melds is list of (position, is_chi) """
+	if pair is None:
+		pair = NO_PAIR
+	code = pair | (len(melds) << 4)
+	for i, (position, is_chi) in enumerate(melds):
+		if is_chi:
+			position += 9
+		code |= position << (8 + 4 * i)
+	return code
+
+def decode_decomposition(code, first):
+	""" Returns (pair_id or None, [ (tile_id, is_chi) ]) """
+	pair = code & 15
+	if pair == NO_PAIR:
+		pair = None
+	else:
+		pair += first
+	melds = []
+	for i in xrange((code >> 4) & 7):
+		position = (code >> (8 + 4 * i)) & 15
+		if position >= 9:
+			melds.append((first + position - 9, True))
+		else:
+			melds.append((first + position, False))
+	return (pair, melds)
+
+def encode_entry(waits, codes_index, count):
+	return waits | (count << COUNT_SHIFT) | (codes_index << CODES_SHIFT)
+
+def write_table(entries, codes, filename = AGARI_FILE):
+	""" entries are indexed by suit_index """
+	data = array("I", [ AGARI_MAGIC, len(entries), len(codes) ])
+	data.extend(entries)
+	data.extend(codes)
+	if sys.byteorder != "little":
+		data.byteswap()
+	f = open(filename, "wb")
+	try:
+		data.tofile(f)
+	finally:
+		f.close()
+
+
+class AgariTable:
+
+	""" Read-only view of memory mapped agari.dat """
+
+	def __init__(self, data, name = "agari table"):
+		magic, patterns, codes = _header.unpack_from(data, 0)
+		if magic != AGARI_MAGIC or patterns != PATTERNS_COUNT or \
+				len(data) != _header.size + 4 * (patterns + codes):
+			raise Exception("Invalid agari table: " + name)
+		self.data = data
+		self.codes_offset = _header.size + 4 * patterns
+
+	def entry(self, index):
+		""" Returns entry of pattern, 0 (no waits, not complete) for index -1 """
+		if index < 0:
+			return 0
+		return _uint.unpack_from(self.data, _header.size + 4 * index)[0]
+
+	def decompositions(self, entry):
+		""" Returns tuple of decomposition codes of entry """
+		count = (entry >> COUNT_SHIFT) & COUNT_MASK
+		return struct.unpack_from("<%iI" % count, self.data, self.codes_offset + 4 * (entry >> CODES_SHIFT))
+
+
+def load_table(filename = AGARI_FILE):
+	f = open(filename, "rb")
+	try:
+		data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	finally:
+		f.close()
+	return AgariTable(data, filename)
+
+def get_agari_table():
+	global _agari_table
+	if _agari_table is None:
+		_agari_table = load_table()
+	return _agari_table
+
+def is_complete_entry(entry):
+	return entry >> COUNT_SHIFT & COUNT_MASK != 0
+
+
+def _honors_pairs(counts):
+	""" Returns number of honor pairs or -1 if honors cannot be part of complete hand """
+	pairs = 0
+	for i in xrange(7):
+		count = counts[i]
+		if count == 2:
+			pairs += 1
+		elif count != 0 and count != 3:
+			return -1
+	return pairs
+
+def is_agari(counts):
+	""" True if counts form complete hand (melds and exactly one pair) """
+	pairs = _honors_pairs(counts)
+	if pairs < 0 or pairs > 1:
+		return False
+
+	table = get_agari_table()
+	for first in suit_first_ids:
+		if not is_complete_entry(table.entry(suit_index(counts, first))):
+			return False
+		if sum(counts[first:first + 9]) % 3 == 2:
+			pairs += 1
+	return pairs == 1
+
+def suit_decompositions(counts, first):
+	""" Returns tuple of decompositions of suit (see decode_decomposition),
+		None if suit cannot be part of complete hand """
+	index = suit_index(counts, first)
+	result = _suit_decompositions.get((first, index))
+	if result is None:
+		codes = get_agari_table().decompositions(get_agari_table().entry(index))
+		if not codes:
+			return None
+		result = tuple((pair, tuple(melds)) for pair, melds in
+			(decode_decomposition(code, first) for code in codes))
+		_suit_decompositions[(first, index)] = result
+	return result
+
+def agari_decompositions(counts):
+	""" Returns list of (pair_id, [ (tile_id, is_chi) ]), ordered by pair_id.
+		Empty list is returned if hand is not complete. """
+	if not is_agari(counts):
+		return []
+
+	pair = None
+	melds = []
+	for i in xrange(7):
+		if counts[i] == 2:
+			pair = i
+		elif counts[i] == 3:
+			melds.append((i, False))
+	result = [ (pair, melds) ]
+
+	for first in suit_first_ids:
+		if not any(counts[first:first + 9]):
+			continue
+		decompositions = suit_decompositions(counts, first)
+		new_result = []
+		for pair, melds in result:
+			for suit_pair, suit_melds in decompositions:
+				if suit_pair is None:
+					suit_pair = pair
+				new_result.append((suit_pair, melds + list(suit_melds)))
+		result = new_result
+
+	result.sort(key = lambda d: d[0])
+	return result
+
+def completing_ids(counts):
+	""" Returns list of ids of tiles that make counts a complete hand (melds and one pair).
+		Waits of every suit are taken from its entry in the table. """
+	table = get_agari_table()
+	entries = []
+	# Number of suits (honors included) that are complete with pair, without pair and broken
+	with_pair = without_pair = broken = 0
+	for first in suit_first_ids:
+		entry = table.entry(suit_index(counts, first))
+		entries.append(entry)
+		if is_complete_entry(entry):
+			if sum(counts[first:first + 9]) % 3 == 2:
+				with_pair += 1
+			else:
+				without_pair += 1
+		else:
+			broken += 1
+	honor_pairs = _honors_pairs(counts)
+
+	ids = []
+	for i in xrange(7):
+		if broken or counts[i] >= 3:
+			continue
+		counts[i] += 1
+		pairs = _honors_pairs(counts)
+		counts[i] -= 1
+		if pairs >= 0 and pairs + with_pair == 1:
+			ids.append(i)
+
+	if honor_pairs < 0 or honor_pairs > 1:
+		return ids
+
+	for s, first in enumerate(suit_first_ids):
+		other_broken = broken
+		other_pairs = honor_pairs + with_pair
+		if is_complete_entry(entries[s]):
+			if sum(counts[first:first + 9]) % 3 == 2:
+				other_pairs -= 1
+		else:
+			other_broken -= 1
+		if other_broken or other_pairs > 1:
+			continue
+		# The suit has to be complete after the tile is added
+		suit_pair = (sum(counts[first:first + 9]) + 1) % 3 == 2
+		if suit_pair + other_pairs != 1:
+			continue
+		waits = entries[s] & WAITS_MASK
+		for position in xrange(9):
+			if waits >> position & 1:
+				ids.append(first + position)
+	return ids
@@ -0,0 +1,455 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Scoring of many completed hands at once (offline analysis, simulations).
+	It returns the same results as eval.compute_score, but yaku, minipoints
+	and payments are computed by NumPy over the whole batch.
+
+	Input of score_hands:
+		counts       (N, 34) tiles in hand (including winning tile)
+		open_sets    (N, 4) sets encoded by encode_set, -1 for no set
+		win_tiles    (N,) id of winning tile
+		tsumo        (N,) True for Tsumo, False for Ron
+		round_winds  (N,) tile id of round wind
+		player_winds (N,) tile id of player wind
+		doras        (N, 34) how many times is each tile dora (optional)
+		ura_doras    (N, 34) the same for ura doras (optional)
+		specials     (N,) bitmask of special yaku (Riichi, Ippatsu, Rinjankaihoo) (optional)
+
+	Result is (yaku, han, minipoints, payment):
+		yaku         (N,) bitmask of yaku (see yaku_names)
+		han          (N,) number of han, including doras (max 13)
+		minipoints   (N,)
+		payment      (N, 2) the same as in eval.compute_payment:
+		             (payment, 0) for Ron, (non-dealer, dealer) for Tsumo
+		Hands that are not complete have all values zero.
+"""
+
+import numpy
+
+from tile import TILES_COUNT, tiles_by_id, Pon, Chi, Kan
+from agari import agari_decompositions
+from eval import scoring_table, limited_hands
+
+yaku_names = [ "Yaku-Pai", "Tan-Yao", "Ipeikou", "Sanshoku doujun", "Itsu", "Chanta", "Junchan taiyai",
+	"Sanshoku douko", "Honitsu", "Chinitsu", "San-anko", "Toitoiho", "Pinfu", "Tsumo", "Chii toitsu",
+	"Dai-sangen", "Shou-suushi", "Dai-suushi", "Suu-ankou", "Suu-kantsu", "Chinroutou", "Ryuu-iisou", "Tsu-iisou",
+	"Chuuren-pootoo", "Kokushi-musou", "Riichi", "Ippatsu", "Rinjankaihoo" ]
+
+yaku_bits = dict((name, 1 << i) for i, name in enumerate(yaku_names))
+
+# Yakumans found in sets, the first one wins (as in eval.yakuman_rules)
+set_yakumans = [ "Dai-sangen", "Shou-suushi", "Dai-suushi", "Suu-ankou", "Suu-kantsu", "Chinroutou", "Ryuu-iisou", "Tsu-iisou" ]
+
+SET_CHI = 0
+SET_PON = 1
+SET_KAN = 2
+
+# Properties of tiles indexed by tile id
+_ids = numpy.arange(TILES_COUNT)
+is_honor = _ids < 7
+is_dragon = _ids < 3
+is_wind = (_ids >= 3) & (_ids < 7)
+suit_of = numpy.where(is_honor, -1, (_ids - 7) // 9)
+number_of = numpy.where(is_honor, 0, (_ids - 7) % 9 + 1)
+is_terminal = (number_of == 1) | (number_of == 9)
+is_nonterminal = ~is_honor & ~is_terminal
+is_green = numpy.array([ tile.is_green() for tile in tiles_by_id ])
+
+EAST_WIND = 3
+NO_WAIT = -100
+
+
+def encode_set(set):
+	if set.is_chi():
+		kind = SET_CHI
+	elif set.is_kan():
+		kind = SET_KAN
+	else:
+		kind = SET_PON
+	return set.get_representative_tile().id | (kind << 6) | (int(set.closed) << 8)
+
+def decode_set(code):
+	tile = tiles_by_id[code & 63]
+	kind = (code >> 6) & 3
+	closed = bool((code >> 8) & 1)
+	if kind == SET_CHI:
+		return Chi(tile, tile.next_tile(), tile.next_tile().next_tile(), closed)
+	if kind == SET_KAN:
+		return Kan(tile, closed)
+	return Pon(tile, closed)
+
+def encode_open_sets(sets):
+	codes = [ encode_set(set) for set in sets ]
+	return codes + [ -1 ] * (4 - len(codes))
+
+
+def _payment_tables():
+	""" Returns (base, limited): base[minipoints, fans] for fans < 5, limited[fans] """
+	base = numpy.zeros((111, 5), dtype = numpy.int64)
+	for minipoints, row in scoring_table.items():
+		for fans, score in enumerate(row):
+			if score is not None:
+				base[minipoints, fans + 1] = score
+	limited = numpy.zeros(14, dtype = numpy.int64)
+	for fans, (name, score) in limited_hands.items():
+		limited[fans] = score
+	return base, limited
+
+_base_payment, _limited_payment = _payment_tables()
+
+
+def _round_up(num, base):
+	return (num + base - 1) // base * base
+
+def _compute_payment(han, minipoints, tsumo, dealer):
+	fans = numpy.minimum(han, 13)
+	score = numpy.where(fans < 5,
+		_base_payment[numpy.clip(minipoints, 0, 110), numpy.clip(fans, 0, 4)],
+		_limited_payment[fans])
+	score = numpy.where(fans > 0, score, 0)
+	payment = numpy.zeros((len(han), 2), dtype = numpy.int64)
+	payment[:, 0] = numpy.where(tsumo,
+		numpy.where(dealer, _round_up(score // 2, 100), _round_up(score // 4, 100)),
+		numpy.where(dealer, _round_up(score // 2 * 3, 100), score))
+	payment[:, 1] = numpy.where(tsumo & ~dealer, _round_up(score // 2, 100), 0)
+	return payment
+
+
+def _special_hands(counts, no_sets):
+	""" Returns (seven_pairs, nine_lanterns, kokushi) masks """
+	seven_pairs = no_sets & ((counts == 0) | (counts == 2)).all(1)
+
+	total = counts.sum(1)
+	nine_lanterns = numpy.zeros(len(counts), dtype = bool)
+	for first in (7, 16, 25):
+		suit = counts[:, first:first + 9]
+		nine_lanterns |= (suit >= 1).all(1) & (suit[:, 0] >= 3) & (suit[:, 8] >= 3) & (suit.sum(1) == total)
+	nine_lanterns &= no_sets
+
+	edges = counts[:, ~is_nonterminal]
+	kokushi = no_sets & (counts[:, is_nonterminal] == 0).all(1) \
+		& ((edges == 1) | (edges == 2)).all(1) & ((edges == 2).sum(1) == 1)
+	return seven_pairs, nine_lanterns, kokushi
+
+
+def _decompose(counts, open_sets, regular):
+	""" Finds all decompositions of regular hands (the only part done per hand).
+		Every decomposition is one row, row_hand is index of hand of row,
+		m_hand marks sets found in hand (not declared). """
+	n = len(counts)
+	row_hand = []
+	pair = []
+	m_tile = []
+	m_kind = []
+	m_closed = []
+	m_hand = []
+
+	for i in xrange(n):
+		if not regular[i]:
+			continue
+		row = [ int(c) for c in counts[i] ]
+		sets = [ decode_set(int(code)) for code in open_sets[i] if code >= 0 ]
+
+		sets_tiles = [ set.get_representative_tile().id for set in sets ]
+		sets_kinds = [ SET_CHI if set.is_chi() else (SET_KAN if set.is_kan() else SET_PON) for set in sets ]
+		sets_closed = [ set.closed for set in sets ]
+		for pair_id, melds in agari_decompositions(row):
+			if len(sets) + len(melds) != 4:
+				continue
+			row_hand.append(i)
+			pair.append(pair_id)
+			m_tile.append(sets_tiles + [ tile_id for tile_id, is_chi in melds ])
+			m_kind.append(sets_kinds + [ SET_CHI if is_chi else SET_PON for tile_id, is_chi in melds ])
+			m_closed.append(sets_closed + [ True ] * len(melds))
+			m_hand.append([ False ] * len(sets) + [ True ] * len(melds))
+
+	shape = (len(row_hand), 4)
+	return (numpy.array(row_hand, dtype = numpy.int64),
+		numpy.array(pair, dtype = numpy.int64),
+		numpy.array(m_tile, dtype = numpy.int64).reshape(shape),
+		numpy.array(m_kind, dtype = numpy.int64).reshape(shape),
+		numpy.array(m_closed, dtype = bool).reshape(shape),
+		numpy.array(m_hand, dtype = bool).reshape(shape))
+
+
+def _best_rows(row_hand, key):
+	""" Returns indexes of rows with the highest key for every hand (the first one in case of tie) """
+	if len(row_hand) == 0:
+		return row_hand
+	order = numpy.lexsort((numpy.arange(len(row_hand)), -key, row_hand))
+	hands = row_hand[order]
+	first = numpy.ones(len(order), dtype = bool)
+	first[1:] = hands[1:] != hands[:-1]
+	return order[first]
+
+
+def _score_sets(pair, m_tile, m_kind, m_closed, round_winds, player_winds):
+	""" Returns list of (name, values) of yaku found in sets, values are arrays of han """
+	n = len(pair)
+	t = m_tile
+	num = number_of[t]
+	chi = m_kind == SET_CHI
+	ponkan = ~chi
+	closed = m_closed.all(1)
+	any_chi = chi.any(1)
+
+	def by_closed(closed_value, open_value):
+		return numpy.where(closed, closed_value, open_value)
+
+	any_terminal = numpy.where(chi, (num == 1) | (num == 7), is_terminal[t])
+	any_terminal_or_honor = numpy.where(chi, (num == 1) | (num == 7), is_terminal[t] | is_honor[t])
+	all_nonterminal = numpy.where(chi, (num >= 2) & (num <= 6), is_nonterminal[t])
+	all_terminal = ponkan & is_terminal[t]
+	all_honor = ponkan & is_honor[t]
+	all_green = numpy.where(chi, t == 8, is_green[t])
+
+	rows = numpy.arange(n)
+	chi_starts = numpy.zeros((n, TILES_COUNT), dtype = bool)
+	pons = numpy.zeros((n, TILES_COUNT), dtype = bool)
+	for c in xrange(4):
+		chi_starts[rows, t[:, c]] |= chi[:, c]
+		pons[rows, t[:, c]] |= ponkan[:, c]
+
+	dragon_pons = (ponkan & is_dragon[t]).sum(1)
+	wind_pons = (ponkan & is_wind[t]).sum(1)
+
+	# Ipeikou: each chi that is repeated exactly once in following sets
+	ipeikou = numpy.zeros(n, dtype = numpy.int64)
+	for i in xrange(4):
+		same = numpy.zeros(n, dtype = numpy.int64)
+		for j in xrange(i + 1, 4):
+			same += chi[:, j] & (t[:, j] == t[:, i])
+		ipeikou += chi[:, i] & (same == 1)
+	ipeikou = numpy.where(closed, ipeikou, 0)
+
+	sanshoku_doujun = (chi_starts[:, 7:14] & chi_starts[:, 16:23] & chi_starts[:, 25:32]).any(1)
+	sanshoku_douko = (pons[:, 7:16] & pons[:, 16:25] & pons[:, 25:34]).any(1)
+	itsu = numpy.zeros(n, dtype = bool)
+	for first in (7, 16, 25):
+		itsu |= chi_starts[:, first] & chi_starts[:, first + 3] & chi_starts[:, first + 6]
+
+	junchan = is_terminal[pair] & any_chi & any_terminal.all(1)
+	chanta = ~is_nonterminal[pair] & any_chi & any_terminal_or_honor.all(1) & ~junchan
+
+	pair_suit = suit_of[pair]
+	chinitsu = (pair_suit >= 0) & (suit_of[t] == pair_suit[:, None]).all(1)
+	suits_used = numpy.zeros(n, dtype = numpy.int64)
+	for suit in xrange(3):
+		suits_used += (pair_suit == suit) | (suit_of[t] == suit).any(1)
+	honitsu = ~chinitsu & (suits_used <= 1)
+
+	closed_pons = (ponkan & m_closed).sum(1)
+
+	yaku_pai = dragon_pons + (ponkan & (t == round_winds[:, None])).sum(1) + (ponkan & (t == player_winds[:, None])).sum(1)
+
+	pair_is_value = is_dragon[pair] | (pair == round_winds) | (pair == player_winds)
+	pinfu = chi.all(1) & closed & ~pair_is_value
+
+	yakumans = [
+		("Dai-sangen", dragon_pons == 3),
+		("Shou-suushi", is_wind[pair] & (wind_pons == 3)),
+		("Dai-suushi", wind_pons == 4),
+		("Suu-ankou", (ponkan & m_closed).all(1)),
+		("Suu-kantsu", (m_kind == SET_KAN).all(1)),
+		("Chinroutou", is_terminal[pair] & all_terminal.all(1)),
+		("Ryuu-iisou", is_green[pair] & all_green.all(1)),
+		("Tsu-iisou", is_honor[pair] & all_honor.all(1)),
+	]
+
+	yaku = [
+		("Yaku-Pai", yaku_pai),
+		("Tan-Yao", (is_nonterminal[pair] & all_nonterminal.all(1)) * 1),
+		("Ipeikou", ipeikou),
+		("Sanshoku doujun", sanshoku_doujun * by_closed(2, 1)),
+		("Itsu", itsu * by_closed(2, 1)),
+		("Chanta", chanta * by_closed(2, 1)),
+		("Junchan taiyai", junchan * by_closed(3, 2)),
+		("Sanshoku douko", sanshoku_douko * 2),
+		("Honitsu", honitsu * by_closed(3, 2)),
+		("Chinitsu", chinitsu * by_closed(6, 5)),
+		("San-anko", (closed_pons >= 3) * 2),
+		("Toitoiho", ponkan.all(1) * 2),
+	]
+	return yaku, yakumans, pinfu, closed
+
+
+def _seven_pairs_yaku(counts):
+	total = counts.sum(1)
+	honors = counts[:, is_honor].sum(1)
+	tsu_iisou = honors == total
+	tan_yao = counts[:, is_nonterminal].sum(1) == total
+	one_suit = numpy.zeros(len(counts), dtype = bool)
+	for first in (7, 16, 25):
+		one_suit |= counts[:, first:first + 9].sum(1) + honors == total
+	chinitsu = one_suit & (honors == 0)
+	honitsu = one_suit & (honors > 0)
+	return tsu_iisou, tan_yao, chinitsu, honitsu
+
+
+def _minipoints(pair, m_tile, m_kind, m_closed, m_hand, win_tiles, tsumo, round_winds, player_winds):
+	""" Returns (minipoints, single_wait) of every decomposition (as eval.decomposition_minipoints),
+		single_wait is True if winning tile can be taken as tanki, kanchan, penchan or shanpon """
+	t = m_tile
+	chi = m_kind == SET_CHI
+	closed = m_closed.all(1)
+
+	points = numpy.where(closed & ~tsumo, 30, 20)
+	factor = numpy.where(is_nonterminal[t], 1, 2)
+	set_points = numpy.where(chi, 0, 2 * factor * numpy.where(m_closed, 2, 1) * numpy.where(m_kind == SET_KAN, 4, 1))
+	points += set_points.sum(1)
+
+	for tile_ids in ( 0, 2, 1, round_winds, player_winds ):
+		points += (pair == tile_ids) * 2
+	points += tsumo * 2
+
+	# The best wait of the winning tile, NO_WAIT for not found
+	w = win_tiles[:, None]
+	num = number_of[w]
+	hand_chi = m_hand & chi
+	tanki = pair == win_tiles
+	kanchan = (hand_chi & (t + 1 == w)).any(1)
+	penchan = (hand_chi & (((t == w) & (num == 7)) | ((t + 2 == w) & (num == 3)))).any(1)
+	ryanmen = (hand_chi & (((t == w) & (num != 7)) | ((t + 2 == w) & (num != 3)))).any(1)
+	shanpon_pon = m_hand & ~chi & (t == w)
+	shanpon = shanpon_pon.any(1)
+
+	# Pon completed by Ron is counted as open
+	shanpon_points = numpy.where(tsumo, 0, -(set_points * shanpon_pon).sum(1) // 2)
+	wait = numpy.where(tanki | kanchan | penchan, 2, NO_WAIT)
+	wait = numpy.maximum(wait, numpy.where(ryanmen, 0, NO_WAIT))
+	wait = numpy.maximum(wait, numpy.where(shanpon, shanpon_points, NO_WAIT))
+	points += numpy.where(wait == NO_WAIT, 0, wait)
+
+	single_wait = tanki | kanchan | penchan | shanpon
+	return numpy.where(points == 20, 30, _round_up(points, 10)), single_wait
+
+
+def _open_sets_counts(open_sets):
+	""" Returns (N, 34) counts of tiles in open sets """
+	n = len(open_sets)
+	result = numpy.zeros((n, TILES_COUNT), dtype = numpy.int64)
+	rows = numpy.arange(n)
+	for c in xrange(open_sets.shape[1]):
+		code = open_sets[:, c]
+		valid = code >= 0
+		tile = numpy.where(valid, code & 63, 0)
+		kind = (numpy.where(valid, code, 0) >> 6) & 3
+		is_chi = valid & (kind == SET_CHI)
+		result[rows, tile] += valid * numpy.where(kind == SET_KAN, 4, numpy.where(is_chi, 1, 3))
+		result[rows, numpy.where(is_chi, tile + 1, 0)] += is_chi
+		result[rows, numpy.where(is_chi, tile + 2, 0)] += is_chi
+	return result
+
+
+def score_hands(counts, open_sets, win_tiles, tsumo, round_winds, player_winds,
+		doras = None, ura_doras = None, specials = None):
+	counts = numpy.asarray(counts, dtype = numpy.int64)
+	open_sets = numpy.asarray(open_sets, dtype = numpy.int64).reshape(len(counts), -1)
+	win_tiles = numpy.asarray(win_tiles, dtype = numpy.int64)
+	tsumo = numpy.asarray(tsumo, dtype = bool)
+	round_winds = numpy.asarray(round_winds, dtype = numpy.int64)
+	player_winds = numpy.asarray(player_winds, dtype = numpy.int64)
+	n = len(counts)
+	if specials is None:
+		specials = numpy.zeros(n, dtype = numpy.int64)
+	specials = numpy.asarray(specials, dtype = numpy.int64)
+
+	no_sets = (open_sets < 0).all(1)
+	seven_pairs, nine_lanterns, kokushi = _special_hands(counts, no_sets)
+	regular = ~seven_pairs & ~nine_lanterns & ~kokushi
+
+	row_hand, pair, m_tile, m_kind, m_closed, m_hand = _decompose(counts, open_sets, regular)
+	sets_yaku, yakumans, pinfu, closed = _score_sets(pair, m_tile, m_kind, m_closed,
+		round_winds[row_hand], player_winds[row_hand])
+	row_tsumo = tsumo[row_hand]
+	row_minipoints, single_wait = _minipoints(pair, m_tile, m_kind, m_closed, m_hand, win_tiles[row_hand],
+		row_tsumo, round_winds[row_hand], player_winds[row_hand])
+	pinfu &= ~single_wait
+	rows_count = len(row_hand)
+
+	# Yaku of every decomposition
+	row_yaku = numpy.zeros(rows_count, dtype = numpy.int64)
+	row_han = numpy.zeros(rows_count, dtype = numpy.int64)
+
+	def add_row(name, mask, value):
+		row_yaku[mask] |= yaku_bits[name]
+		row_han[mask] += numpy.broadcast_to(value, (rows_count,))[mask]
+
+	found_yakuman = numpy.zeros(rows_count, dtype = bool)
+	for name, mask in yakumans:
+		mask = mask & ~found_yakuman
+		add_row(name, mask, 13)
+		found_yakuman |= mask
+
+	normal = ~found_yakuman
+	for name, values in sets_yaku:
+		add_row(name, normal & (values > 0), values)
+	row_pinfu = normal & pinfu
+	add_row("Pinfu", row_pinfu, 1)
+	add_row("Tsumo", normal & row_tsumo & closed, 1)
+
+	# The best decomposition of every hand (as eval.find_best_decomposition)
+	row_minipoints = numpy.where(row_pinfu, numpy.where(row_tsumo, 20, 30), row_minipoints)
+	key = numpy.where(found_yakuman, 1 << 30, row_han * 1000 + row_minipoints)
+	best = _best_rows(row_hand, key)
+	hands = row_hand[best]
+
+	complete = numpy.zeros(n, dtype = bool)
+	complete[hands] = True
+	minipoints = numpy.zeros(n, dtype = numpy.int64)
+	minipoints[hands] = row_minipoints[best]
+
+	yaku = numpy.zeros(n, dtype = numpy.int64)
+	han = numpy.zeros(n, dtype = numpy.int64)
+	yaku[hands] = row_yaku[best]
+	han[hands] = row_han[best]
+
+	def add(name, mask, value):
+		mask = numpy.asarray(mask, dtype = bool)
+		yaku[mask] |= yaku_bits[name]
+		han[mask] += numpy.broadcast_to(value, (n,))[mask]
+
+	# Special hands
+	tsu_iisou, tan_yao, chinitsu, honitsu = _seven_pairs_yaku(counts)
+	add("Tsu-iisou", seven_pairs & tsu_iisou, 13)
+	chii_toitsu = seven_pairs & ~tsu_iisou
+	add("Chii toitsu", chii_toitsu, 2)
+	add("Tan-Yao", chii_toitsu & tan_yao, 1)
+	add("Chinitsu", chii_toitsu & chinitsu, 6)
+	add("Honitsu", chii_toitsu & honitsu, 3)
+	add("Chuuren-pootoo", nine_lanterns, 13)
+	add("Kokushi-musou", kokushi, 13)
+
+	# Specials are not added to nine lanterns and kokushi
+	with_specials = complete | seven_pairs
+	for name in ("Riichi", "Ippatsu", "Rinjankaihoo"):
+		add(name, with_specials & ((specials & yaku_bits[name]) != 0), 1)
+
+	winning = complete | seven_pairs | nine_lanterns | kokushi
+	all_counts = counts + _open_sets_counts(open_sets)
+	for dora_counts in (doras, ura_doras):
+		if dora_counts is not None:
+			dora_han = (all_counts * numpy.asarray(dora_counts, dtype = numpy.int64)).sum(1)
+			han += numpy.where(winning, dora_han, 0)
+	han = numpy.minimum(han, 13)
+
+	minipoints = numpy.where(seven_pairs, 25, minipoints)
+	minipoints = numpy.where(nine_lanterns | kokushi, 30, minipoints)
+
+	payment = _compute_payment(han, minipoints, tsumo, player_winds == EAST_WIND)
+	return yaku, han, minipoints, payment
@@ -0,0 +1,278 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Benchmark of the scoring engine (eval.py) on a corpus of seeded random hands.
+	Prints per-call latency percentiles and calls per second as JSON.
+	Usage: python bench.py [--seed N] [--size N] [--repeat N] [--cold] [--output file]
+"""
+
+import sys
+import json
+from optparse import OptionParser
+from random import Random
+from timeit import default_timer
+
+import eval
+import agari
+from eval import compute_score, find_waiting_tiles, riichi_test, hand_shanten
+from tile import Chi, Pon, all_tiles, tiles_by_id, east_wind, south_wind, terminal_ids, honor_ids, suit_first_ids
+from player import Player
+
+DEFAULT_SEED = 2009
+DEFAULT_SIZE = 50
+DEFAULT_REPEAT = 5
+
+# Kinds of hands in the corpus, each entry has 14 tiles in hand (the last one is
+# the drawn or winning tile), so hand[:-1] is the 13 tiles hand before the draw
+corpus_kinds = [ "complete", "open", "tenpai", "one_shanten", "seven_pairs", "kokushi", "nine_lanterns" ]
+complete_kinds = [ "complete", "open", "seven_pairs", "kokushi", "nine_lanterns" ]
+
+
+class BenchRound:
+
+	""" Minimal round for Player.hand_actions and Player.steal_actions """
+
+	round_wind = east_wind
+	move_id = 0
+
+	def get_remaining_tiles_in_wall(self):
+		return 70
+
+
+def random_melds(random):
+	""" Returns (pair, melds) with no tile used more than four times """
+	while True:
+		counts = [ 0 ] * 34
+		melds = []
+		for i in xrange(4):
+			tile = random.choice(all_tiles)
+			if tile.is_suit() and tile.get_number() <= 7 and random.random() < 0.5:
+				meld = Chi(tile, tile.next_tile(), tile.next_tile().next_tile())
+			else:
+				meld = Pon(tile)
+			melds.append(meld)
+			for t in meld.tiles():
+				counts[t.id] += 1
+		pair = random.choice(all_tiles)
+		counts[pair.id] += 2
+		if max(counts) <= 4:
+			return pair, melds
+
+def random_complete_hand(random, open_sets):
+	pair, melds = random_melds(random)
+	sets = [ meld.with_closed(False) for meld in melds[:open_sets] ]
+	hand = [ pair, pair ]
+	for meld in melds[open_sets:]:
+		hand += meld.tiles()
+	random.shuffle(hand)
+	return hand, sets
+
+def draw_tile(random, hand, sets):
+	""" Returns a random tile that is not already four times in hand and sets """
+	while True:
+		tile = random.choice(all_tiles)
+		if hand.count(tile) + sum(set.count_of_tile(tile) for set in sets) < 4:
+			return tile
+
+def random_hand(random, kind):
+	""" Returns (hand, sets) of the given corpus kind """
+	if kind == "complete":
+		return random_complete_hand(random, 0)
+
+	if kind == "open":
+		return random_complete_hand(random, random.randint(1, 3))
+
+	if kind == "tenpai" or kind == "one_shanten":
+		hand, sets = random_complete_hand(random, random.randint(0, 2))
+		hand.pop(random.randrange(len(hand)))
+		if kind == "one_shanten":
+			while True:
+				h = hand[:]
+				h[random.randrange(len(h))] = draw_tile(random, h, sets)
+				if hand_shanten(h, sets) == 1:
+					hand = h
+					break
+		hand.append(draw_tile(random, hand, sets))
+		return hand, sets
+
+	if kind == "seven_pairs":
+		hand = 2 * random.sample(all_tiles, 7)
+		random.shuffle(hand)
+		return hand, []
+
+	if kind == "kokushi":
+		hand = [ tiles_by_id[i] for i in honor_ids + terminal_ids ]
+		hand.append(random.choice(hand))
+		random.shuffle(hand)
+		return hand, []
+
+	if kind == "nine_lanterns":
+		first = random.choice(suit_first_ids)
+		hand = [ tiles_by_id[first + i] for i in [ 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 8, 8 ] ]
+		random.shuffle(hand)
+		hand.append(tiles_by_id[first + random.randrange(9)])
+		return hand, []
+
+	raise Exception("Unknown kind of hand: " + kind)
+
+def generate_corpus(seed = DEFAULT_SEED, size = DEFAULT_SIZE):
+	""" Returns list of (kind, hand, sets), 'size' hands of every kind """
+	random = Random(seed)
+	corpus = []
+	for kind in corpus_kinds:
+		for i in xrange(size):
+			hand, sets = random_hand(random, kind)
+			corpus.append((kind, hand, sets))
+	return corpus
+
+
+def create_player(hand, sets):
+	player = Player(None, "Bench")
+	left = Player(None, "Left")
+	player.set_neighbours(left, Player(None, "Right"), Player(None, "Across"))
+	player.set_wind(south_wind)
+	player.sets = sets
+	player.set_round(BenchRound(), hand[:13 - 3 * len(sets)])
+	for tile in hand[13 - 3 * len(sets):]:
+		player.new_hand_tile(tile)
+	return player
+
+def bench_compute_score(kind, hand, sets):
+	if kind not in complete_kinds:
+		return None
+	if sets:
+		# Open hands may have no yaku, they are scored as Ron with dora
+		wintype, specials = "Ron", []
+		doras = ([ hand[0] ], [])
+	else:
+		wintype, specials = "Tsumo", [ ("Riichi", 1) ]
+		doras = ([ hand[0] ], [ hand[1] ])
+	return lambda: compute_score(hand, sets, wintype, doras, specials, east_wind, south_wind)
+
+def bench_find_waiting_tiles(kind, hand, sets):
+	h = hand[:-1]
+	return lambda: find_waiting_tiles(h, sets)
+
+def bench_riichi_test(kind, hand, sets):
+	return lambda: riichi_test(hand, sets)
+
+def bench_hand_actions(kind, hand, sets):
+	# Player.hand_actions only returns the result cached for the current hand,
+	# the actions are computed once after every draw
+	player = create_player(hand, sets)
+	return player.compute_hand_actions
+
+def bench_steal_actions(kind, hand, sets):
+	# The claim index is built once after every change of the hand
+	player = create_player(hand[:-1], sets)
+	tracker = player.waiting_tracker
+	tile = hand[-1]
+	def call():
+		tracker.claims = None
+		return player.steal_actions(player.left_player, tile)
+	return call
+
+benchmarks = [
+	("compute_score", bench_compute_score),
+	("find_waiting_tiles", bench_find_waiting_tiles),
+	("riichi_test", bench_riichi_test),
+	("hand_actions", bench_hand_actions),
+	("steal_actions", bench_steal_actions),
+]
+
+
+def percentile(samples, q):
+	""" Returns q-th percentile of sorted samples """
+	return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def summarize(samples):
+	samples = sorted(samples)
+	total = sum(samples)
+	us = 1000000.0
+	return {
+		"calls" : len(samples),
+		"calls_per_second" : len(samples) / total if total > 0 else None,
+		"mean_us" : total * us / len(samples),
+		"p50_us" : percentile(samples, 0.50) * us,
+		"p90_us" : percentile(samples, 0.90) * us,
+		"p99_us" : percentile(samples, 0.99) * us,
+		"max_us" : samples[-1] * us,
+	}
+
+def clear_caches():
+	""" Clears all memo tables of eval.py and agari.py """
+	eval.waiting_cache.clear()
+	eval._suit_blocks.clear()
+	agari._suit_decompositions.clear()
+
+def run_benchmark(corpus, repeat = DEFAULT_REPEAT, cold = False):
+	""" Times every benchmark on the corpus. With 'cold' all memo tables
+		are cleared before every timed call. Returns dictionary name -> statistics """
+	results = {}
+	for name, make_call in benchmarks:
+		samples = []
+		kind_samples = {}
+		for kind, hand, sets in corpus:
+			call = make_call(kind, hand, sets)
+			if call is None:
+				continue
+			call() # Warm up lazily loaded tables
+			for i in xrange(repeat):
+				if cold:
+					clear_caches()
+				start = default_timer()
+				call()
+				t = default_timer() - start
+				samples.append(t)
+				kind_samples.setdefault(kind, []).append(t)
+		stats = summarize(samples)
+		stats["kinds"] = dict((kind, summarize(s)) for kind, s in kind_samples.items())
+		results[name] = stats
+	return results
+
+
+def main():
+	parser = OptionParser(usage = "python bench.py [options]")
+	parser.add_option("--seed", type = "int", default = DEFAULT_SEED, help = "seed of the hand corpus")
+	parser.add_option("--size", type = "int", default = DEFAULT_SIZE, help = "hands of every kind")
+	parser.add_option("--repeat", type = "int", default = DEFAULT_REPEAT, help = "calls per hand")
+	parser.add_option("--cold", action = "store_true", default = False, help = "clear all memo tables before every call")
+	parser.add_option("--output", help = "write JSON into file instead of stdout")
+	options, args = parser.parse_args()
+
+	corpus = generate_corpus(options.seed, options.size)
+	report = {
+		"seed" : options.seed,
+		"size" : options.size,
+		"repeat" : options.repeat,
+		"cold" : options.cold,
+		"python" : sys.version.split()[0],
+		"results" : run_benchmark(corpus, options.repeat, options.cold),
+	}
+
+	if options.output:
+		f = open(options.output, "w")
+		try:
+			json.dump(report, f, indent = 2, sort_keys = True)
+		finally:
+			f.close()
+	else:
+		print json.dumps(report, indent = 2, sort_keys = True)
+
+
+if __name__ == "__main__":
+	main()
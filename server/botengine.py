@@ -15,9 +15,10 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import os
+import select
 from subprocess import PIPE, Popen
-from threading import Thread, Lock
-from Queue import Queue
+from collections import deque
 from tile import Tile, Pon, Chi
 
 BOT_PATH = "../bot/bot"
@@ -26,37 +27,44 @@ BOT_PATH = "../bot/bot"
 class BotEngineException(Exception):
 	pass
 
-class BotEngineThread(Thread):
-
-	def __init__(self, queue, process_out):
-		Thread.__init__(self)
-		self.daemon = True
-		self.queue = queue
-		self.process_out = process_out
-		self.thread_quit = False
-
-	def run(self):
-		while not self.thread_quit:
-			line = self.process_out.readline()
-			self.queue.put(line, True)
-
 class BotEngine():
 
+	""" Output of the bot is read from the pipe when it is ready (see read_available),
+		so the pipe can be watched by the server reactor """
+
 	def __init__(self):
-		self.queue = Queue(3)
-		self.process = Popen([ BOT_PATH ], bufsize = 0, stdin = PIPE, stdout = PIPE)
+		self.lines = deque()
+		self.partial_line = ""
+		# Bot must not inherit sockets of players, closed connection would stay open
+		self.process = Popen([ BOT_PATH ], bufsize = 0, stdin = PIPE, stdout = PIPE, close_fds = True)
 		self.nonblocking = True
+		self.batch = None
 		self.process_out = self.process.stdout
 		self.process_in = self.process.stdin
-		self.thread = BotEngineThread(self.queue, self.process_out)
-		self.thread.start()
 
 	def shutdown(self):
-		self.thread.thread_quit = True
 		self.process.terminate()
 		#self._write("QUIT\n")
 		#self.join()
 
+	def fileno(self):
+		""" Output pipe of the bot """
+		return self.process_out.fileno()
+
+	def read_available(self):
+		""" Reads what the bot has written, it blocks if nothing is ready.
+			Returns False if the bot closed its output """
+		data = os.read(self.fileno(), 4096)
+		if not data:
+			return False
+		lines = (self.partial_line + data).split("\n")
+		self.partial_line = lines.pop()
+		self.lines.extend(line + "\n" for line in lines)
+		return True
+
+	def has_line(self):
+		return len(self.lines) > 0
+
 	def get_tile(self, blocking = False):
 		if self._is_next_line() or blocking:
 			return Tile(self._read_line().strip())
@@ -98,6 +106,15 @@ class BotEngine():
 
 	def set_blocking(self):
 		self.nonblocking = False
+
+	def begin_batch(self):
+		""" Commands are collected until end_batch() and sent in one write """
+		self.batch = []
+
+	def end_batch(self):
+		data = "".join(self.batch)
+		self.batch = None
+		self._write(data)
 	
 	def set_hand(self, tiles):
 		self._write("HAND\n")	
@@ -150,7 +167,10 @@ class BotEngine():
 		self._write_sets(sets)
 
 	def _write(self, string):
-		self.process_in.write(string)
+		if self.batch is not None:
+			self.batch.append(string)
+		else:
+			self.process_in.write(string)
 
 	def _set_tiles(self, tiles):
 		message = " ".join((tile.name for tile in tiles))
@@ -162,10 +182,17 @@ class BotEngine():
 		self._write("\n")
 
 	def _read_line(self):
-		line = self.queue.get()
+		while not self.lines:
+			if not self.read_available():
+				raise BotEngineException("Bot closed its output")
+		line = self.lines.popleft()
 		if line[:5] == "Error":
 			raise BotEngineException(line)
 		return line
 
 	def _is_next_line(self):
-		return not self.queue.empty() or not self.nonblocking
+		if not self.nonblocking:
+			return True
+		if not self.lines and select.select([ self.fileno() ], [], [], 0)[0]:
+			self.read_available()
+		return len(self.lines) > 0
@@ -0,0 +1,207 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Differential fuzzer of the bot scorer (YAKU command of bot/bot) against eval.py.
+	Random complete hands are sent to the bot in batches, divergent hands are
+	minimized and written as JSON lines.
+	Usage: python botfuzz.py [--seed N] [--cases N] [--batch N] [--output file]
+"""
+
+import sys
+import json
+from optparse import OptionParser
+from random import Random
+from timeit import default_timer
+
+from tile import Pon, Kan, winds, east_wind, south_wind
+from eval import find_tiles_yaku
+from botengine import BotEngine
+from bench import random_melds
+
+DEFAULT_SEED = 2009
+DEFAULT_CASES = 10000
+DEFAULT_BATCH = 500
+
+# Cases sent to the bot before its answers are read. Questions of more cases
+# could fill the pipe to the bot while the bot waits on the full pipe of answers.
+PIPELINE_LIMIT = 200
+
+# Yaku that the bot does not evaluate at all, they are not counted on the server side
+bot_unsupported_yaku = [ "Pinfu" ]
+
+
+class Case:
+
+	""" Complete hand (the last tile is the winning tile) with sets and winds """
+
+	def __init__(self, hand, sets, round_wind, player_wind):
+		self.hand = hand
+		self.sets = sets
+		self.round_wind = round_wind
+		self.player_wind = player_wind
+
+	def server_yaku(self):
+		yaku = find_tiles_yaku(self.hand, self.sets, [], self.round_wind, self.player_wind, "Ron")
+		return [ y for y in yaku if y[0] not in bot_unsupported_yaku ]
+
+	def server_han(self):
+		return sum(han for name, han in self.server_yaku())
+
+	def send_to_bot(self, engine):
+		engine.set_hand(self.hand)
+		engine.set_sets(self.sets)
+		engine.set_round_wind(self.round_wind)
+		engine.set_player_wind(self.player_wind)
+		engine.question_yaku()
+
+	def with_hand(self, sets, extra_tiles):
+		""" Returns case with 'sets' and 'extra_tiles' added before the winning tile """
+		return Case(self.hand[:-1] + list(extra_tiles) + self.hand[-1:], sets, self.round_wind, self.player_wind)
+
+	def simpler_cases(self):
+		""" Cases with less open sets, less kans or with plain winds """
+		for i, set in enumerate(self.sets):
+			rest = self.sets[:i] + self.sets[i + 1:]
+			if set.is_kan():
+				if not set.closed:
+					yield Case(self.hand, rest + [ Pon(set.tile, False) ], self.round_wind, self.player_wind)
+				yield self.with_hand(rest, set.tiles()[:3])
+			elif not set.closed:
+				yield self.with_hand(rest, set.tiles())
+		if self.round_wind is not east_wind or self.player_wind is not south_wind:
+			yield Case(self.hand, self.sets, east_wind, south_wind)
+
+	def to_dict(self):
+		return {
+			"hand" : " ".join(tile.name for tile in self.hand),
+			"sets" : [ "%s %s%s" % (set.get_name(), set.get_representative_tile().name,
+				"" if set.closed else " open") for set in self.sets ],
+			"round_wind" : self.round_wind.name,
+			"player_wind" : self.player_wind.name,
+		}
+
+
+def random_case(random):
+	pair, melds = random_melds(random)
+	counts = [ 0 ] * 34
+	for meld in melds:
+		for tile in meld.tiles():
+			counts[tile.id] += 1
+	counts[pair.id] += 2
+
+	hand = [ pair, pair ]
+	sets = []
+	for meld in melds:
+		if meld.is_pon() and counts[meld.tile.id] == 3 and random.random() < 0.15:
+			counts[meld.tile.id] += 1
+			sets.append(Kan(meld.tile, random.random() < 0.5))
+		elif random.random() < 0.3:
+			sets.append(meld.with_closed(False))
+		else:
+			hand += meld.tiles()
+	random.shuffle(hand)
+	return Case(hand, sets, random.choice(winds), random.choice(winds))
+
+
+class BotFuzzer:
+
+	def __init__(self, engine):
+		self.engine = engine
+
+	def bot_hans(self, cases):
+		""" Returns han counted by the bot for every case, cases are sent
+			in writes of at most PIPELINE_LIMIT cases """
+		hans = []
+		for i in xrange(0, len(cases), PIPELINE_LIMIT):
+			chunk = cases[i:i + PIPELINE_LIMIT]
+			self.engine.begin_batch()
+			for case in chunk:
+				case.send_to_bot(self.engine)
+			self.engine.end_batch()
+			hans += [ self.engine.get_int(True) for case in chunk ]
+		return hans
+
+	def is_divergent(self, case):
+		return self.bot_hans([ case ])[0] != case.server_han()
+
+	def minimize(self, case):
+		""" Greedily simplifies case while it stays divergent """
+		changed = True
+		while changed:
+			changed = False
+			for simpler in case.simpler_cases():
+				if self.is_divergent(simpler):
+					case = simpler
+					changed = True
+					break
+		return case
+
+	def check(self, cases):
+		""" Returns list of minimized (case, bot_han, server_han) of divergent cases """
+		divergent = []
+		for case, bot_han in zip(cases, self.bot_hans(cases)):
+			if bot_han != case.server_han():
+				case = self.minimize(case)
+				divergent.append((case, self.bot_hans([ case ])[0], case.server_han()))
+		return divergent
+
+	def run(self, random, count, batch_size = DEFAULT_BATCH):
+		""" Checks 'count' random cases, returns list of minimized (case, bot_han, server_han) """
+		divergent = []
+		while count > 0:
+			cases = [ random_case(random) for i in xrange(min(count, batch_size)) ]
+			count -= len(cases)
+			divergent += self.check(cases)
+		return divergent
+
+
+def main():
+	parser = OptionParser(usage = "python botfuzz.py [options]")
+	parser.add_option("--seed", type = "int", default = DEFAULT_SEED, help = "seed of random hands")
+	parser.add_option("--cases", type = "int", default = DEFAULT_CASES, help = "number of hands to check")
+	parser.add_option("--batch", type = "int", default = DEFAULT_BATCH, help = "hands sent to the bot at once")
+	parser.add_option("--output", help = "write divergent hands into file instead of stdout")
+	options, args = parser.parse_args()
+
+	engine = BotEngine()
+	try:
+		engine.set_blocking()
+		start = default_timer()
+		divergent = BotFuzzer(engine).run(Random(options.seed), options.cases, options.batch)
+		duration = default_timer() - start
+	finally:
+		engine.shutdown()
+
+	if options.output:
+		out = open(options.output, "w")
+	else:
+		out = sys.stdout
+	for case, bot_han, server_han in divergent:
+		d = case.to_dict()
+		d["bot_han"] = bot_han
+		d["server_han"] = server_han
+		d["server_yaku"] = case.server_yaku()
+		out.write(json.dumps(d, sort_keys = True) + "\n")
+	if options.output:
+		out.close()
+
+	sys.stderr.write("Checked %i hands, %i divergent (%.0f hands/s)\n" %
+		(options.cases, len(divergent), options.cases / duration))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,56 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+
+class LRUCache:
+
+	""" Dictionary with limited size, least recently used items are removed first """
+
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.items = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.items)
+
+	def get(self, key, default = None):
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			self.misses += 1
+			return default
+		self.items[key] = value
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		if key in self.items:
+			del self.items[key]
+		elif len(self.items) >= self.max_size:
+			self.items.popitem(last = False)
+		self.items[key] = value
+
+	def clear(self):
+		self.items.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def get_stats(self):
+		return { "size" : len(self.items), "max_size" : self.max_size, "hits" : self.hits, "misses" : self.misses }
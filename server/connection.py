@@ -17,16 +17,92 @@
 
 import socket
 import select
-import string
+import errno
+import logging
+from collections import deque
+from reactor import Future
+
+# Maximal length of line (without '\n'), longer line closes the connection
+MAX_LINE_LENGTH = 16384
+
+# Maximal size of unsent data of non-blocking connection, slower peer is disconnected
+HIGH_WATER_MARK = 256 * 1024
+
+# Errors of non-blocking socket that only mean "try it later"
+would_block_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
 
 class ConnectionClosed(Exception):
 	pass
 
+class LineTooLong(ConnectionClosed):
+	pass
+
+
+class LineBuffer:
+
+	""" Lines received from socket. Data are received by large recv_into calls
+		into one reusable bytearray, lines are cut out of it without copying the rest. """
+
+	def __init__(self, sock, max_line_length = MAX_LINE_LENGTH):
+		self.socket = sock
+		self.data = bytearray(max_line_length + 1)
+		self.view = memoryview(self.data)
+		self.start = 0
+		self.end = 0
+
+	def next_line(self):
+		""" Returns the next received line without '\n' or None if it is not complete """
+		pos = self.data.find("\n", self.start, self.end)
+		if pos < 0:
+			if self.end - self.start == len(self.data):
+				raise LineTooLong()
+			return None
+		line = self.view[self.start:pos].tobytes()
+		if pos + 1 == self.end:
+			self.start = self.end = 0
+		else:
+			self.start = pos + 1
+		return line
+
+	def receive(self):
+		""" Receives what is ready (one recv_into), it blocks if nothing is ready.
+			Raises ConnectionClosed at the end of stream. """
+		if self.end == len(self.data):
+			# Move the unfinished line to the beginning
+			size = self.end - self.start
+			self.data[:size] = self.view[self.start:self.end]
+			self.start = 0
+			self.end = size
+		try:
+			count = self.socket.recv_into(self.view[self.end:])
+		except socket.error, e:
+			if e.args[0] in would_block_errors:
+				return
+			raise ConnectionClosed()
+		if count == 0:
+			raise ConnectionClosed()
+		self.end += count
+
 class Connection:
-	def __init__(self, sock = None):
+	def __init__(self, sock = None, max_line_length = MAX_LINE_LENGTH):
 		if sock == None:
 			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket = sock
+		self.lines = LineBuffer(sock, max_line_length)
+		self.reactor = None
+		self.outbound = deque()
+		self.queued_bytes = 0 # Size of data in self.outbound
+		self.max_queued_bytes = 0
+		self.sent_bytes = 0
+		self.aborted = False
+
+	def set_nonblocking(self, reactor, high_water_mark = HIGH_WATER_MARK):
+		""" send() stops blocking, data that cannot be sent immediately are queued
+			and sent when the reactor reports the socket writable. When more than
+			'high_water_mark' bytes are queued, the connection is aborted. """
+		self.socket.setblocking(0)
+		self.reactor = reactor
+		self.high_water_mark = high_water_mark
 	
 	def bind_and_listen(self, port, reuse_addr = False):
 		if reuse_addr:
@@ -47,31 +123,146 @@ class Connection:
 			return None
 
 	def close(self):
+		if self.outbound:
+			self.reactor.remove_writer(self)
+			self.outbound.clear()
+			self.queued_bytes = 0
 		self.socket.close()
 
+	def fileno(self):
+		return self.socket.fileno()
+
 	def read_line(self):
-		# TODO: Handle long lines
-		try:
-			if self.is_read_ready():
-				buf = []
-				while True:
-					char = self.socket.recv(1)
-					if char == '\n':
-						return string.join(buf,'')
-					if char == '':
-						raise ConnectionClosed()
-					buf.append(char)
-		except socket.error,e:
-			raise ConnectionClosed()
+		""" Returns the next line or None if the whole line is not received yet """
+		line = self.lines.next_line()
+		if line is None and self.is_read_ready():
+			self.lines.receive()
+			line = self.lines.next_line()
+		return line
 
 	def send(self, string):
+		""" Blocking connection sends whole string or raises ConnectionClosed.
+			Non-blocking connection never raises, a broken connection is aborted
+			and its reader gets the end of stream. """
+		if self.reactor is None:
+			try:
+				self.socket.sendall(string)
+			except socket.error,e:
+				raise ConnectionClosed()
+			return
+
+		if self.aborted:
+			return
+		if not self.outbound:
+			count = self._send_some(string)
+			if count is None or count == len(string):
+				return
+			string = string[count:]
+			self.reactor.add_writer(self, self.flush)
+		self.outbound.append(string)
+		self.queued_bytes += len(string)
+		self.max_queued_bytes = max(self.max_queued_bytes, self.queued_bytes)
+		if self.queued_bytes > self.high_water_mark:
+			logging.warning("Peer does not read, %i bytes queued" % self.queued_bytes)
+			self.abort()
+
+	def flush(self):
+		""" Sends queued data, it is called by the reactor when the socket is writable """
+		while self.outbound:
+			data = self.outbound[0]
+			count = self._send_some(data)
+			if count is None:
+				return
+			self.queued_bytes -= count
+			if count < len(data):
+				self.outbound[0] = data[count:]
+				return
+			self.outbound.popleft()
+		self.reactor.remove_writer(self)
+
+	def abort(self):
+		""" Drops unsent data and shuts the socket down, the reading side
+			gets the end of stream and the owner closes the connection as usual """
+		if self.outbound:
+			self.reactor.remove_writer(self)
+			self.outbound.clear()
+			self.queued_bytes = 0
+		self.aborted = True
 		try:
-			self.socket.send(string)
-		except socket.error,e:
-			raise ConnectionClosed()	
+			self.socket.shutdown(socket.SHUT_RDWR)
+		except socket.error, e:
+			pass
+
+	def _send_some(self, data):
+		""" Returns count of sent bytes, None when the connection was aborted """
+		try:
+			count = self.socket.send(data)
+		except socket.error, e:
+			if e.args[0] in would_block_errors:
+				return 0
+			self.abort()
+			return None
+		self.sent_bytes += count
+		return count
 
 	def get_peer_name(self):
 		return self.socket.getpeername()[0]
 
 	def get_peer_port(self):
 		return self.socket.getpeername()[1]
+
+
+class StreamReader:
+
+	""" Reads lines of connection when the reactor reports it readable.
+		read_line() returns Future, so it can be yielded from coroutine. """
+
+	def __init__(self, reactor, connection):
+		self.reactor = reactor
+		self.connection = connection
+		self.eof = False
+		self.waiter = None
+		reactor.add_reader(connection, self.data_ready)
+
+	def data_ready(self):
+		try:
+			self.connection.lines.receive()
+		except ConnectionClosed:
+			self._stop()
+		self._wakeup()
+
+	def read_line(self):
+		""" Returns Future of the next line without '\n', ConnectionClosed is set on end of stream """
+		self.waiter = Future()
+		waiter = self.waiter
+		self._wakeup()
+		return waiter
+
+	def close(self):
+		self._stop()
+		self._wakeup()
+
+	def _stop(self):
+		if not self.eof:
+			self.eof = True
+			self.reactor.remove_reader(self.connection)
+
+	def _wakeup(self):
+		if self.waiter is None:
+			return
+		try:
+			line = self.connection.lines.next_line()
+		except LineTooLong, e:
+			self._stop()
+			line = None
+			error = e
+		else:
+			error = ConnectionClosed()
+		if line is None and not self.eof:
+			return
+		waiter = self.waiter
+		self.waiter = None
+		if line is not None:
+			waiter.set_result(line)
+		else:
+			waiter.set_exception(error)
@@ -14,6 +14,20 @@
 # along with this program; see the file COPYING. If not, see 
 # <http://www.gnu.org/licenses/>.
 
+from connection import StreamReader, ConnectionClosed
+from reactor import Return
+
+
+class MalformedMessage(ConnectionClosed):
+	pass
+
+
+def parse_line(line):
+	""" Returns (key, value), line without '|' raises MalformedMessage """
+	if "|" not in line:
+		raise MalformedMessage(line)
+	return line.split("|", 1)
+
 
 class DictProtocol:
 
@@ -24,6 +38,9 @@ class DictProtocol:
 	def close(self):
 		self.connection.close()
 
+	def fileno(self):
+		return self.connection.fileno()
+
 	def send_message(self, **kw):
 		self.send_dict(kw)		
 
@@ -40,7 +57,31 @@ class DictProtocol:
 					buffer = self.buffer
 					self.buffer = {}
 					return buffer
-				key, value = line.split("|", 1)
+				key, value = parse_line(line)
 				self.buffer[key] = value
 			else:
 				return None
+
+
+class AsyncDictProtocol(DictProtocol):
+
+	""" DictProtocol for coroutines, read_message is a coroutine (see reactor.py),
+		sending is the same as in DictProtocol """
+
+	def __init__(self, reactor, connection):
+		DictProtocol.__init__(self, connection)
+		self.reader = StreamReader(reactor, connection)
+
+	def close(self):
+		self.reader.close()
+		DictProtocol.close(self)
+
+	def read_message(self):
+		""" Coroutine, returns the next message, raises ConnectionClosed at the end of stream """
+		message = {}
+		while True:
+			line = yield self.reader.read_line()
+			if line == "|":
+				raise Return(message)
+			key, value = parse_line(line)
+			message[key] = value
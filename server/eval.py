@@ -16,9 +16,11 @@
 
 import collections 
 from tile import Pon, Chi
-from tile import red_dragon, white_dragon, green_dragon, dragons
-from tile import bamboos, chars, pins, all_tiles, honors
-from copy import copy
+from tile import red_dragon, white_dragon, green_dragon
+from tile import TILES_COUNT, tiles_by_id, tiles_to_counts, counts_to_tiles, is_chi_start_id
+from tile import suit_first_ids, honor_ids, terminal_ids, nonterminal_ids
+from agari import agari_decompositions, completing_ids
+from cache import LRUCache
 
 def is_hand_open(sets):
 	for set in sets:
@@ -27,23 +29,98 @@ def is_hand_open(sets):
 	return False
 
 def find_tiles_yaku(hand, sets, specials, round_wind, player_wind, wintype):
-	last_tile = hand[-1]
+	return evaluate_hand(hand, sets, specials, round_wind, player_wind, wintype)[0]
+
+def evaluate_hand(hand, sets, specials, round_wind, player_wind, wintype):
+	""" Returns (yaku, minipoints) of hand, ([], None) if hand is not complete.
+		Minipoints of kokushi and nine lanterns are not important (limit hands) """
+	counts = tiles_to_counts(hand)
 
 	if not sets:
-		if all((hand.count(tile) == 2 for tile in hand)):
-			return score_special_chii_toitsu(hand) + specials
+		if is_seven_pairs(counts):
+			return (score_special_chii_toitsu(counts) + specials, 25)
+
+		if score_special_nine_lanterns(counts):
+			return ([("Chuuren-pootoo", 13)], 30)
+
+		if score_special_kokushi_musou(counts):
+			return ([("Kokushi-musou", 13)], 30)
+
+	result = find_best_decomposition(hand, sets, round_wind, player_wind, wintype)
+	if result is None:
+		return ([], None)
+	yaku, minipoints = result
+	return (yaku + specials, minipoints)
 
-		if score_special_nine_lanterns(hand):
-			return [("Chuuren-pootoo", 13)]
 
-		if score_special_kokushi_musou(hand):
-			return [("Kokushi-musou", 13)]
+def find_best_decomposition(hand, sets, round_wind, player_wind, wintype):
+	""" Returns (yaku, minipoints) of decomposition with the highest han (and minipoints in case
+		of the same han), the first one wins in case of tie. Every decomposition from the agari
+		table is scored by its features; the pinfu check and minipoints are skipped for
+		decompositions that cannot reach the best han and minipoints are computed only for ties.
+		Returns None if hand is not complete. """
+	last_tile = hand[-1]
+	best = None
+	best_han = None
+	best_minipoints = None
+
+	def minipoints(pair, founded_sets, pinfu):
+		if pinfu:
+			return 30 if wintype == "Ron" else 20
+		return decomposition_minipoints(pair, sets, founded_sets[len(sets):], last_tile,
+			wintype, round_wind, player_wind)
+
+	for pair_id, melds in agari_decompositions(tiles_to_counts(hand)):
+		pair = tiles_by_id[pair_id]
+		founded_sets = sets + melds_to_sets(melds)
+		features, yaku_pai, ipeikou = decomposition_features(pair, founded_sets, round_wind, player_wind)
+
+		yakuman = yakuman_of_features(features)
+		if yakuman:
+			# Nothing can be better
+			return ([(yakuman, 13)], minipoints(pair, founded_sets, False))
+
+		yaku = yaku_of_features(features, yaku_pai, ipeikou, wintype)
+		han = sum([ value for name, value in yaku ])
+		pinfu_possible = not features & F_NO_PINFU
+
+		# Only pinfu can be added, this is the upper bound of the decomposition
+		if best_han is not None and han + pinfu_possible < best_han:
+			continue
 
-	for pair, rest in detect_pairs(hand):
-		founded_sets = find_sets(rest, sets)
-		if founded_sets:
-			return eval_sets(pair, founded_sets, round_wind, player_wind, last_tile, wintype) + specials
-	return []
+		pinfu = pinfu_possible and check_pinfu(pair, founded_sets, features, last_tile)
+		if pinfu:
+			yaku.append(("Pinfu", 1))
+			han += 1
+
+		if best_han is None or han > best_han:
+			best = (yaku, pair, founded_sets, pinfu)
+			best_han = han
+			best_minipoints = None
+		elif han == best_han:
+			if best_minipoints is None:
+				best_minipoints = minipoints(*best[1:])
+			points = minipoints(pair, founded_sets, pinfu)
+			if points > best_minipoints:
+				best = (yaku, pair, founded_sets, pinfu)
+				best_minipoints = points
+
+	if best is None:
+		return None
+	if best_minipoints is None:
+		best_minipoints = minipoints(*best[1:])
+	return (best[0], best_minipoints)
+
+
+def melds_to_sets(melds):
+	""" Converts melds from agari table into Pon/Chi sets """
+	result = []
+	for tile_id, is_chi in melds:
+		if is_chi:
+			result.append(Chi(tiles_by_id[tile_id], tiles_by_id[tile_id + 1], tiles_by_id[tile_id + 2]))
+		else:
+			result.append(Pon(tiles_by_id[tile_id]))
+	return result
 
 
 def count_of_tiles_yaku(hand, sets, specials, round_wind, player_wind, wintype):
@@ -105,62 +182,81 @@ def compute_payment(fans, minipoints, wintype, player_wind):
 		else:
 			return (name, (round_to_base(score / 4, 100), round_to_base(score / 2, 100)))
 
-def quick_pons_and_kans(hand):
-	d = {}
-	for tile in hand:
-		d[tile] = hand.count(tile)
-	pons = []
-	kans = []
-	for tile,i in d.items():
-		if i == 3:
-			pons.append(tile)
-		if i == 4:
-			kans.append(tile)
-	return (pons, kans)
-
-def points_sum(tiles, nontermial_points):
-	s = 0
-	for tile in tiles:		
-		if tile.is_nonterminal():
-			s += nontermial_points
-		else:
-			s += nontermial_points * 2
-	return s
-
-def compute_minipoints(hand, sets, wintype, round_wind, player_wind, last_tile):
+def wait_shapes(pair, melds, last_tile):
+	""" Returns list of (shape, set) for every place of last_tile in pair or melds (sets found in hand),
+		shape is one of "tanki", "kanchan", "penchan", "ryanmen", "shanpon" """
+	shapes = []
+	if pair is last_tile:
+		shapes.append(("tanki", None))
+	for set in melds:
+		if set.is_chi():
+			if set.tile2 is last_tile:
+				shapes.append(("kanchan", set))
+			elif set.tile1 is last_tile:
+				shapes.append(("penchan" if last_tile.get_number() == 7 else "ryanmen", set))
+			elif set.tile3 is last_tile:
+				shapes.append(("penchan" if last_tile.get_number() == 3 else "ryanmen", set))
+		elif set.tile is last_tile:
+			shapes.append(("shanpon", set))
+	return shapes
+
+def set_minipoints(set):
+	if set.is_chi():
+		return 0
+	points = 2
+	if set.closed:
+		points *= 2
+	if set.is_kan():
+		points *= 4
+	if not set.tile.is_nonterminal():
+		points *= 2
+	return points
+
+def decomposition_minipoints(pair, sets, melds, last_tile, wintype, round_wind, player_wind):
+	""" Returns minipoints of decomposition, 'sets' are declared sets and 'melds' are sets found
+		in hand. If last_tile fits more waits, the one with the most minipoints is taken. """
 	if not is_hand_open(sets) and wintype == "Ron":
 		points = 30
 	else:
 		points = 20
 
-	pons, kans = quick_pons_and_kans(hand)
-	points += points_sum(pons, 4)
-	points += points_sum(kans, 16)
-	points += points_sum([set.tile for set in sets if set.is_pon()], 2)
-	points += points_sum([set.tile for set in sets if set.is_kan() and set.closed ], 8)
-	points += points_sum([set.tile for set in sets if set.is_kan() and not set.closed ], 16)
+	for set in sets:
+		points += set_minipoints(set)
+	for set in melds:
+		points += set_minipoints(set)
 
 	for tile in [ red_dragon, white_dragon, green_dragon, round_wind, player_wind ]:
-		if hand.count(tile) == 2:
-			points += 2	
+		if pair is tile:
+			points += 2
 
 	if wintype == "Tsumo":
 		points += 2
 
-	if check_single_waiting(hand, sets):
-		points += 2
+	wait_points = None
+	for shape, set in wait_shapes(pair, melds, last_tile):
+		if shape == "shanpon":
+			# Pon completed by Ron is counted as open
+			p = -set_minipoints(set) / 2 if wintype == "Ron" else 0
+		elif shape == "ryanmen":
+			p = 0
+		else:
+			p = 2
+		if wait_points is None or p > wait_points:
+			wait_points = p
+	points += wait_points or 0
 
 	if points == 20:
-		# In what case can 20 points happend??
+		# Open hand without any minipoints
 		return 30
 
 	return round_to_base(points, 10)
 
 
 def compute_doras(hand, sets, doras, score_name):
+	counts = tiles_to_counts(hand)
 	dora_yaku = 0
 	for dora in doras:
-		dora_yaku += hand.count(dora)
+		dora_yaku += counts[dora.id]
 		for set in sets:
 			dora_yaku += set.count_of_tile(dora)
 	
@@ -171,21 +267,12 @@ def compute_doras(hand, sets, doras, score_name):
 
 
 def compute_score(hand, sets, wintype, doras_and_ura_doras, specials, round_wind, player_wind):
-	last_tile = hand[-1]
-	yaku = find_tiles_yaku(hand, sets, specials, round_wind, player_wind, wintype)
+	yaku, minipoints = evaluate_hand(hand, sets, specials, round_wind, player_wind, wintype)
 
 	doras, ura_doras = doras_and_ura_doras
 	yaku += compute_doras(hand, sets, doras, "Dora")
 	yaku += compute_doras(hand, sets, ura_doras, "Ura dora")
 
-	yaku_names = [ y[0] for y in yaku ]
-
-	if "Pinfu" in yaku_names:
-		minipoints = 30 if wintype == "Ron" else 20	
-	elif "Chii toitsu" in yaku_names:
-		minipoints = 25
-	else:
-		minipoints = compute_minipoints(hand, sets, wintype, round_wind, player_wind, last_tile)
 	fans = min(sum(map(lambda r: r[1], yaku)), 13)
 
 	# TODO: Red-fives
@@ -193,477 +280,605 @@ def compute_score(hand, sets, wintype, doras_and_ura_doras, specials, round_wind
 	return (compute_payment(fans, minipoints, wintype, player_wind), yaku, minipoints)
 	
 
-def detect_pairs(hand):
-	result = []
-	used = []
-	for tile in hand:
-		if tile not in used and hand.count(tile) >= 2:
-			new_hand = copy(hand)
-			new_hand.remove(tile)
-			new_hand.remove(tile)
-			new_hand.sort()
-			result.append((tile, new_hand))
-			used.append(tile)
-	return result
-
-
-def find_sets(hand, sets):
-	""" Hand has to be sorted """
-	founded = copy(sets)
-
-	def check_triples(hand, level):			
-			assert level >= 1 and level <= 5
-			if level == 5:				
-				return founded
-			tile = hand[0]
-
-			if hand.count(tile) >= 3:
-				new_hand = copy(hand)
-				new_hand.remove(tile)
-				new_hand.remove(tile)
-				new_hand.remove(tile)
-				set = Pon(tile)
-				founded.append(set)				
-				r = check_triples(new_hand, level + 1)
-				if r:
-					return r
-				founded.remove(set)
-				
-			if tile.is_suit() and tile.get_number() <= 7:
-				tile2 = tile.next_tile()			
-				tile3 = tile2.next_tile()
-				if tile2 in hand and tile3 in hand:
-					new_hand = copy(hand)
-					new_hand.remove(tile)
-					new_hand.remove(tile2)
-					new_hand.remove(tile3)
-					set = Chi(tile, tile2, tile3)
-					founded.append(set)					
-					r = check_triples(new_hand, level + 1)
-					if r:
-						return r;
-					founded.remove(set)
-			return None
-	return check_triples(hand, 1 + len(sets))
-
-def check_pinfu(pair, sets, round_wind, player_wind, last_tile):
-	if for_any_sets(sets, lambda s: not s.closed or not s.is_chi()):
-		return False
-
-	if pair in [ red_dragon, white_dragon, green_dragon, round_wind, player_wind ]:
-		return False
-
-	# Kan don't need to be tested because all sets are chi
-	hand = [ pair, pair ]
-	for s in sets :
-		hand += s.tiles()
-	hand.remove(last_tile)
-	hand.append(last_tile) # We want to move last_tile to the end
-
-	return not check_single_waiting(hand, [])
-
-
-def eval_sets(pair, sets, round_wind, player_wind, last_tile, wintype):
-	result = []
-
-	# Yakumans
-	for name, fn in score_functions_yakuman:
-		if fn(pair, sets):
-			return [(name, 13)]
-
-	# Other hands
-	for name, fn in score_functions:
-		score = fn(pair, sets)
-		if score > 0:
-			result.append((name, score))
-
-	# Pinfu
-	if check_pinfu(pair, sets, round_wind, player_wind, last_tile):
-		result.append(("Pinfu", 1))
-
-	if wintype == "Tsumo" and for_all_sets(sets, lambda s: s.closed):
-		result.append(("Tsumo", 1))
-
-	yaku_pai_base = 0 
-	for set in sets:
-		if set.is_pon_or_kan():
-			if set.tile == round_wind:
-				yaku_pai_base += 1
-			if set.tile == player_wind:
-				yaku_pai_base += 1
-
-	if yaku_pai_base > 0:
-		for name, yaku in result:
-			if name == "Yaku-Pai":
-				result.remove((name, yaku))
-				result.append((name, yaku + yaku_pai_base))
-				break
+# Yaku rule engine
+#
+# Features of a decomposition (pair and four sets) are extracted in one pass
+# into a bitmask, every yaku is then a test of required and forbidden features.
+
+F_OPEN = 1 << 0                  # Some set is open
+F_CHI = 1 << 1                   # Some set is chi
+F_PON = 1 << 2                   # Some set is pon or kan
+F_NOT_KAN = 1 << 3               # Some set is not kan
+F_HONOR = 1 << 4                 # Some tile is honor
+F_TERMINAL = 1 << 5              # Some tile is terminal
+F_SIMPLE = 1 << 6                # Some tile is 2-8
+F_NONGREEN = 1 << 7              # Some tile is not green
+F_BAMBOO = 1 << 8                # Some tile is bamboo
+F_PINS = 1 << 9                  # Some tile is pin
+F_CHARS = 1 << 10                # Some tile is char
+F_MULTI_SUIT = 1 << 11           # Tiles of more suits
+F_SET_WITHOUT_TERMINAL = 1 << 12
+F_SET_WITHOUT_TERMINAL_OR_HONOR = 1 << 13
+F_PAIR_SIMPLE = 1 << 14
+F_PAIR_HONOR = 1 << 15
+F_PAIR_WIND = 1 << 16
+F_PAIR_VALUE = 1 << 17           # Pair of dragons, round wind or player wind
+F_THREE_DRAGON_PONS = 1 << 18
+F_THREE_WIND_PONS = 1 << 19
+F_FOUR_WIND_PONS = 1 << 20
+F_THREE_CLOSED_PONS = 1 << 21
+F_SANSHOKU_CHI = 1 << 22
+F_SANSHOKU_PON = 1 << 23
+F_ITSU = 1 << 24
+
+F_SUITS = F_BAMBOO | F_PINS | F_CHARS
+
+
+def _tile_features(tile):
+	if tile.is_honor():
+		features = F_HONOR
+	elif tile.is_terminal():
+		features = F_TERMINAL
+	else:
+		features = F_SIMPLE
+	if tile.is_bamboo():
+		features |= F_BAMBOO
+	elif tile.is_pins():
+		features |= F_PINS
+	elif tile.is_char():
+		features |= F_CHARS
+	if not tile.is_green():
+		features |= F_NONGREEN
+	return features
+
+def _set_features(tile_ids):
+	features = 0
+	for tile_id in tile_ids:
+		features |= tile_features[tile_id]
+	if not features & F_TERMINAL:
+		features |= F_SET_WITHOUT_TERMINAL
+		if not features & F_HONOR:
+			features |= F_SET_WITHOUT_TERMINAL_OR_HONOR
+	return features
+
+def _pair_features(tile):
+	features = tile_features[tile.id]
+	if tile.is_honor():
+		features |= F_PAIR_HONOR
+		if tile.is_wind():
+			features |= F_PAIR_WIND
 		else:
-			result.append(("Yaku-Pai", yaku_pai_base))
-	return result
-
+			features |= F_PAIR_VALUE
+	elif tile.is_nonterminal():
+		features |= F_PAIR_SIMPLE
+	return features
 
-def sum_over_sets(sets, fn):
-	return reduce(lambda a, s: fn(s) + a, sets, 0)
+tile_features = [ _tile_features(tile) for tile in tiles_by_id ]
+pair_features = [ _pair_features(tile) for tile in tiles_by_id ]
+pon_features = [ _set_features([ i ]) | F_PON for i in xrange(TILES_COUNT) ]
+chi_features = [ _set_features([ i, i + 1, i + 2 ]) | F_CHI if is_chi_start_id(i) else 0 for i in xrange(TILES_COUNT) ]
 
-def for_all_tiles_in_sets(sets, fn):
-	return for_all_sets(sets, lambda s: s.all_tiles(fn))
 
-def for_all_sets(sets, fn):
-	for set in sets:
-		if not fn(set):
-			return False
-	return True
-
-def for_any_sets(sets, fn):
-	for set in sets:
-		if fn(set):
-			return True
-	return False
-
-def is_sets_closed(sets):
-	return not is_hand_open(sets)
-
-def score_yaku_pai(pair_tile, sets):
-	def dragon_pon_or_kan(set):
-		if set.all_tiles_is(red_dragon) or set.all_tiles_is(white_dragon) or set.all_tiles_is(green_dragon):
-			return 1
-		else:
-			return 0
-	return sum_over_sets(sets, dragon_pon_or_kan)
-
-
-def score_tan_yao(pair_tile, sets):
-	def set_is_nontermial(set):
-		return set.all_tiles(lambda t: t.is_nonterminal())
-	
-	if pair_tile.is_nonterminal() and for_all_sets(sets, set_is_nontermial):
-		return 1
-	else:
-		return 0
-
-def score_ipeikou(pair_tile, sets):
+def count_bits(value):
 	count = 0
-	for i, set in enumerate(sets):
-		if not set.closed:
-			return 0
-		if set.is_chi() and sets[i + 1:].count(set) == 1:
-			count += 1
+	while value:
+		value &= value - 1
+		count += 1
 	return count
 
-def score_sanshoku_doujun(pair_tile, sets):
+def decomposition_features(pair, sets, round_wind, player_wind):
+	""" Returns (features, yaku_pai, ipeikou) of decomposition """
+	features = pair_features[pair.id]
+	if pair == round_wind or pair == player_wind:
+		features |= F_PAIR_VALUE
+
+	chis = 0
+	repeated_chis = 0
+	pons = 0
+	dragon_pons = 0
+	wind_pons = 0
+	closed_pons = 0
+	yaku_pai = 0
 	for set in sets:
-		if set.is_chi() and set.is_bamboo() and sets.count(set.as_pins()) > 0 and sets.count(set.as_char()) > 0:
-			if is_sets_closed(sets):
-				return 2
-			else:
-				return 1
-	return 0
-
-def score_sanshoku_douko(pair_tile, sets):
-	for set in sets:
-		if set.is_pon_or_kan() and set.is_bamboo():
-			pins = [ s for s in sets if s.is_pon_or_kan() and s.tile == set.tile.as_pins() ]
-			chars = [ s for s in sets if s.is_pon_or_kan() and s.tile == set.tile.as_char() ]
-			if pins and chars:
-				return 2
-	return 0
-
-
-itsu_sets_bamboos = [ Chi(bamboos[0], bamboos[1], bamboos[2]), Chi(bamboos[3], bamboos[4], bamboos[5]), Chi(bamboos[6], bamboos[7], bamboos[8]) ]
-itsu_sets_chars = [ Chi(chars[0], chars[1], chars[2]), Chi(chars[3], chars[4], chars[5]), Chi(chars[6], chars[7], chars[8]) ]
-itsu_sets_pins = [ Chi(pins[0], pins[1], pins[2]), Chi(pins[3], pins[4], pins[5]), Chi(pins[6], pins[7], pins[8]) ]
-		
-def score_itsu(pair_tile, sets):
-	if (sets.count(itsu_sets_bamboos[0]) > 0 and sets.count(itsu_sets_bamboos[1]) > 0 and sets.count(itsu_sets_bamboos[2])) or \
-		(sets.count(itsu_sets_chars[0]) > 0 and sets.count(itsu_sets_chars[1]) > 0 and sets.count(itsu_sets_chars[2])) or \
-		(sets.count(itsu_sets_pins[0]) > 0 and sets.count(itsu_sets_pins[1]) > 0 and sets.count(itsu_sets_pins[2])):
-		if is_sets_closed(sets):
-			return 2
+		tile = set.get_representative_tile()
+		tile_id = tile.id
+		if set.is_chi():
+			features |= chi_features[tile_id]
+			bit = 1 << tile_id
+			repeated_chis |= chis & bit
+			chis |= bit
 		else:
-			return 1
-
-def score_chanta(pair_tile, sets):
-	if pair_tile.is_nonterminal() or not for_any_sets(sets, lambda s: s.is_chi()):
-		return 0	
+			features |= pon_features[tile_id]
+			pons |= 1 << tile_id
+			if set.closed:
+				closed_pons += 1
+			if tile_id < 3:
+				dragon_pons += 1
+			elif tile_id < 7:
+				wind_pons += 1
+			if tile == round_wind:
+				yaku_pai += 1
+			if tile == player_wind:
+				yaku_pai += 1
+		if not set.closed:
+			features |= F_OPEN
+		if not set.is_kan():
+			features |= F_NOT_KAN
+
+	if count_bits(features & F_SUITS) > 1:
+		features |= F_MULTI_SUIT
+	if dragon_pons == 3:
+		features |= F_THREE_DRAGON_PONS
+	if wind_pons == 3:
+		features |= F_THREE_WIND_PONS
+	elif wind_pons == 4:
+		features |= F_FOUR_WIND_PONS
+	if closed_pons >= 3:
+		features |= F_THREE_CLOSED_PONS
+	if (chis >> 7) & (chis >> 16) & (chis >> 25) & 0x7f:
+		features |= F_SANSHOKU_CHI
+	if (pons >> 7) & (pons >> 16) & (pons >> 25) & 0x1ff:
+		features |= F_SANSHOKU_PON
+	for first in suit_first_ids:
+		if (chis >> first) & 0x49 == 0x49: # Chis starting on 1, 4 and 7
+			features |= F_ITSU
+			break
 
-	for set in sets:
-		if not set.any_tiles(lambda t: t.is_honor() or t.is_terminal()):
-			return 0
+	return (features, yaku_pai + dragon_pons, count_bits(repeated_chis))
 
-	if score_junchan(pair_tile, sets) > 0:
-		return 0
 
-	if is_sets_closed(sets):
-		return 2
-	else:
-		return 1
+# (name, required features, forbidden features)
+yakuman_rules = [
+	("Dai-sangen", F_THREE_DRAGON_PONS, 0),
+	("Shou-suushi", F_THREE_WIND_PONS | F_PAIR_WIND, 0),
+	("Dai-suushi", F_FOUR_WIND_PONS, 0),
+	("Suu-ankou", 0, F_OPEN | F_CHI),
+	("Suu-kantsu", 0, F_NOT_KAN),
+	("Chinroutou", 0, F_SIMPLE | F_HONOR),
+	("Ryuu-iisou", 0, F_NONGREEN),
+	("Tsu-iisou", 0, F_SUITS),
+]
 
-def score_junchan(pair_tile, sets):
-	if not pair_tile.is_terminal() or not for_any_sets(sets, lambda s: s.is_chi()):
-		return 0	
+# (name, required features, forbidden features, value of closed hand, value of open hand)
+yaku_rules = [
+	("Tan-Yao", 0, F_TERMINAL | F_HONOR, 1, 1),
+	("Sanshoku doujun", F_SANSHOKU_CHI, 0, 2, 1),
+	("Itsu", F_ITSU, 0, 2, 1),
+	("Chanta", F_CHI | F_HONOR, F_PAIR_SIMPLE | F_SET_WITHOUT_TERMINAL_OR_HONOR, 2, 1),
+	("Junchan taiyai", F_CHI, F_PAIR_SIMPLE | F_PAIR_HONOR | F_SET_WITHOUT_TERMINAL, 3, 2),
+	("Sanshoku douko", F_SANSHOKU_PON, 0, 2, 2),
+	("Honitsu", F_HONOR, F_MULTI_SUIT, 3, 2),
+	("Chinitsu", 0, F_HONOR | F_MULTI_SUIT, 6, 5),
+	("San-anko", F_THREE_CLOSED_PONS, 0, 2, 2),
+	("Toitoiho", 0, F_CHI, 2, 2),
+]
 
-	for set in sets:
-		if not set.any_tiles(lambda t: t.is_terminal()):
-			return 0
-	if is_sets_closed(sets):
-		return 3
-	else:
-		return 2
 
+# Pinfu needs closed hand with only chis and pair without value
+F_NO_PINFU = F_OPEN | F_PON | F_PAIR_VALUE
 
-def score_honitsu(pair_tile, sets):
-	if score_chinitsu(pair_tile, sets) > 0:
-		return 0
+def check_pinfu(pair, sets, features, last_tile):
+	""" All sets are closed chi, so last tile is in pair or in some of them.
+		Hand is not pinfu if last tile can be also taken as tanki, kanchan or penchan """
+	if features & F_NO_PINFU:
+		return False
+	for shape, set in wait_shapes(pair, sets, last_tile):
+		if shape != "ryanmen":
+			return False
+	return True
 
-	for suits in [ pins, chars, bamboos ]:
-		if pair_tile not in suits and pair_tile not in honors:
-			continue
-		for set in sets:
-			tile = set.get_representative_tile()
-			if tile not in suits and tile not in honors:
-				break
-		else:
-			if is_sets_closed(sets):
-				return 3
-			else:
-				return 2
-	return 0
 
+def yakuman_of_features(features):
+	""" Returns name of yakuman or None """
+	for name, required, forbidden in yakuman_rules:
+		if features & required == required and not features & forbidden:
+			return name
+	return None
 
-def score_chinitsu(pair_tile, sets):
-	if not pair_tile.is_suit():
-		return 0
-	
-	for set in sets:
-		if not set.all_tiles(lambda t: pair_tile.is_same_type(t)):
-			return 0
+def yaku_of_features(features, yaku_pai, ipeikou, wintype):
+	""" Returns yaku of decomposition without yakumans and pinfu """
+	result = []
+	if yaku_pai > 0:
+		result.append(("Yaku-Pai", yaku_pai))
 
-	if is_sets_closed(sets):
-		return 6
-	else:
-		return 5
+	if ipeikou > 0 and not features & F_OPEN:
+		result.append(("Ipeikou", ipeikou))
 
+	# Other hands
+	for name, required, forbidden, closed_value, open_value in yaku_rules:
+		if features & required == required and not features & forbidden:
+			if features & F_OPEN:
+				result.append((name, open_value))
+			else:
+				result.append((name, closed_value))
 
-def score_sananko(pair_tile, sets):
-	s = [ set for set in sets if set.closed and set.is_pon_or_kan() ]
-	if len(s) >= 3:
-		return 2
-	return 0
+	if wintype == "Tsumo" and not features & F_OPEN:
+		result.append(("Tsumo", 1))
 
+	return result
 
-def score_toitoiho(pair_tile, sets):
-	if for_all_sets(sets, lambda s: s.is_pon_or_kan()):
-		return 2
-	return 0
+def count_in_range(counts, first, last):
+	return sum(counts[first:last + 1])
 
 
-def nine_lanterns_helper(hand, suits):
-	for s in suits:
-		if hand.count(s) == 0:
+def nine_lanterns_helper(counts, first):
+	last = first + 8
+	for i in xrange(first, last + 1):
+		if counts[i] == 0:
 			return False
 
-	for h in hand:
-		if not h in suits:
-			return False
+	if count_in_range(counts, first, last) != sum(counts):
+		return False
 
-	return hand.count(suits[0]) >= 3 and hand.count(suits[-1]) >= 3
+	return counts[first] >= 3 and counts[last] >= 3
 
 
-def score_special_nine_lanterns(hand):
-	return nine_lanterns_helper(hand, bamboos) or nine_lanterns_helper(hand, pins) or nine_lanterns_helper(hand, chars)
+def score_special_nine_lanterns(counts):
+	for first in suit_first_ids:
+		if nine_lanterns_helper(counts, first):
+			return True
+	return False
 
 
-def score_special_kokushi_musou(hand):
+def score_special_kokushi_musou(counts):
 	pair = False
 
-	for tile in all_tiles:
-		if tile.is_nonterminal():
-			if hand.count(tile) != 0:
-				return False
-		else:
-			if hand.count(tile) == 2:
-				if pair:
-					return False
-				else:
-					pair = True
-			elif hand.count(tile) != 1:
+	for i in nonterminal_ids:
+		if counts[i] != 0:
+			return False
+
+	for i in terminal_ids + honor_ids:
+		if counts[i] == 2:
+			if pair:
 				return False
+			else:
+				pair = True
+		elif counts[i] != 1:
+			return False
 	return pair
 
 
-def score_special_chii_toitsu(hand):
+def is_seven_pairs(counts):
+	for count in counts:
+		if count != 0 and count != 2:
+			return False
+	return True
+
+
+def score_special_chii_toitsu(counts):
 	yaku = [ ("Chii toitsu", 2) ]
+	total = sum(counts)
+	honors_count = count_in_range(counts, 0, 6)
 
-	if all((tile.is_honor() for tile in hand)):
+	if honors_count == total:
 		return [("Tsu-iisou", 13)]
 
-	if all((tile.is_nonterminal() for tile in hand)):
+	if sum(counts[i] for i in nonterminal_ids) == total:
 		yaku.append(("Tan-Yao", 1))
 
-	for suits in [ pins, chars, bamboos ]:
-		if all((tile in suits for tile in hand)):
+	for first in suit_first_ids:
+		suit_count = count_in_range(counts, first, first + 8)
+		if suit_count == total:
 			yaku.append(("Chinitsu", 6))
 			break
-		if all((tile in suits or tile in honors for tile in hand)):
+		if suit_count + honors_count == total:
 			yaku.append(("Honitsu", 3))
 			break
 
 	return yaku
 
 
-def score_daisangen(pair_tile, sets):
-	c = 0
-	for set in sets:
-		if set.is_pon_or_kan() and set.tile in dragons:
-			c += 1
-	return c == 3
-
-
-def score_shou_suushi(pair_tile, sets):
-	if not pair_tile.is_wind():
-		return False
-	c = 0
-	for set in sets:
-		if set.is_pon_or_kan() and set.tile.is_wind():
-			c += 1
-	return c == 3
-
-
-def score_dai_suushi(pair_tile, sets):
-	c = 0
-	for set in sets:
-		if set.is_pon_or_kan() and set.tile.is_wind():
-			c += 1
-	return c == 4
-
-
-def score_suu_ankou(pair_tile, sets):
-	return for_all_sets(sets, lambda s: s.closed and s.is_pon_or_kan())
-
-
-def score_suu_kantsu(pair_tile, sets):
-	return for_all_sets(sets, lambda s: s.is_kan())
-
-
-def score_chinroutou(pair_tile, sets):
-	return pair_tile.is_terminal() and for_all_tiles_in_sets(sets, lambda t: t.is_terminal())
-
-
-def score_ryuu_iisou(pair_tile, sets):
-	return pair_tile.is_green() and for_all_tiles_in_sets(sets, lambda t: t.is_green())
-
-def score_tsu_iisou(pair_tile, sets):
-	return pair_tile.is_honor() and for_all_tiles_in_sets(sets, lambda t: t.is_honor())
-
-score_functions = [ 
-	("Yaku-Pai", score_yaku_pai),
-	("Tan-Yao", score_tan_yao),
-	("Ipeikou", score_ipeikou),
-	("Sanshoku doujun", score_sanshoku_doujun),
-	("Itsu", score_itsu),
-	("Chanta", score_chanta),
-	("Junchan taiyai", score_junchan),
-	("Sanshoku douko", score_sanshoku_douko),
-	("Honitsu", score_honitsu),
-	("Chinitsu", score_chinitsu),
-	("San-anko", score_sananko),
-	("Toitoiho", score_toitoiho),
-]
-
-score_functions_yakuman = [
-	("Dai-sangen", score_daisangen),
-	("Shou-suushi", score_shou_suushi),
-	("Dai-suushi", score_dai_suushi),
-	("Suu-ankou", score_suu_ankou),
-	("Suu-kantsu", score_suu_kantsu),
-	("Chinroutou", score_chinroutou),
-	("Ryuu-iisou", score_ryuu_iisou),
-	("Tsu-iisou", score_tsu_iisou)
-]
-
-
 def find_potential_chi(hand, tile):
+	return potential_chi_of_counts(tiles_to_counts(hand), tile)
+
+def potential_chi_of_counts(counts, tile):
+	""" Returns list of (chi, marker tile) that can be formed with tile """
 	r = []
 	if not tile.is_suit():
 		return r
 	n = tile.get_number()
-	pt = tile.prev_tile()
-	ppt = pt.prev_tile()
-	nt = tile.next_tile()
-	nnt = nt.next_tile()
-	if n < 9 and n > 1 and pt in hand and nt in hand:
-		r.append((Chi(pt, tile, nt), pt))
-	if n < 8 and nt in hand and nnt in hand:
-		r.append((Chi(tile, nt, nnt), tile))
-	if n > 2 and pt in hand and ppt in hand:
-		r.append((Chi(ppt, pt, tile), ppt))
+	i = tile.id
+	if n < 9 and n > 1 and counts[i - 1] and counts[i + 1]:
+		r.append((Chi(tiles_by_id[i - 1], tile, tiles_by_id[i + 1]), tiles_by_id[i - 1]))
+	if n < 8 and counts[i + 1] and counts[i + 2]:
+		r.append((Chi(tile, tiles_by_id[i + 1], tiles_by_id[i + 2]), tile))
+	if n > 2 and counts[i - 1] and counts[i - 2]:
+		r.append((Chi(tiles_by_id[i - 2], tiles_by_id[i - 1], tile), tiles_by_id[i - 2]))
 	return r
 
-def tile_counts(hand):
+def tile_counts(counts):
+	""" Returns dictionary: count -> set of tile ids with this count """
 	d = collections.defaultdict(set)
-	for tile in hand:
-		d[hand.count(tile)].add(tile)
+	for i, count in enumerate(counts):
+		if count:
+			d[count].add(i)
 	return d
 
-def riichi_test(hand, sets):
-	if any([ not s.closed for s in sets ]):
-		return False
+# Shanten
+#
+# Regular hand: shanten = 8 - 2 * melds - partial sets - pair, where melds
+# and partial sets together cannot exceed four. Every suit is evaluated
+# independently into "blocks": list of (melds, partial sets, pair) that
+# can be formed from the suit. Blocks are computed once for each suit
+# pattern and cached in _suit_blocks.
+
+_suit_blocks = {}
+
+def _search_blocks(counts, chi, results, i, melds, partials, pair):
+	while i < 9 and counts[i] == 0:
+		i += 1
+	if i == 9:
+		results.add((melds, partials, pair))
+		return
+
+	if counts[i] >= 3:
+		counts[i] -= 3
+		_search_blocks(counts, chi, results, i, melds + 1, partials, pair)
+		counts[i] += 3
+
+	if chi and i <= 6 and counts[i + 1] and counts[i + 2]:
+		counts[i] -= 1; counts[i + 1] -= 1; counts[i + 2] -= 1
+		_search_blocks(counts, chi, results, i, melds + 1, partials, pair)
+		counts[i] += 1; counts[i + 1] += 1; counts[i + 2] += 1
+
+	if counts[i] >= 2:
+		counts[i] -= 2
+		if not pair:
+			_search_blocks(counts, chi, results, i, melds, partials, 1)
+		_search_blocks(counts, chi, results, i, melds, partials + 1, pair)
+		counts[i] += 2
+
+	if chi:
+		for j in (i + 1, i + 2):
+			if j < 9 and counts[j]:
+				counts[i] -= 1; counts[j] -= 1
+				_search_blocks(counts, chi, results, i, melds, partials + 1, pair)
+				counts[i] += 1; counts[j] += 1
+
+	# Isolated tile
+	counts[i] -= 1
+	_search_blocks(counts, chi, results, i, melds, partials, pair)
+	counts[i] += 1
+
+def suit_blocks(counts, first, size = 9, chi = True):
+	""" Returns list of non-dominated (melds, partials, pair) for tiles counts[first:first + size] """
+	suit = counts[first:first + size]
+	key = (tuple(suit), chi)
+	blocks = _suit_blocks.get(key)
+	if blocks is None:
+		results = set()
+		_search_blocks(suit + [ 0 ] * (9 - size), chi, results, 0, 0, 0, 0)
+		blocks = [ b for b in results
+			if not any(o != b and o[2] == b[2] and o[0] >= b[0] and o[1] >= b[1] for o in results) ]
+		_suit_blocks[key] = blocks
+	return blocks
+
+def regular_shanten(counts, sets_count):
+	parts = [ suit_blocks(counts, first) for first in suit_first_ids ]
+	parts.append(suit_blocks(counts, 0, 7, False))
+
+	best = 8
+	for m1, t1, p1 in parts[0]:
+		for m2, t2, p2 in parts[1]:
+			if p1 + p2 > 1:
+				continue
+			for m3, t3, p3 in parts[2]:
+				if p1 + p2 + p3 > 1:
+					continue
+				for m4, t4, p4 in parts[3]:
+					pair = p1 + p2 + p3 + p4
+					if pair > 1:
+						continue
+					melds = m1 + m2 + m3 + m4 + sets_count
+					partials = min(t1 + t2 + t3 + t4, 4 - melds)
+					shanten = 8 - 2 * melds - partials - pair
+					if shanten < best:
+						best = shanten
+	return best
+
+def seven_pairs_shanten(counts):
+	pairs = 0
+	kinds = 0
+	for count in counts:
+		if count:
+			kinds += 1
+			if count >= 2:
+				pairs += 1
+	return 6 - pairs + max(0, 7 - kinds)
+
+def kokushi_shanten(counts):
+	kinds = 0
+	pair = 0
+	for i in terminal_ids + honor_ids:
+		if counts[i]:
+			kinds += 1
+			if counts[i] >= 2:
+				pair = 1
+	return 13 - kinds - pair
+
+def shanten_of_counts(counts, sets):
+	""" Returns shanten number, 0 is tenpai, -1 is complete hand """
+	shanten = regular_shanten(counts, len(sets))
+	if not sets:
+		shanten = min(shanten, seven_pairs_shanten(counts), kokushi_shanten(counts))
+	return shanten
+
+def hand_shanten(hand, sets):
+	return shanten_of_counts(tiles_to_counts(hand), sets)
+
+def riichi_discards(hand, sets):
+	""" Returns dictionary: discarded tile -> list of waiting tiles, for every discard
+		that leaves hand in tenpai. Function work with 14 tiles hand """
+	result = {}
+	if is_hand_open(sets):
+		return result
+
+	counts = tiles_to_counts(hand)
+	# Shanten of 14 tiles is the best shanten after one discard
+	if shanten_of_counts(counts, sets) > 0:
+		return result
+
+	for i in xrange(TILES_COUNT):
+		if counts[i]:
+			counts[i] -= 1
+			waiting = find_waiting_ids(counts, sets)
+			counts[i] += 1
+			if waiting:
+				result[tiles_by_id[i]] = [ tiles_by_id[j] for j in waiting ]
+	return result
 
-	for tile in set(hand):
-		h = copy(hand)
-		h.remove(tile)
-		if hand_in_tenpai(h, sets):
-			return True
-	return False
+def riichi_test(hand, sets):
+	return len(riichi_discards(hand, sets)) > 0
 
 def hand_in_tenpai(hand, sets):
 	""" Check if hand is in tenpai. Function work with 13 tiles hand """
-	return len(find_waiting_tiles(hand, sets)) > 0
+	return len(find_waiting_ids(tiles_to_counts(hand), sets)) > 0
 
 def find_waiting_tiles(hand, sets):
 	""" Returns tiles that forming hand. Function work with 13 tiles hand """
-
+	return [ tiles_by_id[i] for i in find_waiting_ids(tiles_to_counts(hand), sets) ]
+
+# Waiting tiles depend only on tiles in hand and on the number of sets,
+# so (counts, number of sets) is used as the key
+waiting_cache = LRUCache(4096)
+
+def find_waiting_ids(counts, sets):
+	""" Returns tuple of ids of tiles that forming hand. Function work with 13 tiles hand """
+	key = (tuple(counts), len(sets))
+	ids = waiting_cache.get(key)
+	if ids is None:
+		ids = tuple(compute_waiting_ids(counts, sets))
+		waiting_cache.put(key, ids)
+	return ids
+
+def compute_waiting_ids(counts, sets):
+	""" Regular waits are looked up in the agari table, special hands are tested directly """
+	seven_pairs = []
 	if not sets:
-		# Seven pairs
-		counts = tile_counts(hand)
-		if len(counts[1]) == 1 and len(counts[2]) == 6:
-			return counts[1]
-
-	tiles = []
-	for tile in all_tiles:
-		h = hand + [tile]
-
-		if score_special_nine_lanterns(h):
-			tiles.append(tile)
-			continue
-
-		if score_special_kokushi_musou(h):
-			tiles.append(tile)
-			continue
-
-		for pair, rest in detect_pairs(h):
-			if find_sets(rest, sets):
-				tiles.append(tile)
-		
-	return tiles
-
-def check_single_waiting(hand, sets):
-	""" Hand is 14-tile hand, assuming last tile is last tile in 'hand', specials hand is not handled """
-	last_tile = hand[-1]
-
-	for pair, rest in detect_pairs(hand):
-		s = find_sets(rest, sets)
-		if s:
-			if last_tile == pair:
-				return True
-			for set in s:
-				if set.is_chi():
-					tiles = set.tiles()
-					if tiles[1] == last_tile or (last_tile.is_terminal() and (tiles[0] == last_tile or tiles[2] == last_tile)):
-						return True
-					if (tiles[0].is_terminal() and tiles[2] == last_tile) or (tiles[2].is_terminal() and tiles[0] == last_tile):
-						return True
-	return False				
-
-
+		d = tile_counts(counts)
+		if len(d[1]) == 1 and len(d[2]) == 6:
+			seven_pairs = list(d[1])
+
+	# Nine lanterns is always complete hand, so it need not to be tested
+	ids = completing_ids(counts)
+	for i in seven_pairs:
+		if i not in ids:
+			ids.append(i)
+	if not sets and kokushi_shanten(counts) == 0:
+		for i in xrange(TILES_COUNT):
+			if i not in ids and counts[i] < 4:
+				counts[i] += 1
+				if score_special_kokushi_musou(counts):
+					ids.append(i)
+				counts[i] -= 1
+	ids.sort()
+	return ids
+
+
+class Claims:
+
+	""" What a player can do with a discarded tile. 'ron_yaku' is True when
+		the completed hand has yaku without specials (riichi, ...) """
+
+	def __init__(self, pon, kan, chi, waiting, ron_yaku):
+		self.pon = pon
+		self.kan = kan
+		self.chi = chi
+		self.waiting = waiting
+		self.ron_yaku = ron_yaku
+
+no_claims = Claims(False, False, [], False, False)
+
+def build_claims(counts, sets, waiting, round_wind, player_wind):
+	""" Returns dictionary: tile id -> Claims, tiles without any claim are omitted """
+	hand = counts_to_tiles(counts)
+	claims = {}
+	for tile in tiles_by_id:
+		i = tile.id
+		chi = potential_chi_of_counts(counts, tile)
+		if counts[i] >= 2 or chi or i in waiting:
+			ron_yaku = i in waiting and \
+				count_of_tiles_yaku(hand + [ tile ], sets, [], round_wind, player_wind, "Ron") > 0
+			claims[i] = Claims(counts[i] >= 2, counts[i] >= 3, chi, i in waiting, ron_yaku)
+	return claims
+
+
+class WaitingTracker:
+
+	"""
+		Keeps counts of tiles in player's hand and tiles that complete the hand.
+		Hand has to be updated through add_tile/remove_tile.
+		'version' is increased by every change of the hand or sets.
+
+		When a tile is added (draw, steal for Ron), 'waiting' still describes
+		the hand before the tile was added, so is_complete() is a lookup.
+	"""
+
+	def __init__(self):
+		self.version = 0
+		self.reset([], [])
+
+	def reset(self, hand, sets):
+		""" 'sets' is the list of player's sets, it is used as reference """
+		self.version += 1
+		self.counts = tiles_to_counts(hand)
+		self.sets = sets
+		self.waiting = None
+		self.waiting_mask = 0
+		self.last_tile_id = None
+		self.claims = None
+
+	def add_tile(self, tile):
+		self.get_waiting()
+		self.version += 1
+		self.counts[tile.id] += 1
+		self.last_tile_id = tile.id
+		self.claims = None
+
+	def remove_tile(self, tile):
+		self.version += 1
+		self.counts[tile.id] -= 1
+		self.waiting = None
+		self.last_tile_id = None
+		self.claims = None
+
+	def sets_changed(self):
+		self.version += 1
+		self.waiting = None
+		self.last_tile_id = None
+		self.claims = None
+
+	def update(self):
+		""" Recomputes waiting tiles, it is called after discard """
+		if sum(self.counts) % 3 == 1:
+			self.waiting = frozenset(find_waiting_ids(self.counts, self.sets))
+		else:
+			self.waiting = frozenset()
+		self.waiting_mask = 0
+		for i in self.waiting:
+			self.waiting_mask |= 1 << i
+
+	def get_waiting(self):
+		""" Returns set of ids of tiles that complete the hand """
+		if self.waiting is None:
+			self.update()
+		return self.waiting
+
+	def get_waiting_mask(self):
+		""" Returns waiting tiles as bitset of ids """
+		self.get_waiting()
+		return self.waiting_mask
+
+	def is_waiting_for(self, tile):
+		return tile.id in self.get_waiting()
+
+	def is_complete(self):
+		""" True if the last added tile completes the hand """
+		return self.last_tile_id is not None and self.last_tile_id in self.waiting
+
+	def get_claims(self, tile, round_wind, player_wind):
+		""" Returns Claims of tile discarded by other player. The claim index
+			of the hand is built on the first call after the hand is changed """
+		if self.claims is None:
+			self.claims = build_claims(self.counts, self.sets, self.get_waiting(), round_wind, player_wind)
+		return self.claims.get(tile.id, no_claims)
@@ -0,0 +1,106 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Generates agari.dat (see agari.py)
+	Usage: python gen_agari.py [output_file]
+"""
+
+import sys
+import collections
+import itertools
+from agari import AGARI_FILE, MAX_PATTERN_TILES, PATTERNS_COUNT, encode_decomposition, encode_entry, write_table
+
+# Melds in single suit: (position, is_chi)
+suit_melds = [ (p, False) for p in xrange(9) ] + [ (p, True) for p in xrange(7) ]
+
+
+def add_meld(counts, meld):
+	position, is_chi = meld
+	if is_chi:
+		for p in xrange(position, position + 3):
+			counts[p] += 1
+	else:
+		counts[position] += 3
+
+def meld_combinations(start, count):
+	""" Multisets of 'count' melds taken from suit_melds[start:] """
+	if count == 0:
+		yield []
+		return
+	for i in xrange(start, len(suit_melds)):
+		for rest in meld_combinations(i, count - 1):
+			yield [ suit_melds[i] ] + rest
+
+def generate_decompositions():
+	""" Returns dictionary: counts of suit (tuple) -> list of decomposition codes.
+		Only complete patterns are included, the empty suit has one empty decomposition. """
+	decompositions = collections.defaultdict(list)
+	for melds_count in xrange(5):
+		for melds in meld_combinations(0, melds_count):
+			for pair in [ None ] + range(9):
+				counts = [ 0 ] * 9
+				for meld in melds:
+					add_meld(counts, meld)
+				if pair is not None:
+					counts[pair] += 2
+				if max(counts) > 4:
+					continue
+				# Melds are ordered by tile, pons before chis of the same tile
+				melds = sorted(melds, key = lambda m: (m[0], m[1]))
+				decompositions[tuple(counts)].append((pair, melds))
+
+	table = {}
+	for counts, items in decompositions.items():
+		items.sort()
+		table[counts] = [ encode_decomposition(pair, melds) for pair, melds in items ]
+	return table
+
+def pattern_waits(counts, decompositions):
+	""" Bitmask of positions where added tile makes complete pattern """
+	waits = 0
+	if sum(counts) < MAX_PATTERN_TILES:
+		for position in xrange(9):
+			if counts[position] < 4:
+				completed = counts[:position] + (counts[position] + 1,) + counts[position + 1:]
+				if completed in decompositions:
+					waits |= 1 << position
+	return waits
+
+def generate_table():
+	""" Returns (entries, codes), entries are in order of agari.suit_index """
+	decompositions = generate_decompositions()
+	entries = []
+	codes = []
+	# Lexicographic order of patterns is the order of suit_index
+	for counts in itertools.product(xrange(5), repeat = 9):
+		if sum(counts) > MAX_PATTERN_TILES:
+			continue
+		items = decompositions.get(counts, ())
+		entries.append(encode_entry(pattern_waits(counts, decompositions), len(codes), len(items)))
+		codes.extend(items)
+	assert len(entries) == PATTERNS_COUNT
+	return entries, codes
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1:
+		filename = sys.argv[1]
+	else:
+		filename = AGARI_FILE
+	entries, codes = generate_table()
+	write_table(entries, codes, filename)
+	print "Written %i suit patterns into %s" % (len(entries), filename)
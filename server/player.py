@@ -15,11 +15,12 @@
 # <http://www.gnu.org/licenses/>.
 
 import logging
+import itertools
 from copy import copy
 
 from connection import ConnectionClosed
-from tile import Tile, Pon, Chi, Kan
-from eval import count_of_tiles_yaku, find_potential_chi, hand_in_tenpai, riichi_test
+from tile import Tile, Pon, Chi, Kan, UnknownTile
+from eval import count_of_tiles_yaku, riichi_discards, WaitingTracker
 from botengine import BotEngine
 
 class Player:
@@ -32,16 +33,27 @@ class Player:
 		self.drop_zone = []
 		self.sets = []
 		self.riichi = False
+		self.riichi_discards = {}
+		self.hand_actions_key = None
 		self.ippatsu_move_id = 0
 		self.kan_played = False
+		self.discarded_mask = 0
+		self.ron_passed = False
+		self.riichi_furiten = False
+		self.waiting_tracker = WaitingTracker()
 
 	def player_round_reset(self):
 		self.drop_zone = []
 		self.sets = []
 		self.can_drop_tile = False
 		self.riichi = False
+		self.riichi_discards = {}
+		self.hand_actions_key = None
 		self.ippatsu_move_id = 0
 		self.kan_played = False
+		self.discarded_mask = 0
+		self.ron_passed = False
+		self.riichi_furiten = False
 
 	def set_neighbours(self, left, right, across):
 		self.left_player = left
@@ -54,6 +66,7 @@ class Player:
 	def set_round(self, round, hand):
 		self.round = round
 		self.hand = hand
+		self.waiting_tracker.reset(hand, self.sets)
 
 	def is_dealer(self):
 		return self.wind.name == "WE"
@@ -64,6 +77,11 @@ class Player:
 
 	def new_hand_tile(self, tile):
 		self.hand.append(tile)
+		self.waiting_tracker.add_tile(tile)
+
+	def remove_hand_tile(self, tile):
+		self.hand.remove(tile)
+		self.waiting_tracker.remove_tile(tile)
 
 	def move(self, tile):
 		self.new_hand_tile(tile)
@@ -100,11 +118,27 @@ class Player:
 		return not self.riichi and self.round.get_remaining_tiles_in_wall() >= 4 and self.score >= 1000 and not self.is_hand_open()
 
 	def hand_actions(self):
+		""" Returns possible actions with hand. It also sets self.riichi_discards:
+			riichi-legal discards with their waiting tiles (kept after riichi is played).
+			The result is cached until hand, sets, riichi, score or the move changes """
+		key = (self.waiting_tracker.version, self.riichi, self.score, self.kan_played,
+			self.round.move_id, self.round.get_remaining_tiles_in_wall())
+		if key != self.hand_actions_key:
+			self.cached_hand_actions = self.compute_hand_actions()
+			self.hand_actions_key = key
+		return list(self.cached_hand_actions)
+
+	def compute_hand_actions(self):
 		options = []
-		if count_of_tiles_yaku(self.hand, self.sets, self.get_specials_yaku(), self.round.round_wind, self.wind, "Tsumo") > 0:
+		if self.waiting_tracker.is_complete() and \
+				count_of_tiles_yaku(self.hand, self.sets, self.get_specials_yaku(), self.round.round_wind, self.wind, "Tsumo") > 0:
 			options.append("Tsumo")
 
-		if self.other_condition_for_riichi() and riichi_test(self.hand, self.sets):
+		if self.other_condition_for_riichi():
+			self.riichi_discards = riichi_discards(self.hand, self.sets)
+		elif not self.riichi:
+			self.riichi_discards = {}
+		if self.riichi_discards and not self.riichi:
 			options.append("Riichi")
 
 		for tile in set(self.hand):			
@@ -118,25 +152,37 @@ class Player:
 		return options
 
 	def is_furiten(self):
-		# TODO
-		return False
+		""" Permanent furiten (waiting tile in own discards), temporary furiten (Ron was passed
+			since the last own discard) and riichi furiten (Ron was passed after riichi) """
+		if self.ron_passed or self.riichi_furiten:
+			return True
+		return self.discarded_mask & self.waiting_tracker.get_waiting_mask() != 0
+
+	def ron_chance_passed(self):
+		""" Called when player did not declare Ron on a tile that completes the hand """
+		self.ron_passed = True
+		if self.riichi:
+			self.riichi_furiten = True
 
 	def is_tenpai(self):
-		return hand_in_tenpai(self.hand, self.sets)
+		return len(self.waiting_tracker.get_waiting()) > 0
+
+	def get_claims(self, tile):
+		return self.waiting_tracker.get_claims(tile, self.round.round_wind, self.wind)
 
 	def steal_actions(self, player, tile):
+		claims = self.get_claims(tile)
 		options = []
-		if self.hand.count(tile) >= 2 and not self.riichi:
+		if claims.pon and not self.riichi:
 			options.append("Pon")
-			if self.hand.count(tile) >= 3 and not self.riichi:
+			if claims.kan:
 				options.append("Kan")
 
-		if player == self.left_player and not self.riichi:
-			if find_potential_chi(self.hand, tile):
-				options.append("Chi")
+		if player == self.left_player and not self.riichi and claims.chi:
+			options.append("Chi")
 
-		if count_of_tiles_yaku(self.hand + [ tile ], self.sets, self.get_specials_yaku(), self.round.round_wind, 
-				self.wind, "Ron") > 0 and not self.is_furiten():
+		# Specials (riichi, ...) are yaku by themselves
+		if claims.waiting and not self.is_furiten() and (claims.ron_yaku or self.get_specials_yaku()):
 			options.append("Ron")
 
 		return options
@@ -156,15 +202,15 @@ class Player:
 			self.ippatsu_move_id = -100 # Round is interrupeted
 
 		if player == self:
-			my_set = copy(opened_set)
-			my_set.closed = False
+			my_set = opened_set.with_closed(False)
 
-			tiles = my_set.tiles()
+			tiles = list(my_set.tiles())
 			tiles.remove(tile)
 			for t in tiles:
-				self.hand.remove(t)			
+				self.remove_hand_tile(t)
 	
 			self.sets.append(my_set)
+			self.waiting_tracker.sets_changed()
 			self.can_drop_tile = True
 			
 			if action == "Kan":
@@ -172,8 +218,11 @@ class Player:
 				self.kan_played = True
 
 	def drop_tile(self, tile):
-		self.hand.remove(tile)
+		self.remove_hand_tile(tile)
+		self.waiting_tracker.update()
 		self.drop_zone.append(tile)
+		self.discarded_mask |= 1 << tile.id
+		self.ron_passed = False
 		self.server.state.drop_tile(self, tile)
 		self.kan_played = False
 
@@ -192,17 +241,17 @@ class Player:
 		for s in self.sets:
 			if s.is_pon() and s.tile == tile:
 				self.sets.remove(s)
-				self.hand.remove(tile)
+				self.remove_hand_tile(tile)
 				pon_found = True
 				break
 
-		kan = Kan(tile)
-		kan.closed = not pon_found # If we add to pon, it is open kan
+		kan = Kan(tile, not pon_found) # If we add to pon, it is open kan
 		self.sets.append(kan)
 
 		if not pon_found:
 			for t in kan.tiles():
-				self.hand.remove(t)
+				self.remove_hand_tile(t)
+		self.waiting_tracker.sets_changed()
 
 		self.round.own_kan_played(self, kan)
 
@@ -228,11 +277,10 @@ class NetworkPlayer(Player):
 				self.process_message(message)
 				message = self.connection.read_message()
 		except ConnectionClosed, e:
+			self.server.reactor.remove_reader(self.connection)
+			self.connection.close()
 			self.server.player_leaved(self)
 
-	def tick(self):
-		self.process_messages()
-
 	def round_is_ready(self):
 		Player.round_is_ready(self)
 		msg = {}
@@ -252,23 +300,43 @@ class NetworkPlayer(Player):
 		msg["hand"] = " ".join( [ tile.name for tile in self.hand ] )
 		self.connection.send_dict(msg)
 
+	def add_hand_actions(self, msg):
+		""" Adds possible actions and riichi-legal discards (with their waiting tiles) into message """
+		msg["actions"] = ";".join(self.hand_actions())
+		if self.riichi:
+			discards = []
+		else:
+			discards = sorted(self.riichi_discards.items())
+		msg["riichi_discards"] = ";".join([ tile.name + ":" + " ".join([ t.name for t in waiting ])
+			for tile, waiting in discards ])
+
 	def move(self, tile):
 		Player.move(self, tile)
-		actions = ";".join(self.hand_actions())
-		self.connection.send_message(message = "MOVE", tile = tile.name, actions = actions)
+		msg = { "message" : "MOVE", "tile" : tile.name }
+		self.add_hand_actions(msg)
+		self.connection.send_dict(msg)
 
 	def other_move(self, player):
 		Player.other_move(self, player)
 		self.connection.send_message(message = "OTHER_MOVE", wind = player.wind.name)
 
 	def process_message(self, message):
+		self.server.received_messages += 1
 		name = message["message"]
 
 		if name == "DROP":
 			if not self.can_drop_tile:
 				return
+			tile = self.message_tile(message["tile"])
+			if tile is None:
+				return
+			if tile not in self.hand:
+				logging.error("Discard %s is not in hand" % tile)
+				return
+			if self.riichi_played_this_turn() and tile not in self.riichi_discards:
+				logging.error("Discard %s is not allowed after riichi" % tile)
+				return
 			self.can_drop_tile = False
-			tile = Tile(message["tile"])
 			self.drop_tile(tile)
 			logging.debug("%s: Discarded Tile: %s" % (self, tile))
 			return
@@ -280,11 +348,16 @@ class NetworkPlayer(Player):
 		if name == "STEAL":
 			action = message["action"]
 			if "chi_choose" in message:
-				chi_tile = Tile(message["chi_choose"])
+				chi_tile = self.message_tile(message["chi_choose"])
+				if chi_tile is None:
+					return
 				for s, marker in self.potential_chi:
 					if marker == chi_tile:
 						opened_set = s
 						break
+				else:
+					logging.error("Chi %s is not possible" % chi_tile)
+					return
 			elif action == "Pon":
 				opened_set = Pon(self.steal_tile)
 			else:
@@ -311,7 +384,12 @@ class NetworkPlayer(Player):
 			return
 
 		if name == "KAN":
-			tile = Tile(message["tile"])
+			tile = self.message_tile(message["tile"])
+			if tile is None:
+				return
+			if not self.can_drop_tile or "Kan " + tile.name not in self.hand_actions():
+				logging.error("Kan is not allowed")
+				return
 			self.play_own_kan(tile)
 			return
 
@@ -320,6 +398,14 @@ class NetworkPlayer(Player):
 		print s
 		logging.error(s)
 
+	def message_tile(self, name):
+		""" Returns tile of name received from client, None if the name is unknown """
+		try:
+			return Tile(name)
+		except UnknownTile:
+			logging.error("Unknown tile %s from player: %s" % (repr(name), self.name))
+			return None
+
 	def own_kan_played_by_me(self, kan, new_tile, dora_indicator):
 		Player.own_kan_played_by_me(self, kan, new_tile, dora_indicator)
 		msg = {}
@@ -328,7 +414,7 @@ class NetworkPlayer(Player):
 		msg["player"] = self.wind.name
 		msg["new_tile"] = new_tile.name
 		msg["dora_indicator"] = dora_indicator.name
-		msg["actions"] = ";".join(self.hand_actions())
+		self.add_hand_actions(msg)
 		self.connection.send_dict(msg)
 
 	def own_kan_played_by_other(self, player, kan, dora_indicator):
@@ -350,7 +436,7 @@ class NetworkPlayer(Player):
 		if actions:
 			self.steal_tile = tile
 			if "Chi" in actions:
-				self.potential_chi = find_potential_chi(self.hand, tile)
+				self.potential_chi = self.get_claims(tile).chi
 				choose_tiles = [ t.name for set, t in self.potential_chi ]
 				chi_choose = ";".join(choose_tiles)
 			actions.append("Pass")
@@ -418,15 +504,16 @@ class NetworkPlayer(Player):
 			msg["dora_indicator"] = dora_indicator.name
 			if player == self:
 				msg["new_tile"] = new_tile.name
-				msg["actions"] = ";".join(self.hand_actions())
+				self.add_hand_actions(msg)
 
 		self.connection.send_dict(msg)
 
 	def server_quit(self):
-		pass
+		self.server.reactor.remove_reader(self.connection)
+		self.connection.close()
 
 
-bot_names = (name for name in [ "Panda", "Saki", "Yogi" ])
+bot_names = itertools.cycle([ "Panda", "Saki", "Yogi" ])
 
 
 class BotPlayer(Player):
@@ -435,12 +522,20 @@ class BotPlayer(Player):
 		Player.__init__(self, server, bot_names.next())
 		self.engine = BotEngine()
 		self.action = None
+		server.reactor.add_reader(self.engine, server.guard(self.engine_ready))
 
-	def tick(self):
-		if self.action:
+	def engine_ready(self):
+		if not self.engine.read_available():
+			logging.error("Bot engine of %s terminated" % self.name)
+			self.server.reactor.remove_reader(self.engine)
+			self.server.player_leaved(self)
+			return
+		# Action can set another action that is answered by lines already read
+		while self.action and self.engine.has_line():
 			self.action()
 
 	def server_quit(self):
+		self.server.reactor.remove_reader(self.engine)
 		self.engine.shutdown()
 
 	def move(self, tile):
@@ -473,7 +568,7 @@ class BotPlayer(Player):
 					for t in h:
 						if t in target:
 							target.remove(t)
-					if len(target) == 1 and self.round.hidden_tiles_for_player(self).count(target[0]) > 1 and hand_in_tenpai(h, self.sets): 
+					if len(target) == 1 and self.round.hidden_tiles_for_player(self).count(target[0]) > 1 and tile in self.riichi_discards: 
 						# If target is 1 tile away and this tile is more then 1 in "game"
 						self.play_riichi()
 				self.drop_tile(tile)
@@ -503,7 +598,7 @@ class BotPlayer(Player):
 				if "Pon" in actions:
 					sets.append(Pon(tile))
 				if "Chi" in actions:
-					sets += [ set for set, t in find_potential_chi(self.hand, tile) ]
+					sets += [ set for set, t in self.get_claims(tile).chi ]
 				self._set_basic_state()
 				self.engine.question_steal(tile, sets)
 				self.action = self.action_steal
@@ -0,0 +1,253 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	Event loop of the server. It sleeps until some registered file (socket,
+	pipe of bot) is readable (or writable) or until the next timer expires
+	and then calls the callbacks. select.epoll is used when it is available (Linux),
+	select.select otherwise.
+
+	Coroutines are generators run by Task. A coroutine yields Future (or
+	another coroutine) and it is resumed with its result when it is done.
+	A coroutine returns value by raising Return(value).
+"""
+
+import time
+import types
+import errno
+import heapq
+import select
+import itertools
+
+
+class Timer:
+
+	def __init__(self, deadline, callback):
+		self.deadline = deadline
+		self.callback = callback
+
+	def cancel(self):
+		self.callback = None
+
+
+class Return(Exception):
+
+	def __init__(self, value = None):
+		Exception.__init__(self, value)
+		self.value = value
+
+
+class Future:
+
+	def __init__(self):
+		self.done = False
+		self.result = None
+		self.exception = None
+		self.callbacks = []
+
+	def add_done_callback(self, callback):
+		""" callback(future) is called when result is set, immediately if it is already set """
+		if self.done:
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def set_result(self, result):
+		self.result = result
+		self._finish()
+
+	def set_exception(self, exception):
+		self.exception = exception
+		self._finish()
+
+	def _finish(self):
+		self.done = True
+		callbacks = self.callbacks
+		self.callbacks = []
+		for callback in callbacks:
+			callback(self)
+
+
+class Task(Future):
+
+	""" Runs coroutine, every step is called from the reactor loop. Exception of task
+		that nobody waits for is raised from the reactor loop. """
+
+	def __init__(self, reactor, coroutine):
+		Future.__init__(self)
+		self.reactor = reactor
+		self.coroutine = coroutine
+		reactor.call_soon(lambda: self.step(None, None))
+
+	def step(self, value, exception):
+		try:
+			if exception is None:
+				yielded = self.coroutine.send(value)
+			else:
+				yielded = self.coroutine.throw(exception)
+		except StopIteration:
+			self.set_result(None)
+			return
+		except Return, e:
+			self.set_result(e.value)
+			return
+		except Exception, e:
+			if not self.callbacks:
+				raise
+			self.set_exception(e)
+			return
+
+		if isinstance(yielded, types.GeneratorType):
+			yielded = Task(self.reactor, yielded)
+		yielded.add_done_callback(self.wakeup)
+
+	def wakeup(self, future):
+		self.reactor.call_soon(lambda: self.step(future.result, future.exception))
+
+
+class Reactor:
+
+	def __init__(self):
+		self.readers = {} # fd -> callback
+		self.writers = {} # fd -> callback
+		self.timers = [] # heap of (deadline, sequence number, timer)
+		self.sequence = itertools.count()
+		if hasattr(select, "epoll"):
+			self.epoll = select.epoll()
+		else:
+			self.epoll = None
+
+	def add_reader(self, fileobj, callback):
+		""" Calls callback() whenever fileobj (object with fileno()) is readable """
+		self._add(self.readers, fileobj.fileno(), callback)
+
+	def remove_reader(self, fileobj):
+		self._remove(self.readers, fileobj.fileno())
+
+	def add_writer(self, fileobj, callback):
+		""" Calls callback() whenever fileobj (object with fileno()) is writable """
+		self._add(self.writers, fileobj.fileno(), callback)
+
+	def remove_writer(self, fileobj):
+		self._remove(self.writers, fileobj.fileno())
+
+	def _add(self, callbacks, fd, callback):
+		registered = fd in self.readers or fd in self.writers
+		callbacks[fd] = callback
+		self._update_epoll(fd, registered)
+
+	def _remove(self, callbacks, fd):
+		if fd in callbacks:
+			del callbacks[fd]
+			self._update_epoll(fd, True)
+
+	def _update_epoll(self, fd, registered):
+		if not self.epoll:
+			return
+		events = 0
+		if fd in self.readers:
+			events |= select.EPOLLIN
+		if fd in self.writers:
+			events |= select.EPOLLOUT
+		if not registered:
+			self.epoll.register(fd, events)
+		elif events:
+			self.epoll.modify(fd, events)
+		else:
+			self.epoll.unregister(fd)
+
+	def call_later(self, delay, callback):
+		""" Returns Timer, callback is called once after 'delay' seconds unless the timer is canceled """
+		timer = Timer(time.time() + delay, callback)
+		heapq.heappush(self.timers, (timer.deadline, self.sequence.next(), timer))
+		return timer
+
+	def call_soon(self, callback):
+		return self.call_later(0, callback)
+
+	def sleep(self, delay):
+		""" Returns Future that is done after 'delay' seconds """
+		future = Future()
+		self.call_later(delay, lambda: future.set_result(None))
+		return future
+
+	def spawn(self, coroutine):
+		return Task(self, coroutine)
+
+	def next_timeout(self, timeout = None):
+		""" Returns time to the next timer limited by timeout, None means wait forever """
+		while self.timers and self.timers[0][2].callback is None:
+			heapq.heappop(self.timers)
+		if not self.timers:
+			return timeout
+		delay = max(0, self.timers[0][0] - time.time())
+		if timeout is None:
+			return delay
+		return min(delay, timeout)
+
+	def run_once(self, timeout = None):
+		""" Waits at most 'timeout' seconds (None = until some event) and calls callbacks
+			of writable and readable files and expired timers """
+		readable, writable = self._poll(self.next_timeout(timeout))
+		for fd in writable:
+			# Callback may be removed by previous callback
+			callback = self.writers.get(fd)
+			if callback:
+				callback()
+		for fd in readable:
+			callback = self.readers.get(fd)
+			if callback:
+				callback()
+
+		now = time.time()
+		while self.timers and self.timers[0][0] <= now:
+			deadline, sequence, timer = heapq.heappop(self.timers)
+			if timer.callback:
+				callback = timer.callback
+				timer.callback = None
+				callback()
+
+	def run(self, is_finished):
+		""" Runs the loop until is_finished() returns True """
+		while not is_finished():
+			self.run_once()
+
+	def close(self):
+		if self.epoll:
+			self.epoll.close()
+
+	def _poll(self, timeout):
+		""" Returns lists of readable and writable fds """
+		try:
+			if self.epoll:
+				if timeout is None:
+					timeout = -1
+				events = self.epoll.poll(timeout)
+				# Errors and hangups are reported to both sides
+				readable = [ fd for fd, event in events if event & ~select.EPOLLOUT ]
+				writable = [ fd for fd, event in events
+					if event & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP) ]
+				return readable, writable
+			if not self.readers and not self.writers and timeout is not None:
+				# select.select on empty lists fails on some systems
+				time.sleep(timeout)
+				return [], []
+			readable, writable, errors = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+			return readable, writable
+		except (IOError, select.error), e:
+			if e.args[0] == errno.EINTR:
+				return [], []
+			raise
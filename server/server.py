@@ -15,84 +15,117 @@
 # <http://www.gnu.org/licenses/>.
 
 
-import time
 import sys
 import logging
+import itertools
 
-from states import LobbyState, ScoreState
-from player import BotPlayer
-from game import Game
+from states import LobbyState, AsyncLobbyState
+from table import Table
+from reactor import Reactor
+
+# Period of logging metrics of all tables (in seconds) when more tables are hosted
+METRICS_INTERVAL = 60
 
 class Server:
 
-	def __init__(self, port, count_of_network_players):
+	def __init__(self, port, count_of_network_players, coroutines = False, multiple_tables = False):
+		""" With 'coroutines' every connection is served by its own coroutine (AsyncLobbyState).
+			Without 'multiple_tables' the lobby is closed when the first table is full
+			and the server exits at the end of its game. With 'multiple_tables'
+			new players are seated at new tables until the server is stopped. """
 		logging.info("Starting server on port " + str(port))
-		self.players = []
-		for i in xrange(4 - count_of_network_players):
-			self.players.append(BotPlayer(self))
-			logging.info("Added bot " + self.players[-1].name)
+		self.reactor = Reactor()
+		self.count_of_network_players = count_of_network_players
+		self.multiple_tables = multiple_tables
+		self.table_ids = itertools.count(1)
+		self.tables = []
+
+		# Metrics
+		self.started_tables = 0
+		self.failed_tables = 0
+		self.closed_tables = 0
+
+		self.new_open_table()
 
 		self.exit_flag = False
-		self.game = None
-		self.round = None
-		self.state = LobbyState(self, port)
+		if coroutines:
+			self.state = AsyncLobbyState(self, port)
+		else:
+			self.state = LobbyState(self, port)
 		self.state.enter_state()
-
-	def set_state(self, state):
+		if multiple_tables:
+			self.reactor.call_later(METRICS_INTERVAL, self.log_metrics)
+
+	def new_open_table(self):
+		""" Creates table where new players are seated """
+		self.open_table = Table(self, self.table_ids.next(), self.count_of_network_players)
+		self.tables.append(self.open_table)
+		logging.info("Table %i opened" % self.open_table.id)
+
+	def start_table(self, table):
+		""" Starts the game of the full open table """
+		self.started_tables += 1
+		if self.multiple_tables:
+			self.new_open_table()
+		else:
+			self.open_table = None
+			self.close_lobby()
+		table.start_game()
+
+	def table_closed(self, table):
+		self.tables.remove(table)
+		self.closed_tables += 1
+		if table.failed:
+			self.failed_tables += 1
+		if table is self.open_table:
+			# Bots of the open table are broken, start again
+			self.new_open_table()
+		elif self.state is None and not self.tables:
+			self.set_exit_flag()
+
+	def close_lobby(self):
 		self.state.leave_state()
-		self.state = state
-		self.state.enter_state()
+		self.state = None
 
 	def set_exit_flag(self):
 		self.exit_flag = True
 
-	def start_new_game(self):
-		self.game = Game(self.players, None)
-
-	def start_new_round(self, rotate_players, prev_riichi_bets = 0):
-		self.round = self.game.new_round(rotate_players, prev_riichi_bets)
-
-	def add_player(self, player):
-		self.players.append(player)
-
-	def remove_player(self, player):
-		self.players.remove(player)
+	def get_metrics(self):
+		return {
+			"tables" : len(self.tables),
+			"started_tables" : self.started_tables,
+			"closed_tables" : self.closed_tables,
+			"failed_tables" : self.failed_tables,
+			"table_metrics" : [ table.get_metrics() for table in self.tables ],
+		}
 
-	def player_leaved(self, player):
-		self.state.player_leaved(player)
-		self.remove_player(player)
-	
-	def player_tick(self):
-		for player in self.players[:]:
-			player.tick()
+	def log_metrics(self):
+		logging.info("Metrics: %s" % self.get_metrics())
+		self.reactor.call_later(METRICS_INTERVAL, self.log_metrics)
 
 	def run(self):
+		""" Sockets of players, pipes of bots and the listening socket
+			are watched by the reactor, nothing is polled """
 		try:
-			while not self.exit_flag:
-				self.state.tick()
-				self.player_tick()
-				time.sleep(0.07)
+			self.reactor.run(lambda: self.exit_flag)
 		finally:
 			self.server_quit()
 
 	def server_quit(self):
-		for player in self.players:
-			player.server_quit()
-
-	def declare_win(self, player, looser, wintype):
-		self.set_state(ScoreState(self, player, looser, wintype))
-
-	def player_is_ready(self, player):
-		self.state.player_is_ready(player)
-
-	def player_try_steal_tile(self, player, action, opened_set):
-		self.state.player_try_steal_tile(player, action, opened_set)
-
-if len(sys.argv) == 1:
-	print "Usage:", sys.argv[0], "<number_of_players>"
-else:
-	logging.basicConfig(filename = "server.log", format = "%(asctime)s - %(levelname)s - %(message)s", level = logging.DEBUG)
-	server = Server(4500, int(sys.argv[1]))
-	sys.stdout.write("Init done\n")
-	sys.stdout.flush()
-	server.run()
+		if self.state:
+			self.close_lobby()
+		self.open_table = None
+		for table in self.tables[:]:
+			table.close()
+		self.reactor.close()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 1:
+		print "Usage:", sys.argv[0], "<number_of_players> [--async] [--tables]"
+	else:
+		logging.basicConfig(filename = "server.log", format = "%(asctime)s - %(levelname)s - %(message)s", level = logging.DEBUG)
+		server = Server(4500, int(sys.argv[1]), "--async" in sys.argv[2:], "--tables" in sys.argv[2:])
+		sys.stdout.write("Init done\n")
+		sys.stdout.flush()
+		server.run()
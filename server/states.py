@@ -17,13 +17,19 @@
 import logging
 from message import check_message
 from player import NetworkPlayer
-from connection import Connection
-from dictprotocol import DictProtocol
+from connection import Connection, ConnectionClosed
+from dictprotocol import DictProtocol, AsyncDictProtocol
 from tile import Chi, Pon
 from eval import find_potential_chi
 
+def is_login(msg):
+	return check_message(msg, "LOGIN") and msg.has_key("user_name")
+
+
 class LobbyState:
 
+	""" Accepts connections and seats logged players at the open table of the server """
+
 	def __init__(self, server, port):
 		self.server = server
 		self.port = port
@@ -32,53 +38,134 @@ class LobbyState:
 		self.listen_connection = Connection()
 		self.listen_connection.bind_and_listen(self.port, True)
 		self.connections = []
+		self.server.reactor.add_reader(self.listen_connection, self.try_new_connections)
 
 	def leave_state(self):
+		self.server.reactor.remove_reader(self.listen_connection)
 		self.listen_connection.close()
 		self.listen_connection = None
 
 		for conn in self.connections:
+			self.server.reactor.remove_reader(conn)
 			conn.close()
 		self.connections = []
 
-	def process_messages(self):
-		for connection in self.connections[:]:
+	def process_connection(self, connection):
+		""" Broken connection or login closes only this connection """
+		try:
 			msg = connection.read_message()
-			if msg:
-				self.connections.remove(connection)
-				if check_message(msg, "LOGIN"):
-					self.new_player(connection, msg)
-				else:
-					connection.close()
+			if msg is not None:
+				self.login(connection, msg)
+		except ConnectionClosed:
+			self.drop_connection(connection)
+		except Exception:
+			logging.exception("Login failed")
+			self.drop_connection(connection)
+
+	def login(self, connection, msg):
+		self.server.reactor.remove_reader(connection)
+		self.connections.remove(connection)
+		if not is_login(msg):
+			connection.close()
+			return
+		player = self.new_player(connection, msg)
+		table = player.server
+		process_messages = table.guard(player.process_messages)
+		self.server.reactor.add_reader(connection, process_messages)
+		table.guard(lambda: self.check_players(table))()
+		# Messages received together with LOGIN are already buffered
+		process_messages()
+
+	def drop_connection(self, connection):
+		self.server.reactor.remove_reader(connection)
+		if connection in self.connections:
+			self.connections.remove(connection)
+		connection.close()
 
 	def try_new_connections(self):
 			conn = self.listen_connection.accept()
 			if conn:
+				conn.set_nonblocking(self.server.reactor)
 				dp = DictProtocol(conn)
 				self.connections.append(dp)
+				self.server.reactor.add_reader(dp, lambda: self.process_connection(dp))
 				logging.info("New peer: " + str(conn.get_peer_name()))
 
 		
 	def new_player(self, connection, msg):
-		logging.info("New network player: " + msg["user_name"])
+		table = self.server.open_table
+		logging.info("New network player: %s (table %i)" % (msg["user_name"], table.id))
 		connection.send_message(message="WELCOME", version = "0.0")
-		player = NetworkPlayer(self.server, msg["user_name"], connection)
-		self.server.add_player(player)
+		player = NetworkPlayer(table, msg["user_name"], connection)
+		table.add_player(player)
+		return player
 
-		if len(self.server.players) == 4:
-			self.init_game()
+	def check_players(self, table):
+		if table.is_full():
+			self.server.start_table(table)
 
-	def init_game(self):
-		self.server.start_new_game()
-		self.server.start_new_round(False)
-		self.server.set_state(PlayerMoveState(self.server, self.server.round.get_dealer()))
 
-	def tick(self):
-		self.try_new_connections()
-		self.process_messages()
+class AsyncLobbyState(LobbyState):
 
-	def player_leaved(self, player):
-		logging.info("Player %s leaved" % player.name)
+	""" Lobby of the asynchronous mode, every connection is served by its own coroutine
+		(see reactor.py) from the login to the end of the game """
+
+	def leave_state(self):
+		self.server.reactor.remove_reader(self.listen_connection)
+		self.listen_connection.close()
+		self.listen_connection = None
+
+		for conn in self.connections:
+			conn.close()
+		self.connections = []
+
+	def try_new_connections(self):
+		""" All waiting connections are accepted """
+		conn = self.listen_connection.accept()
+		while conn:
+			conn.set_nonblocking(self.server.reactor)
+			protocol = AsyncDictProtocol(self.server.reactor, conn)
+			self.connections.append(protocol)
+			self.server.reactor.spawn(self.serve_connection(protocol))
+			logging.info("New peer: " + str(conn.get_peer_name()))
+			conn = self.listen_connection.accept()
+
+	def serve_connection(self, connection):
+		""" Broken connection or login closes only this connection """
+		try:
+			msg = yield connection.read_message()
+		except ConnectionClosed:
+			if connection in self.connections:
+				self.connections.remove(connection)
+				connection.close()
+			return
+
+		self.connections.remove(connection)
+		if not is_login(msg):
+			connection.close()
+			return
+
+		try:
+			player = self.new_player(connection, msg)
+		except Exception:
+			logging.exception("Login failed")
+			connection.close()
+			return
+		table = player.server
+		task = self.server.reactor.spawn(self.serve_player(player, connection))
+		task.add_done_callback(table.task_done)
+		table.guard(lambda: self.check_players(table))()
+
+	def serve_player(self, player, connection):
+		try:
+			while True:
+				msg = yield connection.read_message()
+				if player.server.closed:
+					break
+				player.process_message(msg)
+		except ConnectionClosed:
+			connection.close()
+			player.server.player_leaved(player)
 
 
 class GenericGameState:
@@ -87,10 +174,7 @@ class GenericGameState:
 		self.server = server
 
 	def player_leaved(self, player):
-		self.server.set_exit_flag()
-
-	def tick(self):
-		pass
+		self.server.close()
 
 	def enter_state(self):
 		pass
@@ -102,6 +186,14 @@ class GenericGameState:
 		pass
 
 
+class WaitingForPlayersState(GenericGameState):
+
+	""" State of table before the game, players can leave without ending the table """
+
+	def player_leaved(self, player):
+		logging.info("Player %s leaved" % player.name)
+
+
 class PlayerMoveState(GenericGameState):
 
 	def __init__(self, server, player):
@@ -151,6 +243,12 @@ class StealTileState(GenericGameState):
 			self.ready_players.append((player, action, opened_set))
 		self.check_ready_players()
 
+	def check_passed_ron(self):
+		""" Players that were waiting for the dropped tile and did not declare Ron become furiten """
+		for player, action, opened_set in self.ready_players:
+			if player != self.player and player.waiting_tracker.is_waiting_for(self.droped_tile):
+				player.ron_chance_passed()
+
 	def check_ready_players(self):
 		if len(self.ready_players) == 4:
 			players = self.player.other_players() + [ self.player ]
@@ -169,7 +267,10 @@ class StealTileState(GenericGameState):
 
 				s_player.new_hand_tile(self.droped_tile)
 				self.server.declare_win(s_player, self.player, "Ron")
-			elif self.server.round.is_draw():
+				return
+
+			self.check_passed_ron()
+			if self.server.round.is_draw():
 				self.server.set_state(DrawState(self.server))
 			elif s_action == "Pass":
 				self.server.set_state(PlayerMoveState(self.server, self.player.right_player))
@@ -0,0 +1,150 @@
+# Copyright (C) 2009 Stanislav Bohm
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""
+	One table of the server: four players, their game, round and state.
+	Players and states refer to their table as 'server'. An exception raised
+	in a callback of the table closes only this table, other tables
+	of the server keep running.
+"""
+
+import time
+import logging
+
+from states import WaitingForPlayersState, PlayerMoveState, ScoreState
+from player import BotPlayer, NetworkPlayer
+from game import Game
+
+
+class Table:
+
+	def __init__(self, server, id, count_of_network_players):
+		self.server = server
+		self.id = id
+		self.reactor = server.reactor
+		self.players = []
+		self.game = None
+		self.round = None
+		self.closed = False
+		self.failed = False
+		self.state = WaitingForPlayersState(self)
+		self.state.enter_state()
+
+		# Metrics
+		self.created_time = time.time()
+		self.start_time = None
+		self.rounds = 0
+		self.received_messages = 0
+
+		for i in xrange(4 - count_of_network_players):
+			self.players.append(BotPlayer(self))
+			logging.info("Table %i: Added bot %s" % (self.id, self.players[-1].name))
+
+	def __repr__(self):
+		return "<Table %i>" % self.id
+
+	def guard(self, callback):
+		""" Returns callback for the reactor, exception of the callback closes the table """
+		def guarded_callback():
+			if self.closed:
+				return
+			try:
+				callback()
+			except Exception:
+				self.fail()
+		return guarded_callback
+
+	def task_done(self, task):
+		""" Done callback of coroutines serving the table """
+		if task.exception is not None and not self.closed:
+			logging.error("Table %i: %s" % (self.id, repr(task.exception)))
+			self.failed = True
+			self.close()
+
+	def fail(self):
+		logging.exception("Table %i failed" % self.id)
+		self.failed = True
+		self.close()
+
+	def is_full(self):
+		return len(self.players) == 4
+
+	def start_game(self):
+		self.start_time = time.time()
+		self.game = Game(self.players, None)
+		self.start_new_round(False)
+		self.set_state(PlayerMoveState(self, self.round.get_dealer()))
+
+	def set_state(self, state):
+		self.state.leave_state()
+		self.state = state
+		self.state.enter_state()
+
+	def start_new_round(self, rotate_players, prev_riichi_bets = 0):
+		self.rounds += 1
+		self.round = self.game.new_round(rotate_players, prev_riichi_bets)
+
+	def add_player(self, player):
+		self.players.append(player)
+
+	def remove_player(self, player):
+		self.players.remove(player)
+
+	def player_leaved(self, player):
+		if self.closed:
+			return
+		self.remove_player(player)
+		self.state.player_leaved(player)
+
+	def close(self):
+		""" Disconnects all players and removes the table from the server """
+		if self.closed:
+			return
+		self.closed = True
+		for player in self.players:
+			try:
+				player.server_quit()
+			except Exception:
+				logging.exception("Table %i: Quit of player %s failed" % (self.id, player.name))
+		logging.info("Table %i closed: %s" % (self.id, self.get_metrics()))
+		self.server.table_closed(self)
+
+	def get_metrics(self):
+		now = time.time()
+		connections = [ player.connection.connection for player in self.players
+			if isinstance(player, NetworkPlayer) ]
+		return {
+			"table" : self.id,
+			"players" : [ player.name for player in self.players ],
+			"started" : self.start_time is not None,
+			"failed" : self.failed,
+			"rounds" : self.rounds,
+			"received_messages" : self.received_messages,
+			"sent_bytes" : sum(connection.sent_bytes for connection in connections),
+			"queued_bytes" : sum(connection.queued_bytes for connection in connections),
+			"max_queued_bytes" : max([ 0 ] + [ connection.max_queued_bytes for connection in connections ]),
+			"game_time" : now - self.start_time if self.start_time else 0,
+			"lifetime" : now - self.created_time,
+		}
+
+	def declare_win(self, player, looser, wintype):
+		self.set_state(ScoreState(self, player, looser, wintype))
+
+	def player_is_ready(self, player):
+		self.state.player_is_ready(player)
+
+	def player_try_steal_tile(self, player, action, opened_set):
+		self.state.player_try_steal_tile(player, action, opened_set)
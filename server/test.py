@@ -15,13 +15,30 @@
 # <http://www.gnu.org/licenses/>.
 
 
+import socket
+import logging
 import unittest
 from unittest import TestCase
+from random import Random
+from copy import copy
 
-from tile import Tile, Chi, Pon, Kan, all_tiles
-from eval import count_of_tiles_yaku, compute_payment, hand_in_tenpai, compute_score, find_tiles_yaku, riichi_test
-from eval import find_waiting_tiles, check_single_waiting
+from tile import Tile, Chi, Pon, Kan, all_tiles, tiles_by_id, tiles_to_counts, counts_to_tiles
+from tile import east_wind, south_wind, west_wind, north_wind, no_wind, UnknownTile
+from eval import count_of_tiles_yaku, compute_payment, hand_in_tenpai, compute_score, find_tiles_yaku, riichi_test, riichi_discards, is_hand_open
+from eval import find_waiting_tiles, hand_shanten, find_potential_chi, WaitingTracker
+from eval import wait_shapes, evaluate_hand, set_minipoints
+from agari import is_agari, agari_decompositions, completing_ids, load_table, suit_index, PATTERNS_COUNT, WAITS_MASK
+from gen_agari import generate_decompositions, pattern_waits
+from cache import LRUCache
+from batcheval import score_hands, encode_open_sets, yaku_names, yaku_bits
 from botengine import BotEngine
+from player import Player
+from bench import generate_corpus, run_benchmark, create_player
+from botfuzz import BotFuzzer, Case
+from reactor import Reactor, Return
+from connection import Connection, ConnectionClosed, LineTooLong
+from dictprotocol import AsyncDictProtocol
+from server import Server
 
 
 def tiles(strs):
@@ -30,25 +47,17 @@ def tiles(strs):
 
 def chi(tile_name):
 	t = Tile(tile_name)
-	chi = Chi(t, t.next_tile(), t.next_tile().next_tile())
-	chi.closed = False
-	return chi
+	return Chi(t, t.next_tile(), t.next_tile().next_tile(), False)
 
 
 def pon(tile_name):
-	pon =  Pon(Tile(tile_name))
-	pon.closed = False
-	return pon
+	return Pon(Tile(tile_name), False)
 
 def kan(tile_name):
-	kan =  Kan(Tile(tile_name))
-	kan.closed = False
-	return kan
+	return Kan(Tile(tile_name), False)
 
 def ckan(tile_name):
-	kan =  Kan(Tile(tile_name))
-	kan.closed = True
-	return kan
+	return Kan(Tile(tile_name), True)
 
 
 test_hands = [
@@ -107,9 +116,7 @@ test_hands = [
 	([ "C6", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "C2", "C2", "B6", "B7", "B9" ], [], 0), #52, Nothing
 	([ "C6", "C7", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "DR", "DR", "B6", "B7", "B8" ], [], 0), #53, Nohthing
 	([ "C6", "C7", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "C2", "C2", "B6", "B7", "B8" ], [], 0), #54, Nothing
-	([ "C6", "C7", "C8", "B7", "B8", "B9", "P2", "P3", "C2", "C2", "B3", "B4", "B5", "P1" ], [], 0), #55, Nothing
 	([ "C6", "C7", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "WW", "B6", "B7", "B8", "WW" ], [], 0), #56, Nothing
-	([ "C6", "C7", "C8", "B2", "B3", "B4", "P1", "P2", "P3", "C2", "C2", "B7", "B8", "B9" ], [], 0), #57, Nothing
 	([ "DR", "DR", "DR", "B3", "B4", "B2", "P2", "P2" ], [ ckan("DW"), pon("DG") ], 13), #58, dai-sangen
 	([ "WE", "WE", "WE", "B3", "B4", "B2", "WN", "WN" ], [ ckan("WW"), pon("WS") ], 13), #59, shou-suushi
 	([ "WE", "WE", "WE", "C9", "C9", "WN", "WN", "WN" ], [ ckan("WW"), pon("WS") ], 13), #60, dai-suushi
@@ -133,6 +140,8 @@ test_hands = [
 	([ "C6", "C7", "C8", "B6", "B7", "B8", "P6", "P7", "P8", "C2", "C2", "B6", "B7", "B8" ], [], 5), #X, Sanshoku doujun (closed), Ipeikou, Tan-Yao, Pinfu
 	([ "C6", "C7", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "C2", "C2", "B7", "B8", "B6" ], [], 1), #X, Pinfu
 	([ "C6", "C7", "C8", "B7", "B8", "B9", "P1", "P2", "P3", "C2", "C2", "C3", "C4", "C5" ], [], 1), #X, Pinfu
+	([ "C6", "C7", "C8", "B7", "B8", "B9", "P2", "P3", "C2", "C2", "B3", "B4", "B5", "P1" ], [], 1), #X, Pinfu (P2 P3 waits on P1 or P4)
+	([ "C6", "C7", "C8", "B2", "B3", "B4", "P1", "P2", "P3", "C2", "C2", "B7", "B8", "B9" ], [], 1), #X, Pinfu (B7 B8 waits on B6 or B9)
 
 
 	# -----Special hands --------- Ignored by bot eval
@@ -149,13 +158,131 @@ test_hands = [
 ]
 
 
+class TileTestCase(TestCase):
+
+	def test_tile_ids(self):
+		# Same order as in bot/tiles.h
+		self.assertEquals(Tile("DR").id, 0)
+		self.assertEquals(Tile("WN").id, 6)
+		self.assertEquals(Tile("B1").id, 7)
+		self.assertEquals(Tile("P1").id, 16)
+		self.assertEquals(Tile("C9").id, 33)
+		self.assertEquals(no_wind.id, None)
+
+	def test_interned_tiles(self):
+		self.assertTrue(Tile("B3") is Tile("B3"))
+		registry_size = len(Tile.registry)
+		for name in [ "XX", "", "Bx", "B0", "B3 " ]:
+			self.assertRaises(UnknownTile, Tile, name)
+		self.assertEquals(len(Tile.registry), registry_size)
+		self.assertTrue(tiles_by_id[Tile("P5").id] is Tile("P5"))
+		self.assertTrue(Tile("B9").next_tile() is Tile("B1"))
+		self.assertTrue(Tile("C1").prev_tile() is Tile("C9"))
+		self.assertTrue(Tile("P7").as_char() is Tile("C7"))
+		self.assertTrue(copy(Tile("WN")) is Tile("WN"))
+		self.assertTrue(Tile("B1").is_terminal())
+		self.assertFalse(Tile("DR").is_terminal())
+		self.assertTrue(Tile("C5").is_nonterminal())
+
+	def test_interned_sets(self):
+		self.assertTrue(pon("B3") is Pon(Tile("B3"), False))
+		self.assertTrue(chi("C2") is chi("C2"))
+		self.assertFalse(kan("DR") is ckan("DR"))
+		self.assertTrue(ckan("DR").with_closed(False) is kan("DR"))
+		self.assertEquals(chi("P4").tiles(), tuple(tiles([ "P4", "P5", "P6" ])))
+		self.assertEquals({ pon("WE") : 1 }.get(Pon(Tile("WE"), False)), 1)
+		self.assertTrue(copy(chi("B7")) is chi("B7"))
+		self.assertRaises(AttributeError, setattr, pon("B3"), "closed", True)
+
+	def test_counts(self):
+		hand = tiles([ "C1", "DR", "C1", "B5", "WN" ])
+		counts = tiles_to_counts(hand)
+		self.assertEquals(len(counts), 34)
+		self.assertEquals(counts[Tile("C1").id], 2)
+		self.assertEquals(sum(counts), 5)
+		self.assertEquals(counts_to_tiles(counts), tiles([ "DR", "WN", "B5", "C1", "C1" ]))
+
+
+class LRUCacheTestCase(TestCase):
+
+	def test_cache(self):
+		cache = LRUCache(2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		self.assertEquals(cache.get("a"), 1)
+		cache.put("c", 3) # "b" is removed
+		self.assertEquals(cache.get("b"), None)
+		self.assertEquals(cache.get("c"), 3)
+		self.assertEquals(cache.get("a"), 1)
+		self.assertEquals(len(cache), 2)
+		self.assertEquals((cache.hits, cache.misses), (3, 1))
+
+
+class AgariTestCase(TestCase):
+
+	def test_table_file(self):
+		decompositions = generate_decompositions()
+		table = load_table()
+		for counts, codes in decompositions.items():
+			self.assertEquals(table.decompositions(table.entry(suit_index(counts, 0))), tuple(codes))
+
+		random = Random(7)
+		for i in xrange(2000):
+			counts = tuple(tiles_to_counts(random.sample(4 * tiles_by_id[:9], random.randint(0, 14)))[:9])
+			entry = table.entry(suit_index(counts, 0))
+			self.assertEquals(entry & WAITS_MASK, pattern_waits(counts, decompositions))
+			self.assertEquals(len(table.decompositions(entry)), len(decompositions.get(counts, ())))
+
+	def test_suit_index(self):
+		self.assertEquals(suit_index([ 0 ] * 9, 0), 0)
+		self.assertEquals(suit_index([ 4, 4, 4, 2, 0, 0, 0, 0, 0 ], 0), PATTERNS_COUNT - 1)
+		self.assertEquals(suit_index([ 4, 4, 4, 3, 0, 0, 0, 0, 0 ], 0), -1)
+		self.assertEquals(suit_index([ 0, 5, 0, 0, 0, 0, 0, 0, 0 ], 0), -1)
+		# Patterns are indexed in lexicographic order
+		random = Random(8)
+		patterns = sorted(set(tuple(tiles_to_counts(random.sample(4 * tiles_by_id[:9], random.randint(0, 14)))[:9])
+			for i in xrange(2000)))
+		indexes = [ suit_index(counts, 0) for counts in patterns ]
+		self.assertEquals(indexes, sorted(set(indexes)))
+		counts = tiles_to_counts(tiles([ "P1", "P2", "P3", "C5", "C5", "C5" ]))
+		self.assertEquals(suit_index(counts, Tile("P1").id), suit_index([ 1, 1, 1, 0, 0, 0, 0, 0, 0 ], 0))
+
+	def test_agari(self):
+		self.assert_(is_agari(tiles_to_counts(tiles([ "C1", "C2", "C3", "B5", "B5", "B5", "DR", "DR", "P7", "P8", "P9", "WN", "WN", "WN" ]))))
+		self.assert_(not is_agari(tiles_to_counts(tiles([ "C1", "C2", "C3", "B5", "B5", "B5", "DR", "DR", "P7", "P8", "P9", "WN", "WN", "WS" ]))))
+		self.assert_(not is_agari(tiles_to_counts(tiles([ "C1", "C1", "C3", "C3", "B5", "B5", "DR", "DR", "P7", "P7", "P9", "P9", "WN", "WN" ]))))
+		self.assert_(is_agari(tiles_to_counts(tiles([ "B2", "B3", "B4", "B5", "B5" ]))))
+
+	def test_decompositions(self):
+		counts = tiles_to_counts(tiles([ "P1", "P1", "P1", "P2", "P2", "P2", "P3", "P3", "P3", "C5", "C6", "C7", "WN", "WN" ]))
+		self.assertEquals(len(agari_decompositions(counts)), 2)
+		counts = tiles_to_counts(tiles([ "P1", "P1", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9", "P9", "P9", "P5" ]))
+		pairs = [ pair for pair, melds in agari_decompositions(counts) ]
+		self.assertEquals(pairs, [ Tile("P5").id ])
+
+	def test_completing_ids(self):
+		random = Random(17)
+		for i in xrange(2000):
+			counts = tiles_to_counts(random.sample(4 * all_tiles, random.choice([ 1, 4, 7, 10, 13 ])))
+			expected = []
+			for j in xrange(34):
+				if counts[j] < 4:
+					counts[j] += 1
+					if is_agari(counts):
+						expected.append(j)
+					counts[j] -= 1
+			self.assertEquals(sorted(completing_ids(counts)), expected)
+		counts = tiles_to_counts(tiles([ "P1", "P1", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9", "P9", "P9" ]))
+		self.assertEquals(sorted(completing_ids(counts)), range(Tile("P1").id, Tile("P9").id + 1))
+
+
 class EvalHandTestCase(TestCase):
 
 	def test_yaku_count(self):
 		for hand_id, h in enumerate(test_hands):
 			hand, sets, r = h
-			score = count_of_tiles_yaku(tiles(hand), sets, [], Tile("XX"), Tile("XX"), "Ron")
-			yaku = find_tiles_yaku(tiles(hand), sets, [], Tile("XX"), Tile("XX"), "Ron")
+			score = count_of_tiles_yaku(tiles(hand), sets, [], no_wind, no_wind, "Ron")
+			yaku = find_tiles_yaku(tiles(hand), sets, [], no_wind, no_wind, "Ron")
 			self.assert_(score == r, "Hand %i returned score %i %s hand=%s" % (hand_id, score, yaku, hand))
 
 		hand = [ "WE", "C2", "C3", "C4", "WN", "WN", "WN", "DR", "B9", "DR", "B8", "B7", "WE", "WE" ]
@@ -212,7 +339,8 @@ class EvalHandTestCase(TestCase):
 						([ "B1", "B9", "C1", "C9", "P1", "P9", "DW", "DR", "DG", "WN", "WE", "WW", "WW"], [], True, [ "WS" ]),
 						([ "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "WN", "WN"], [ pon("P1") ], True, ["B3","B6","B9"]),
 						([ "P1", "P2", "P3", "DR", "DR", "DR", "B7", "B8", "WN", "WN"], [ pon("P1") ], True, ["B6", "B9"]),
-						([ "P1", "P2", "P3", "DR", "DR", "DR", "B7", "B9", "WN", "WN"], [ pon("P1") ], True, ["B8"]))
+						([ "P1", "P2", "P3", "DR", "DR", "DR", "B7", "B9", "WN", "WN"], [ pon("P1") ], True, ["B8"]),
+						([ "B1", "B2", "B2", "B3", "B3", "P5", "P5", "P6", "P6", "P7", "P7", "WN", "WN"], [], True, ["B1", "B4"]))
 
 		for h, sets, tenpai, w in hands:
 			self.assertEquals(hand_in_tenpai(tiles(h), sets), tenpai)
@@ -220,6 +348,30 @@ class EvalHandTestCase(TestCase):
 			waiting.sort()
 			self.assertEquals(waiting, w)
 
+	def test_waiting_tracker(self):
+		hand = tiles([ "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN"])
+		sets = []
+		tracker = WaitingTracker()
+		tracker.reset(hand, sets)
+		self.assertEquals(tracker.get_waiting(), set([ Tile("WN").id ]))
+		tracker.add_tile(Tile("C5"))
+		self.assert_(not tracker.is_complete())
+		tracker.remove_tile(Tile("WN"))
+		tracker.update()
+		self.assertEquals(tracker.get_waiting(), set([ Tile("C5").id ]))
+		tracker.add_tile(Tile("C5"))
+		self.assert_(tracker.is_complete())
+
+		# Pon and discard
+		tracker.reset(tiles([ "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "WN", "WN", "C5"]), sets)
+		tracker.remove_tile(Tile("P1"))
+		tracker.remove_tile(Tile("P1"))
+		sets.append(pon("P1"))
+		tracker.sets_changed()
+		tracker.remove_tile(Tile("C5"))
+		tracker.update()
+		self.assertEquals(tracker.get_waiting(), set([ Tile("B1").id, Tile("B4").id, Tile("B7").id ]))
+
 	def test_riichi(self):
 		hands = (([ "P5", "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN"], [], True),
 					([ "B3", "B3", "B2", "B2", "C9", "C9", "WW", "WW", "DR", "DR", "P1", "P1", "WN", "WN"], [], True),
@@ -231,19 +383,42 @@ class EvalHandTestCase(TestCase):
 		for h, sets, riichi in hands:
 			self.assertEquals(riichi_test(tiles(h), sets), riichi, [h,sets])
 
-	def test_singlewait(self):
-		# Last tile in the list comes last
-		hands = (([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN", "WN"], [], True),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "WN", "WN", "WN"], [], False),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "P2", "P3"], [], True),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P3", "P2", "P1"], [], True),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "C7", "C8", "C9"], [], True),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "C6", "C7", "C8"], [], False),
-				([  "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P3", "P1", "P2"], [], True),
-				([  "B1", "B2", "B3", "C8", "C8", "C8", "DW", "DW", "DW", "P4", "P4", "P1", "P2", "P3"], [], True))
-		for h, sets, singlewait in hands:
-			self.assertEquals(check_single_waiting(tiles(h), sets), singlewait)
+	def test_riichi_discards(self):
+		hand = tiles([ "P5", "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN"])
+		self.assertEquals(riichi_discards(hand, []), { Tile("P5") : [ Tile("WN") ], Tile("WN") : [ Tile("P5") ] })
+		self.assertEquals(riichi_discards(hand[:-3] + tiles([ "P2", "P3", "P4" ]), [ chi("C1") ]), {})
 
+		for h, sets, value in test_hands:
+			if len(h) + 3 * len(sets) != 14:
+				continue
+			h = tiles(h)
+			discards = riichi_discards(h, sets)
+			for tile in set(h):
+				rest = list(h)
+				rest.remove(tile)
+				if is_hand_open(sets) or not hand_in_tenpai(rest, sets):
+					self.assertFalse(tile in discards)
+				else:
+					self.assertEquals(discards[tile], find_waiting_tiles(rest, sets))
+
+	def test_shanten(self):
+		hands = (([ "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN", "WN" ], [], -1),
+				([ "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P1", "P1", "WN"], [], 0),
+				([ "B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "P1", "P3", "P1", "WN"], [], 1),
+				([ "B1", "B4", "B7", "P2", "P5", "P8", "C3", "C6", "C9", "DR", "DG", "WE", "WS"], [], 6),
+				([ "B3", "B3", "B2", "B2", "C9", "C9", "WW", "WW", "DR", "DR", "P1", "P7", "WN"], [], 1),
+				([ "B1", "B9", "C1", "C9", "P1", "P9", "DW", "DR", "DG", "WN", "WE", "WW", "C5"], [], 1),
+				([ "P1", "P2", "P3", "DR", "DR", "DR", "B7", "B9", "WN", "WN"], [ pon("P1") ], 0),
+				([ "P1", "P2", "P5", "DR", "DR", "DG", "B7", "B9", "WN", "WS"], [ pon("P1") ], 3))
+		for h, sets, shanten in hands:
+			self.assertEquals(hand_shanten(tiles(h), sets), shanten, h)
+
+	def test_best_decomposition(self):
+		hands = (([ "P6", "P7", "P8", "P6", "P7", "P8", "P6", "P7", "P8", "C9", "C9", "C9", "P9", "P9" ], "Ron", [("Suu-ankou", 13)]),
+				([ "B1", "B1", "B1", "B2", "B2", "B2", "B3", "B3", "B3", "C5", "C6", "C7", "P9", "P9" ], "Ron", [("San-anko", 2)]),
+				([ "B1", "B1", "B1", "B2", "B2", "B2", "B3", "B3", "B3", "C5", "C6", "C7", "P9", "P9" ], "Tsumo", [("San-anko", 2), ("Tsumo", 1)]))
+		for h, wintype, yaku in hands:
+			self.assertEquals(find_tiles_yaku(tiles(h), [], [], Tile("WE"), Tile("WS"), wintype), yaku)
 
 	def test_score(self):
 		hand = [ "WN", "B9", "B6", "WN", "B4", "B8", "B5", "B7"]
@@ -258,6 +433,271 @@ class EvalHandTestCase(TestCase):
 		self.assertEquals(payment, ('', 6400))
 		self.assertEquals(minipoints, 25)
 
+	def test_wait_shapes(self):
+		sets = [ chi("B6"), chi("B7"), pon("WN") ]
+		self.assertEquals(wait_shapes(Tile("C2"), sets, Tile("B8")), [ ("ryanmen", sets[0]), ("kanchan", sets[1]) ])
+		self.assertEquals(wait_shapes(Tile("C2"), sets, Tile("B7")), [ ("kanchan", sets[0]), ("penchan", sets[1]) ])
+		self.assertEquals(wait_shapes(Tile("WN"), sets, Tile("WN")), [ ("tanki", None), ("shanpon", sets[2]) ])
+		self.assertEquals(wait_shapes(Tile("C2"), [ chi("P1") ], Tile("P1")), [ ("ryanmen", chi("P1")) ])
+		self.assertEquals(wait_shapes(Tile("C2"), [ chi("P1") ], Tile("P3")), [ ("penchan", chi("P1")) ])
+
+	def test_minipoints(self):
+		winds = (Tile("WE"), Tile("WS"))
+		# Penchan
+		hand = [ "B1", "B2", "C5", "C6", "C7", "P6", "P7", "P8", "C2", "C2", "B4", "B5", "B6", "B3" ]
+		self.assertEquals(evaluate_hand(tiles(hand), [], [], winds[0], winds[1], "Ron"), ([], 40))
+		# Shanpon, pon completed by Ron is counted as open
+		hand = [ "B1", "B1", "B1", "P9", "P9", "P9", "C3", "C4", "C5", "WN", "WN", "C9", "C9", "C9" ]
+		self.assertEquals(evaluate_hand(tiles(hand), [], [], winds[0], winds[1], "Ron")[1], 50)
+		self.assertEquals(evaluate_hand(tiles(hand), [], [], winds[0], winds[1], "Tsumo")[1], 50)
+		hand = hand[:6] + [ "C4", "C5", "WN", "WN", "C9", "C9", "C9", "C3" ]
+		self.assertEquals(evaluate_hand(tiles(hand), [], [], winds[0], winds[1], "Ron")[1], 60)
+		# Pinfu
+		hand = [ "B1", "B2", "B3", "C5", "C6", "C7", "P6", "P7", "P8", "C2", "C2", "B4", "B5", "B6" ]
+		self.assertEquals(evaluate_hand(tiles(hand), [], [], winds[0], winds[1], "Tsumo"), ([ ("Tsumo", 1), ("Pinfu", 1) ], 20))
+		self.assertEquals(evaluate_hand(tiles(hand[:-1]), [], [], winds[0], winds[1], "Ron"), ([], None))
+
+	def test_kan_minipoints(self):
+		# Declared kans: open 8 (simple) or 16 (terminal, honor), closed twice more
+		self.assertEquals(set_minipoints(kan("P5")), 8)
+		self.assertEquals(set_minipoints(ckan("P5")), 16)
+		self.assertEquals(set_minipoints(kan("B9")), 16)
+		self.assertEquals(set_minipoints(ckan("B9")), 32)
+		self.assertEquals(set_minipoints(kan("DR")), 16)
+		self.assertEquals(set_minipoints(ckan("DR")), 32)
+		self.assertEquals(set_minipoints(pon("P5")), 2)
+		self.assertEquals(set_minipoints(Pon(Tile("WN"), True)), 8)
+
+		# Ryanmen wait, open hand: 20 + kan, closed hand: 30 (Ron) + kan
+		winds = (Tile("WE"), Tile("WS"))
+		hand = tiles([ "B1", "B2", "B3", "C6", "C7", "P6", "P7", "P8", "C2", "C2", "C5" ])
+		for set, minipoints in [ (kan("P5"), 30), (ckan("P5"), 50), (kan("DR"), 40), (ckan("B9"), 70) ]:
+			self.assertEquals(evaluate_hand(hand, [ set ], [], winds[0], winds[1], "Ron")[1], minipoints)
+
+
+class BatchEvalTestCase(TestCase):
+
+	def random_hand(self, random):
+		""" Returns (hand, sets) of random complete hand """
+		while True:
+			counts = [ 0 ] * 34
+			melds = []
+			for i in xrange(4):
+				tile = random.choice(all_tiles)
+				if tile.is_suit() and tile.get_number() <= 7 and random.random() < 0.5:
+					melds.append(Chi(tile, tile.next_tile(), tile.next_tile().next_tile()))
+				elif random.random() < 0.1:
+					melds.append(Kan(tile))
+				else:
+					melds.append(Pon(tile))
+			pair = random.choice(all_tiles)
+			for meld in melds:
+				for tile in meld.tiles():
+					counts[tile.id] += 1
+			counts[pair.id] += 2
+			if max(counts) <= 4:
+				break
+
+		hand = [ pair, pair ]
+		sets = []
+		for meld in melds:
+			if meld.is_kan() or random.random() < 0.3:
+				sets.append(meld.with_closed(meld.is_kan() and random.random() < 0.5))
+			else:
+				hand += meld.tiles()
+		random.shuffle(hand)
+		return hand, sets
+
+	def check_batch(self, items):
+		""" items: list of (hand, sets, wintype, doras, specials, round_wind, player_wind) """
+		expected = []
+		for hand, sets, wintype, doras, specials, round_wind, player_wind in items:
+			try:
+				expected.append(compute_score(hand, sets, wintype, (doras, []), specials, round_wind, player_wind))
+			except KeyError: # Minipoints out of scoring table
+				expected.append(None)
+
+		dora_counts = [ tiles_to_counts(item[3]) for item in items ]
+		specials = [ sum(yaku_bits[name] for name, value in item[4]) for item in items ]
+		yaku, han, minipoints, payment = score_hands(
+			[ tiles_to_counts(item[0]) for item in items ],
+			[ encode_open_sets(item[1]) for item in items ],
+			[ item[0][-1].id for item in items ],
+			[ item[2] == "Tsumo" for item in items ],
+			[ item[5].id for item in items ],
+			[ item[6].id for item in items ],
+			doras = dora_counts, specials = specials)
+
+		checked = 0
+		for i, result in enumerate(expected):
+			if result is None or not find_tiles_yaku(*(items[i][:2] + (items[i][4], items[i][5], items[i][6], items[i][2]))):
+				continue
+			(name, pay), scores, mp = result
+			names = set(n for n, value in scores if n not in ("Dora", "Ura dora"))
+			batch_names = set(n for n in yaku_names if yaku[i] & yaku_bits[n])
+			self.assertEquals(batch_names, names, (items[i], names, batch_names))
+			self.assertEquals(han[i], min(sum(value for n, value in scores), 13))
+			self.assertEquals(minipoints[i], mp, items[i])
+			if isinstance(pay, tuple):
+				self.assertEquals(tuple(payment[i]), pay)
+			else:
+				self.assertEquals(tuple(payment[i]), (pay, 0))
+			checked += 1
+		return checked
+
+	def test_test_hands(self):
+		items = []
+		winds = [ (Tile("WE"), Tile("WE")), (Tile("WE"), Tile("WS")), (Tile("WS"), Tile("WW")) ]
+		for i, (hand, sets, value) in enumerate(test_hands):
+			round_wind, player_wind = winds[i % 3]
+			for wintype in [ "Ron", "Tsumo" ]:
+				specials = [ ("Riichi", 1) ] if not sets and i % 2 else []
+				items.append((tiles(hand), sets, wintype, [ Tile("C2") ], specials, round_wind, player_wind))
+		self.assertTrue(self.check_batch(items) > 100)
+
+	def test_random_hands(self):
+		random = Random(4321)
+		items = []
+		for i in xrange(500):
+			hand, sets = self.random_hand(random)
+			wintype = random.choice([ "Ron", "Tsumo" ])
+			winds = [ Tile("WE"), Tile("WS"), Tile("WW"), Tile("WN") ]
+			doras = [ random.choice(all_tiles) ]
+			items.append((hand, sets, wintype, doras, [], random.choice(winds), random.choice(winds)))
+		self.assertTrue(self.check_batch(items) > 100)
+
+	def test_incomplete_hands(self):
+		yaku, han, minipoints, payment = score_hands(
+			[ tiles_to_counts(tiles([ "C1", "B1", "B9", "C2", "WW", "WW", "WN", "WS", "DR", "DG", "DW", "C5", "P7", "P9" ])) ],
+			[ [ -1 ] * 4 ], [ Tile("P9").id ], [ False ], [ Tile("WE").id ], [ Tile("WE").id ])
+		self.assertEquals((yaku[0], han[0], minipoints[0], tuple(payment[0])), (0, 0, 0, (0, 0)))
+
+
+class DummyState:
+
+	def drop_tile(self, player, tile):
+		pass
+
+
+class DummyServer:
+
+	def __init__(self):
+		self.state = DummyState()
+
+
+class FuritenTestCase(TestCase):
+
+	def create_player(self):
+		player = Player(DummyServer(), "Player")
+		player.set_round(None, tiles([ "B1", "B2", "B3", "B4", "B5", "B6", "P1", "P1", "P1", "WN", "WN", "C2", "C3" ]))
+		return player
+
+	def draw_and_drop(self, player, tile_name):
+		player.new_hand_tile(Tile(tile_name))
+		player.drop_tile(Tile(tile_name))
+
+	def test_discard_furiten(self):
+		player = self.create_player()
+		self.assertFalse(player.is_furiten())
+		self.draw_and_drop(player, "DR")
+		self.assertFalse(player.is_furiten())
+		self.draw_and_drop(player, "C4")
+		self.assertTrue(player.is_furiten())
+		self.draw_and_drop(player, "DR")
+		self.assertTrue(player.is_furiten())
+
+	def test_temporary_furiten(self):
+		player = self.create_player()
+		player.ron_chance_passed()
+		self.assertTrue(player.is_furiten())
+		self.draw_and_drop(player, "DR")
+		self.assertFalse(player.is_furiten())
+
+	def test_riichi_furiten(self):
+		player = self.create_player()
+		player.riichi = True
+		player.ron_chance_passed()
+		self.draw_and_drop(player, "DR")
+		self.assertTrue(player.is_furiten())
+
+
+class ClaimIndexTestCase(TestCase):
+
+	def test_claims(self):
+		for kind, hand, sets in generate_corpus(3, 10):
+			hand = hand[:-1]
+			tracker = WaitingTracker()
+			tracker.reset(hand, sets)
+			waiting = find_waiting_tiles(hand, sets)
+			for tile in all_tiles:
+				claims = tracker.get_claims(tile, Tile("WE"), Tile("WS"))
+				self.assertEquals(claims.pon, hand.count(tile) >= 2)
+				self.assertEquals(claims.kan, hand.count(tile) >= 3)
+				self.assertEquals(claims.chi, find_potential_chi(hand, tile))
+				self.assertEquals(claims.waiting, tile in waiting)
+				self.assertEquals(claims.ron_yaku, tile in waiting and \
+					count_of_tiles_yaku(hand + [ tile ], sets, [], Tile("WE"), Tile("WS"), "Ron") > 0)
+
+	def test_rebuild(self):
+		h = tiles([ "B1", "B2", "B3", "B4", "B5", "B6", "P1", "P1", "P1", "WN", "WN", "C2", "C3" ])
+		tracker = WaitingTracker()
+		tracker.reset(h, [])
+		self.assertTrue(tracker.get_claims(Tile("C4"), Tile("WE"), Tile("WS")).waiting)
+		self.assertTrue(tracker.get_claims(Tile("C1"), Tile("WE"), Tile("WS")).chi)
+		tracker.add_tile(Tile("DR"))
+		tracker.remove_tile(Tile("C3"))
+		self.assertFalse(tracker.get_claims(Tile("C4"), Tile("WE"), Tile("WS")).waiting)
+		self.assertFalse(tracker.get_claims(Tile("C1"), Tile("WE"), Tile("WS")).chi)
+
+
+class HandActionsTestCase(TestCase):
+
+	def test_cache(self):
+		h = tiles([ "B1", "B2", "B3", "B4", "B5", "B6", "P1", "P1", "P1", "WN", "WN", "C2", "C3", "C4" ])
+		player = create_player(h, [])
+		calls = []
+		compute = player.compute_hand_actions
+		player.compute_hand_actions = lambda: calls.append(1) or compute()
+		self.assertEquals(player.hand_actions(), [ "Tsumo", "Riichi" ])
+		self.assertEquals(player.hand_actions(), [ "Tsumo", "Riichi" ])
+		self.assertEquals(len(calls), 1)
+		player.riichi = True
+		self.assertEquals(player.hand_actions(), [ "Tsumo" ])
+		player.remove_hand_tile(Tile("C4"))
+		player.new_hand_tile(Tile("DR"))
+		self.assertEquals(player.hand_actions(), [])
+		self.assertEquals(len(calls), 3)
+
+
+class BenchTestCase(TestCase):
+
+	def test_corpus(self):
+		corpus = generate_corpus(7, 10)
+		self.assertEquals(corpus, generate_corpus(7, 10))
+		for kind, hand, sets in corpus:
+			self.assertEquals(len(hand) + 3 * len(sets), 14)
+			shanten = { "tenpai" : 0, "one_shanten" : 1 }.get(kind, -1)
+			self.assertEquals(hand_shanten(hand[:-1], sets), max(shanten, 0), (kind, hand, sets))
+			if shanten == -1:
+				self.assertEquals(hand_shanten(hand, sets), -1, (kind, hand, sets))
+
+	def test_run_benchmark(self):
+		results = run_benchmark(generate_corpus(7, 1), repeat = 1)
+		self.assertEquals(results["compute_score"]["calls"], 5)
+		self.assertEquals(results["steal_actions"]["calls"], 7)
+		self.assertTrue(results["riichi_test"]["p50_us"] <= results["riichi_test"]["p99_us"])
+		results = run_benchmark(generate_corpus(7, 1), repeat = 1, cold = True)
+		self.assertEquals(results["hand_actions"]["calls"], 7)
+
+
+class KanBotFuzzer(BotFuzzer):
+
+	""" Fuzzer of bot that counts one more han for hands with kan """
+
+	def bot_hans(self, cases):
+		hans = BotFuzzer.bot_hans(self, cases)
+		return [ han + any(set.is_kan() for set in case.sets) for case, han in zip(cases, hans) ]
+
 
 class BotEngineTestCase(TestCase):
 
@@ -299,10 +739,11 @@ class BotEngineTestCase(TestCase):
 		e = BotEngine()
 		try:
 			e.set_blocking()
-			# Remove last 8 tests (Hand: seven pairs), bot "question_yaku" detect only "normal sets"
-			# + 3 next hand because bot don't see pinfu yet
-			# + 1 beacause bot see kan as pon
-			for hand_id, h in enumerate(test_hands[:-14]): 
+			# Remove last 16 tests, bot "question_yaku" detect only "normal sets" and does not see pinfu:
+			# 1 hand with kans (bot see kan as pon), 5 pinfu hands (including the two
+			# ryanmen hands moved from the penchan tests) and 10 special hands
+			# (5 seven pairs, 3 chuuren-pootoo, 2 kokushi-musou)
+			for hand_id, h in enumerate(test_hands[:-16]): 
 				hand, sets, r = h
 				e.set_hand(tiles(hand))
 				e.set_sets(sets)
@@ -313,6 +754,34 @@ class BotEngineTestCase(TestCase):
 		finally:
 			e.shutdown()
 
+	def test_bot_fuzzer(self):
+		e = BotEngine()
+		try:
+			e.set_blocking()
+			fuzzer = BotFuzzer(e)
+			# Hands that the bot counts right (see test_bot_yaku_count)
+			cases = [ Case(tiles(hand), sets, east_wind, south_wind) for hand, sets, r in test_hands[:-16] ]
+			self.assertEquals(fuzzer.check(cases), [])
+
+			# Closed kans are part of random cases
+			for case, bot_han, server_han in fuzzer.run(Random(1), 300, 100):
+				self.assertNotEquals(bot_han, server_han)
+				self.assertTrue(fuzzer.is_divergent(case))
+
+			# Seeded divergence is found and minimized to the kan
+			fuzzer = KanBotFuzzer(e)
+			case = Case(tiles([ "P9", "P2", "P3", "P9", "P4" ]), [ kan("C5"), pon("DR"), chi("B1") ], west_wind, north_wind)
+			cases = [ c for c in cases if not any(set.is_kan() for set in c.sets) ]
+			divergent = fuzzer.check(cases[:10] + [ case ])
+			self.assertEquals(len(divergent), 1)
+			case, bot_han, server_han = divergent[0]
+			self.assertEquals(case.sets, [ kan("C5") ])
+			self.assertEquals(sorted(case.hand), sorted(tiles([ "P9", "P9", "P2", "P3", "P4", "DR", "DR", "DR", "B1", "B2", "B3" ])))
+			self.assertEquals((case.round_wind, case.player_wind), (east_wind, south_wind))
+			self.assertEquals(bot_han, server_han + 1)
+		finally:
+			e.shutdown()
+
 	def test_bot_yaku_count2(self):
 		e = BotEngine()
 		try:
@@ -456,6 +925,249 @@ class BotEngineTestCase(TestCase):
 			e.shutdown()
 
 
+class ReactorTestCase(TestCase):
+
+	def test_readers(self):
+		reactor = Reactor()
+		a, b = socket.socketpair()
+		try:
+			received = []
+			reactor.add_reader(a, lambda: received.append(a.recv(10)))
+			reactor.run_once(0)
+			self.assertEquals(received, [])
+			b.send("x")
+			reactor.run_once(1)
+			self.assertEquals(received, [ "x" ])
+			reactor.remove_reader(a)
+			b.send("y")
+			reactor.run_once(0.01)
+			self.assertEquals(received, [ "x" ])
+		finally:
+			a.close()
+			b.close()
+			reactor.close()
+
+	def test_timers(self):
+		reactor = Reactor()
+		called = []
+		reactor.call_later(0.02, lambda: called.append(2))
+		reactor.call_later(0.01, lambda: called.append(1))
+		timer = reactor.call_later(0.015, lambda: called.append(3))
+		timer.cancel()
+		reactor.call_soon(lambda: called.append(0))
+		reactor.run(lambda: len(called) >= 3)
+		self.assertEquals(called, [ 0, 1, 2 ])
+		self.assertEquals(reactor.next_timeout(5), 5)
+		reactor.close()
+
+	def test_coroutines(self):
+		reactor = Reactor()
+		def double(x):
+			yield reactor.sleep(0.001)
+			raise Return(x * 2)
+		def fail():
+			yield reactor.sleep(0)
+			raise ValueError()
+		def main():
+			a = yield double(2)
+			b = yield double(a)
+			try:
+				yield fail()
+			except ValueError:
+				b += 1
+			raise Return(a + b)
+		task = reactor.spawn(main())
+		reactor.run(lambda: task.done)
+		self.assertEquals(task.result, 13)
+		reactor.close()
+
+	def test_async_dict_protocol(self):
+		reactor = Reactor()
+		a, b = socket.socketpair()
+		protocol = AsyncDictProtocol(reactor, Connection(a))
+		messages = []
+		def read_all():
+			try:
+				while True:
+					msg = yield protocol.read_message()
+					messages.append(msg)
+			except ConnectionClosed:
+				protocol.close()
+		task = reactor.spawn(read_all())
+		b.send("message|LOGIN\nuser_")
+		reactor.run_once(0.01)
+		b.send("name|x\n|\nmessage|READY\n|\nmessage|")
+		b.close()
+		reactor.run(lambda: task.done)
+		self.assertEquals(messages, [ { "message" : "LOGIN", "user_name" : "x" }, { "message" : "READY" } ])
+		reactor.close()
+
+
+class ConnectionTestCase(TestCase):
+
+	def test_read_line(self):
+		a, b = socket.socketpair()
+		connection = Connection(a, 8)
+		self.assertEquals(connection.read_line(), None)
+		b.send("abc\n\nxy")
+		self.assertEquals(connection.read_line(), "abc")
+		self.assertEquals(connection.read_line(), "")
+		self.assertEquals(connection.read_line(), None)
+		b.send("z\n12345678")
+		self.assertEquals(connection.read_line(), "xyz")
+		self.assertEquals(connection.read_line(), None)
+		b.send("\n123456789\n")
+		self.assertEquals(connection.read_line(), "12345678")
+		self.assertRaises(LineTooLong, connection.read_line)
+		b.close()
+		a.close()
+
+	def test_outbound_buffer(self):
+		reactor = Reactor()
+		a, b = socket.socketpair()
+		a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+		connection = Connection(a)
+		connection.set_nonblocking(reactor, 1000000)
+		connection.send("x" * 500000)
+		self.assert_(connection.queued_bytes > 0)
+		self.assert_(a.fileno() in reactor.writers)
+		received = []
+		while connection.queued_bytes:
+			reactor.run_once(1)
+			received.append(b.recv(1000000))
+		self.assert_(a.fileno() not in reactor.writers)
+		self.assertEquals(connection.sent_bytes, 500000)
+		rest = 500000 - sum(map(len, received))
+		while rest:
+			rest -= len(b.recv(rest))
+
+		logging.disable(logging.WARNING)
+		connection.send("y" * 500000)
+		connection.send("z" * 600000)
+		logging.disable(logging.NOTSET)
+		self.assert_(connection.aborted)
+		self.assertEquals(connection.queued_bytes, 0)
+		self.assert_(a.fileno() not in reactor.writers)
+		self.assertRaises(ConnectionClosed, connection.read_line)
+		connection.close()
+		b.close()
+		reactor.close()
+
+	def test_closed(self):
+		a, b = socket.socketpair()
+		connection = Connection(a)
+		b.send("line\n")
+		b.close()
+		self.assertEquals(connection.read_line(), "line")
+		self.assertRaises(ConnectionClosed, connection.read_line)
+		a.close()
+
+
+class ServerTestCase(TestCase):
+
+	def login(self, server, name):
+		s = socket.create_connection(("127.0.0.1", 4599))
+		s.send("message|LOGIN\nuser_name|%s\n|\n" % name)
+		for i in xrange(10):
+			server.reactor.run_once(0.01)
+		return s
+
+	def test_multiple_tables(self):
+		server = Server(4599, 4, multiple_tables = True)
+		try:
+			sockets = [ self.login(server, "p%i" % i) for i in xrange(5) ]
+			self.assertEquals(server.started_tables, 1)
+			self.assertEquals(len(server.tables), 2)
+			table1, table2 = server.tables
+			self.assert_(table1.round is not None)
+			self.assertEquals([ p.name for p in table2.players ], [ "p4" ])
+
+			# Broken message closes only its table
+			logging.disable(logging.ERROR)
+			sockets[0].send("foo|bar\n|\n")
+			for i in xrange(10):
+				server.reactor.run_once(0.01)
+			logging.disable(logging.NOTSET)
+			self.assert_(table1.closed)
+			self.assertEquals(server.tables, [ table2 ])
+			self.assertEquals(server.failed_tables, 1)
+			self.assertEquals(server.get_metrics()["table_metrics"][0]["players"], [ "p4" ])
+			sockets[1].settimeout(1)
+			while sockets[1].recv(4096):
+				pass
+
+			sockets += [ self.login(server, "p%i" % i) for i in xrange(5, 8) ]
+			self.assertEquals(server.started_tables, 2)
+			self.assert_(table2.round is not None)
+			self.assertEquals(len(server.tables), 2)
+			self.assertFalse(server.exit_flag)
+			for s in sockets:
+				s.close()
+		finally:
+			server.server_quit()
+
+	def check_malformed_login(self, coroutines):
+		server = Server(4599, 4, coroutines, True)
+		try:
+			sockets = [ self.login(server, "p%i" % i) for i in xrange(4) ]
+			table = server.tables[0]
+			self.assert_(table.round is not None)
+			logging.disable(logging.ERROR)
+			for data in [ "message|LOGIN\n|\n", "message|LOGIN\nuser_name\n|\n", "|\n" ]:
+				s = socket.create_connection(("127.0.0.1", 4599))
+				s.send(data)
+				for i in xrange(10):
+					server.reactor.run_once(0.01)
+				s.settimeout(1)
+				self.assertEquals(s.recv(4096), "")
+				s.close()
+			logging.disable(logging.NOTSET)
+			self.assertFalse(table.closed)
+			self.assertEquals(server.tables[0], table)
+			self.assertEquals(server.open_table.players, [])
+			for s in sockets:
+				s.close()
+		finally:
+			server.server_quit()
+
+	def test_bad_tiles(self):
+		server = Server(4599, 4, multiple_tables = True)
+		try:
+			sockets = [ self.login(server, "p%i" % i) for i in xrange(4) ]
+			table = server.tables[0]
+			dealer = table.round.get_dealer()
+			s = sockets[int(dealer.name[1])]
+			not_in_hand = [ tile for tile in all_tiles if tile not in dealer.hand ][0]
+			registry_size = len(Tile.registry)
+			logging.disable(logging.ERROR)
+			for name in [ "", "Bx", "XX" ] + [ "Q%i" % i for i in xrange(100) ]:
+				s.send("message|DROP\ntile|%s\n|\nmessage|KAN\ntile|%s\n|\n" % (name, name))
+			s.send("message|DROP\ntile|%s\n|\n" % not_in_hand.name)
+			no_kan = [ tile for tile in dealer.hand if dealer.hand.count(tile) < 4 ][0]
+			s.send("message|KAN\ntile|%s\n|\n" % no_kan.name)
+			for i in xrange(10):
+				server.reactor.run_once(0.01)
+			logging.disable(logging.NOTSET)
+			self.assertEquals(len(Tile.registry), registry_size)
+			self.assertFalse(table.closed)
+			self.assertTrue(dealer.can_drop_tile)
+			self.assertEquals(len(dealer.hand), 14)
+
+			s.send("message|DROP\ntile|%s\n|\n" % dealer.hand[0].name)
+			for i in xrange(10):
+				server.reactor.run_once(0.01)
+			self.assertFalse(dealer.can_drop_tile)
+			self.assertEquals(len(dealer.hand), 13)
+			for s in sockets:
+				s.close()
+		finally:
+			server.server_quit()
+
+	def test_malformed_login(self):
+		self.check_malformed_login(False)
+		self.check_malformed_login(True)
+
+
 if __name__ == '__main__':
     unittest.main()
 
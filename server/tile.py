@@ -15,19 +15,68 @@
 # <http://www.gnu.org/licenses/>.
 
 
+# Tile ids follow the ordering of bot/tiles.h
+tile_names = [ "DR", "DG", "DW", "WE", "WS", "WW", "WN",
+	"B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9",
+	"P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9",
+	"C1", "C2", "C3", "C4", "C5", "C6", "C7", "C8", "C9" ]
+
+TILES_COUNT = 34
+
+tile_ids = dict((name, i) for i, name in enumerate(tile_names))
+
+# Ids of the first tile of each suit (B1, P1, C1)
+suit_first_ids = [ 7, 16, 25 ]
+honor_ids = range(7)
+suit_ids = range(7, TILES_COUNT)
+terminal_ids = [ 7, 15, 16, 24, 25, 33 ]
+nonterminal_ids = [ i for i in suit_ids if i not in terminal_ids ]
+
+
+class UnknownTile(ValueError):
+	pass
+
+
 class Tile(object):
+	""" Tiles are interned: Tile("B3") always returns the same instance,
+	    so tiles compare by identity. All attributes are computed once
+	    when the registry is built. """
+
+	__slots__ = ("name", "id", "type", "number", "honor", "suit", "terminal", "green",
+		"next", "prev", "bamboo", "char", "pin")
 
 	honor_types = [ "W", "D" ]
 	suit_types = [ "P", "B", "C" ]
-	
-	def __init__(self, name):
-		self.name = name
 
-	def __eq__(self, x):
-		return self.name == x.name
-	
-	def __hash__(self):
-		return hash(self.name)
+	registry = {}
+
+	def __new__(cls, name):
+		""" Raises UnknownTile if name is not a name of tile """
+		tile = cls.registry.get(name)
+		if tile is None:
+			raise UnknownTile(name)
+		return tile
+
+	@classmethod
+	def create(cls, name, id):
+		tile = object.__new__(cls)
+		tile.name = name
+		tile.id = id
+		tile.type = name[0]
+		tile.suit = tile.type in cls.suit_types
+		tile.honor = tile.type in cls.honor_types
+		if tile.suit:
+			tile.number = int(name[1])
+		else:
+			tile.number = None
+		tile.terminal = tile.suit and tile.number in (1, 9)
+		tile.green = name in ("DG", "B2", "B3", "B4", "B6", "B8")
+		tile.next = tile.prev = tile.bamboo = tile.char = tile.pin = None
+		return tile
+
+	def __reduce__(self):
+		# Copies and unpickled tiles resolve back to the interned instance
+		return (Tile, (self.name,))
 
 	def __str__(self):
 		return "|%s|" % self.name
@@ -42,65 +91,77 @@ class Tile(object):
 		return self.name < x.name	
 
 	def get_type(self):
-		return self.name[0]
+		return self.type
 
 	def get_number(self):
-		return int(self.name[1])
+		return self.number
 
 	def is_honor(self):
-		return self.get_type() in self.honor_types
+		return self.honor
 	
 	def is_dragon(self):
-		return self.get_type() == "D"
+		return self.type == "D"
 
 	def is_wind(self):
-		return self.get_type() == "W"
+		return self.type == "W"
 
 	def is_suit(self):
-		return self.get_type() in self.suit_types
+		return self.suit
 
 	def is_terminal(self):
-		return self.is_suit() and (self.get_number() == 1 or self.get_number() == 9)
+		return self.terminal
 
 	def is_nonterminal(self):
-		return self.is_suit() and self.get_number() != 1 and self.get_number() != 9
+		return self.suit and not self.terminal
 
 	def next_tile(self):
-		n = self.get_number() + 1
-		if n == 10:
-			n = 1
-		return Tile(self.get_type() + str(n))
+		return self.next
 
 	def prev_tile(self):
-		n = self.get_number() - 1
-		if n == 0:
-			n = 9
-		return Tile(self.get_type() + str(n))
+		return self.prev
 
 	def as_bamboo(self):
-		return Tile("B" + self.name[1])
+		return self.bamboo
 
 	def as_char(self):
-		return Tile("C" + self.name[1])
+		return self.char
 
 	def as_pins(self):
-		return Tile("P" + self.name[1])
+		return self.pin
 
 	def is_bamboo(self):
-		return self.name[0] == "B"
+		return self.type == "B"
 
 	def is_char(self):
-		return self.name[0] == "C"
+		return self.type == "C"
 
 	def is_pins(self):
-		return self.name[0] == "P"
+		return self.type == "P"
 
 	def is_green(self):
-		return self.name in ("DG", "B2", "B3", "B4", "B6", "B8")
+		return self.green
 
 	def is_same_type(self, tile):
-		return self.name[0] == tile.name[0]
+		return self.type == tile.type
+
 
+def _build_registry():
+	for i, name in enumerate(tile_names):
+		Tile.registry[name] = Tile.create(name, i)
+	for tile in Tile.registry.values():
+		if tile.suit:
+			n = str(tile.number % 9 + 1)
+			p = str((tile.number + 7) % 9 + 1)
+			tile.next = Tile.registry[tile.type + n]
+			tile.prev = Tile.registry[tile.type + p]
+			tile.bamboo = Tile.registry["B" + tile.name[1]]
+			tile.char = Tile.registry["C" + tile.name[1]]
+			tile.pin = Tile.registry["P" + tile.name[1]]
+
+_build_registry()
+
+# Placeholder for "no wind" (it is not in the registry and has no id)
+no_wind = Tile.create("XX", None)
 
 red_dragon = Tile("DR")
 white_dragon = Tile("DW")
@@ -119,6 +180,25 @@ chars = [ Tile("C1"), Tile("C2"), Tile("C3"), Tile("C4"), Tile("C5"), Tile("C6")
 bamboos = [ Tile("B1"), Tile("B2"), Tile("B3"), Tile("B4"), Tile("B5"), Tile("B6"), Tile("B7"), Tile("B8"), Tile("B9") ]
 all_tiles = honors + pins + chars + bamboos
 
+tiles_by_id = [ Tile(name) for name in tile_names ]
+
+def tiles_to_counts(tiles):
+	""" Returns list of 34 counts indexed by tile id """
+	counts = [ 0 ] * TILES_COUNT
+	for tile in tiles:
+		counts[tile.id] += 1
+	return counts
+
+def counts_to_tiles(counts):
+	tiles = []
+	for i, count in enumerate(counts):
+		tiles += [ tiles_by_id[i] ] * count
+	return tiles
+
+def is_chi_start_id(tile_id):
+	""" True if chi can start at this tile (suit tile with number <= 7) """
+	return tile_id >= 7 and (tile_id - 7) % 9 <= 6
+
 def dora_from_indicator(tile):
 	if tile.is_suit():
 		return tile.next_tile()
@@ -127,10 +207,30 @@ def dora_from_indicator(tile):
 	return dragons[ (dragons.index(tile) + 1) % 3 ]
 
 class TileSet(object):
-	
-	def __init__(self, closed):
-		self.closed = closed
-		
+	""" Sets are immutable and interned per (kind, first tile, closed),
+	    so they compare by identity and can be used as dict keys.
+	    tiles() returns a cached tuple. """
+
+	__slots__ = ("closed", "tiles_tuple")
+
+	registry = {}
+
+	@classmethod
+	def create(cls, key, tiles, closed, **fields):
+		set = object.__new__(cls)
+		object.__setattr__(set, "closed", closed)
+		object.__setattr__(set, "tiles_tuple", tiles)
+		for name, value in fields.items():
+			object.__setattr__(set, name, value)
+		TileSet.registry[key] = set
+		return set
+
+	def __setattr__(self, name, value):
+		raise AttributeError("%s is immutable" % self.get_name())
+
+	def tiles(self):
+		return self.tiles_tuple
+
 	def is_pon_or_kan(self):
 		return False
 
@@ -144,14 +244,22 @@ class TileSet(object):
 		return False
 
 	def tiles_as_string(self, delimiter = " "):
-		return delimiter.join( [ tile.name for tile in self.tiles() ] )
+		return delimiter.join( [ tile.name for tile in self.tiles_tuple ] )
 
 
 class Pon(TileSet):
-	
-	def __init__(self, tile, closed = True):
-		TileSet.__init__(self, closed)
-		self.tile = tile
+
+	__slots__ = ("tile",)
+
+	def __new__(cls, tile, closed = True):
+		key = (cls, tile, closed)
+		return TileSet.registry.get(key) or cls.create(key, (tile, tile, tile), closed, tile = tile)
+
+	def __reduce__(self):
+		return (Pon, (self.tile, self.closed))
+
+	def with_closed(self, closed):
+		return Pon(self.tile, closed)
 	
 	def get_name(self):
 		return "Pon"
@@ -159,9 +267,6 @@ class Pon(TileSet):
 	def get_representative_tile(self):
 		return self.tile
 
-	def tiles(self):
-		return [ self.tile, self.tile, self.tile ]
-	
 	def is_pon_or_kan(self):
 		return True
 
@@ -175,19 +280,16 @@ class Pon(TileSet):
 		return fn(self.tile)
 
 	def count_of_tile(self, tile):
-		if self.tile == tile:
+		if self.tile is tile:
 			return 3
 		return 0
 
 	def all_tiles_is(self, tile):
-		return self.tile == tile
+		return self.tile is tile
 	
 	def __repr__(self):
 		return "Pon: " + str(self.tile)
 
-	def __eq__(self, x):
-		return isinstance(x, TileSet) and x.is_pon() and self.tile == x.tile
-
 	def is_suit(self):
 		return self.tile.is_suit()
 
@@ -201,19 +303,27 @@ class Pon(TileSet):
 		return self.tile.is_pins()
 
 	def as_char(self):
-		return Pon(self.tile.as_char())
+		return Pon(self.tile.as_char(), self.closed)
 
 	def as_bamboo(self):
-		return Pon(self.tile.as_bamboo())
+		return Pon(self.tile.as_bamboo(), self.closed)
 
 	def as_pins(self):
-		return Pon(self.tile.as_pins())
+		return Pon(self.tile.as_pins(), self.closed)
 
 class Kan(TileSet):
-	
-	def __init__(self, tile, closed = True):
-		TileSet.__init__(self, closed)
-		self.tile = tile
+
+	__slots__ = ("tile",)
+
+	def __new__(cls, tile, closed = True):
+		key = (cls, tile, closed)
+		return TileSet.registry.get(key) or cls.create(key, (tile, tile, tile, tile), closed, tile = tile)
+
+	def __reduce__(self):
+		return (Kan, (self.tile, self.closed))
+
+	def with_closed(self, closed):
+		return Kan(self.tile, closed)
 	
 	def get_name(self):
 		return "Kan"
@@ -221,9 +331,6 @@ class Kan(TileSet):
 	def get_representative_tile(self):
 		return self.tile
 
-	def tiles(self):
-		return [ self.tile, self.tile, self.tile, self.tile ]
-	
 	def is_pon_or_kan(self):
 		return True
 
@@ -237,19 +344,16 @@ class Kan(TileSet):
 		return fn(self.tile)
 
 	def count_of_tile(self, tile):
-		if self.tile == tile:
+		if self.tile is tile:
 			return 4
 		return 0
 
 	def all_tiles_is(self, tile):
-		return self.tile == tile
+		return self.tile is tile
 	
 	def __repr__(self):
 		return "Kan: " + str(self.tile)
 
-	def __eq__(self, x):
-		return isinstance(x, TileSet) and x.is_kan() and self.tile == x.tile
-
 	def is_suit(self):
 		return self.tile.is_suit()
 
@@ -263,22 +367,29 @@ class Kan(TileSet):
 		return self.tile.is_pins()
 
 	def as_char(self):
-		return Kan(self.tile.as_char())
+		return Kan(self.tile.as_char(), self.closed)
 
 	def as_bamboo(self):
-		return Kan(self.tile.as_bamboo())
+		return Kan(self.tile.as_bamboo(), self.closed)
 
 	def as_pins(self):
-		return Kan(self.tile.as_pins())
+		return Kan(self.tile.as_pins(), self.closed)
 
 
 class Chi(TileSet):
-	
-	def __init__(self, tile1, tile2, tile3, closed = True):
-		TileSet.__init__(self, closed)
-		self.tile1 = tile1
-		self.tile2 = tile2
-		self.tile3 = tile3
+
+	__slots__ = ("tile1", "tile2", "tile3")
+
+	def __new__(cls, tile1, tile2, tile3, closed = True):
+		key = (cls, tile1, closed)
+		return TileSet.registry.get(key) or cls.create(key, (tile1, tile2, tile3), closed,
+			tile1 = tile1, tile2 = tile2, tile3 = tile3)
+
+	def __reduce__(self):
+		return (Chi, (self.tile1, self.tile2, self.tile3, self.closed))
+
+	def with_closed(self, closed):
+		return Chi(self.tile1, self.tile2, self.tile3, closed)
 
 	def get_name(self):
 		return "Chi"
@@ -286,9 +397,6 @@ class Chi(TileSet):
 	def get_representative_tile(self):
 		return self.tile1
 
-	def tiles(self):
-		return [ self.tile1, self.tile2, self.tile3 ]
-
 	def __repr__(self):
 		return "Chi: %s %s %s" % (self.tile1, self.tile2, self.tile3)		
 
@@ -299,7 +407,7 @@ class Chi(TileSet):
 		return fn(self.tile1) or fn(self.tile2) or fn(self.tile3)
 
 	def count_of_tile(self, tile):
-		if self.tile1 == tile or self.tile2 == tile or self.tile3 == tile:
+		if self.tile1 is tile or self.tile2 is tile or self.tile3 is tile:
 			return 1
 		else:
 			return 0
@@ -317,13 +425,10 @@ class Chi(TileSet):
 		return self.tile1.is_suit()
 
 	def as_char(self):
-		return Chi(self.tile1.as_char(), self.tile2.as_char(), self.tile3.as_char())
+		return Chi(self.tile1.as_char(), self.tile2.as_char(), self.tile3.as_char(), self.closed)
 
 	def as_bamboo(self):
-		return Chi(self.tile1.as_bamboo(), self.tile2.as_bamboo(), self.tile3.as_bamboo())
+		return Chi(self.tile1.as_bamboo(), self.tile2.as_bamboo(), self.tile3.as_bamboo(), self.closed)
 
 	def as_pins(self):
-		return Chi(self.tile1.as_pins(), self.tile2.as_pins(), self.tile3.as_pins())
-
-	def __eq__(self, x):
-		return isinstance(x, TileSet) and x.is_chi() and self.tile1 == x.tile1
+		return Chi(self.tile1.as_pins(), self.tile2.as_pins(), self.tile3.as_pins(), self.closed)